@@ -0,0 +1,24 @@
+import redis
+from django.conf import settings
+
+_connection = None
+_scripts = {}
+
+
+def get_redis():
+    # Direct client for the structures the Django cache API has no verbs for
+    # (sorted sets, hashes, scripts). Shares the Redis instance used by Celery
+    # and the cache; redis-py keeps its own connection pool per client.
+    global _connection
+    if _connection is None:
+        _connection = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _connection
+
+
+def get_script(source):
+    # Lua scripts are registered once and run by SHA (EVALSHA), so the source
+    # only goes over the wire again after Redis drops its script cache.
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_redis().register_script(source)
+    return script
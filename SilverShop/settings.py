@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 from decouple import config
+from corsheaders.defaults import default_headers
 
 from pathlib import Path
 
@@ -257,8 +258,25 @@ LOGGING = {
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 
+REDIS_URL = config('REDIS_URL', default='redis://redis:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'silvershop',
+    }
+}
+PRODUCT_CACHE_TIMEOUT = 60 * 15
+
 CELERY_BROKER_URL = config('REDIS_URL', default='redis://redis:6379')
 CELERY_RESULT_BACKEND = config('REDIS_URL', default='redis://redis:6379')
+# Replaced product images are released this long after the save.
+PRODUCT_IMAGE_RELEASE_GRACE = 60 * 60
+# A task sent with a countdown stays unacknowledged in Redis until it runs,
+# and Redis hands it to another worker once the visibility timeout passes.
+# Keep the timeout past the longest countdown so the task runs only once.
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': PRODUCT_IMAGE_RELEASE_GRACE + 60 * 60}
 CELERY_BEAT_SCHEDULE = {
     'update_delivery_status': {
         'task': 'order_app.tasks.update_delivery_status',
@@ -277,6 +295,8 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['idempotent-replayed']
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # Adjust this to match your frontend origin
 ]
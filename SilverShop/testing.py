@@ -0,0 +1,60 @@
+import json
+from django.db import connection
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+from SilverShop.redis_client import get_redis
+
+# Helpers shared by the apps' test modules.
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except Exception:
+        return False
+
+
+class QueryPlanMixin:
+    # Fails when the plan for a queryset has no index it could read its table
+    # by. On small test tables MySQL may rightly prefer a full scan, so there
+    # the check is on possible_keys, which depends on the query and the
+    # schema only, not on the chosen access type.
+    def full_scans(self, queryset):
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'mysql':
+            plan = json.loads(queryset.explain(format='JSON'))
+            scans = []
+
+            def walk(node):
+                if isinstance(node, dict):
+                    if node.get('table_name') == table and node.get('access_type') == 'ALL' and not node.get('possible_keys'):
+                        scans.append(node)
+                    for value in node.values():
+                        walk(value)
+                elif isinstance(node, list):
+                    for value in node:
+                        walk(value)
+            walk(plan)
+            return scans
+        if connection.vendor == 'sqlite':
+            return [
+                line for line in queryset.explain().splitlines()
+                if f'SCAN {table}' in line and 'INDEX' not in line
+            ]
+        self.skipTest(f'No plan check for {connection.vendor}')
+
+    def assertUsesIndex(self, queryset):
+        scans = self.full_scans(queryset)
+        self.assertFalse(scans, f'Full table scan in plan for: {queryset.query}')
+
+    def build_view(self, viewset, params=None, user=None, action='list'):
+        request = APIRequestFactory().get('/', params or {})
+        if user is not None:
+            force_authenticate(request, user=user)
+        view = viewset()
+        view.request = Request(request)
+        view.request.user = user
+        view.action = action
+        view.format_kwarg = None
+        view.kwargs = {}
+        return view
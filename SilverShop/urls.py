@@ -17,7 +17,7 @@ Including another URLconf
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
 
 urlpatterns = [
@@ -32,5 +32,15 @@ urlpatterns = [
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
 ]
+# Media is only served by Django in development. In production the web server
+# serves MEDIA_ROOT and has to set the immutable Cache-Control that
+# serve_product_media adds to content-addressed files itself, e.g. for nginx:
+#   location ~ ^/media/products/(.*/)?[0-9a-f]{64}[/.] {
+#       add_header Cache-Control "public, max-age=31536000, immutable";
+#   }
 if settings.DEBUG:
+    from product_app.views import serve_product_media
+    urlpatterns += [
+        re_path(r'^%s(?P<path>products/.*)$' % settings.MEDIA_URL.lstrip('/'), serve_product_media),
+    ]
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
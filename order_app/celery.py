@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SilverShop.settings')
 
@@ -18,6 +19,50 @@ app.conf.beat_schedule = {
         'task': 'order_app.queue_management.check_reservations',  
         'schedule': 60.0,  
     },
+    'release-expired-cart-holds-every-minute': {
+        'task': 'order_app.tasks.release_expired_cart_holds',
+        'schedule': 60.0,
+    },
+    'reconcile-flash-sale-stock-every-30-seconds': {
+        'task': 'order_app.tasks.reconcile_flash_sale_stock',
+        'schedule': 30.0,
+    },
+    'drain-outbox-every-10-seconds': {
+        'task': 'order_app.tasks.drain_outbox',
+        'schedule': 10.0,
+    },
+    'flush-sales-counters-every-minute': {
+        'task': 'product_app.tasks.flush_sales_counters',
+        'schedule': 60.0,
+    },
+    'flush-view-counters-every-minute': {
+        'task': 'product_app.tasks.flush_view_counters',
+        'schedule': 60.0,
+    },
+    'activate-promotions-every-minute': {
+        'task': 'product_app.tasks.activate_promotions',
+        'schedule': 60.0,
+    },
+    'update-product-cooccurrences-every-15-minutes': {
+        'task': 'product_app.tasks.update_product_cooccurrences',
+        'schedule': 60.0 * 15,
+    },
+    'purge-idempotency-keys-nightly': {
+        'task': 'order_app.tasks.purge_idempotency_keys',
+        'schedule': crontab(hour=4, minute=0),
+    },
+    'reconcile-total-spent-nightly': {
+        'task': 'order_app.tasks.reconcile_total_spent',
+        'schedule': crontab(hour=4, minute=15),
+    },
+    'purge-outbox-nightly': {
+        'task': 'order_app.tasks.purge_outbox',
+        'schedule': crontab(hour=4, minute=30),
+    },
+    'rebuild-sales-leaderboards-nightly': {
+        'task': 'product_app.tasks.rebuild_sales_leaderboards',
+        'schedule': crontab(hour=3, minute=0),
+    },
 }
 
 app.conf.timezone = 'Asia/Tehran'  
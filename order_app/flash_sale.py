@@ -0,0 +1,262 @@
+import logging
+import uuid
+from collections import namedtuple
+from functools import partial
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from SilverShop.redis_client import get_redis, get_script
+from product_app.models import Product
+from product_app.cache import invalidate_product
+from .models import PreOrderQueue
+from .queue_management import next_queue_position
+from .stock import release_product_holds, return_stock
+
+logger = logging.getLogger(__name__)
+
+# While a product is in flash-sale mode its available stock lives in Redis and
+# every reserve/claim is a single script call, so no request waits on the
+# product row. Product.stock is brought up to date by reconcile_flash_sales,
+# which means stock edited on the row during a sale is overwritten; restock a
+# running sale with release_units.
+ACTIVE_KEY = 'flash:products'
+STOCK_KEY = 'flash:stock:{product_id}'
+# token -> "user_id:quantity"
+RESERVATIONS_KEY = 'flash:reservations:{product_id}'
+# token -> expiry timestamp
+EXPIRY_KEY = 'flash:expiry:{product_id}'
+# user_id -> token, so a user holds at most one reservation per product
+HOLDERS_KEY = 'flash:holders:{product_id}'
+
+RESERVATION_TTL = timedelta(seconds=getattr(settings, 'FLASH_SALE_RESERVATION_SECONDS', 10 * 60))
+PREORDER_RESERVATION_TTL = timedelta(hours=4)
+EXPIRE_BATCH = 1000
+
+NOT_STARTED = -1
+
+Reservation = namedtuple('Reservation', ['token', 'quantity', 'expires_at'])
+
+RESERVE_SCRIPT = """
+local stock = tonumber(redis.call('GET', KEYS[1]))
+if not stock then return {-1} end
+local quantity = tonumber(ARGV[2])
+if stock < quantity then return {0} end
+local held = 0
+local token = redis.call('HGET', KEYS[4], ARGV[1])
+if token then
+    local entry = redis.call('HGET', KEYS[2], token)
+    if entry then held = tonumber(string.match(entry, ':(%d+)$')) else token = false end
+end
+if not token then
+    token = ARGV[3]
+    redis.call('HSET', KEYS[4], ARGV[1], token)
+end
+redis.call('DECRBY', KEYS[1], quantity)
+redis.call('HSET', KEYS[2], token, ARGV[1] .. ':' .. (held + quantity))
+redis.call('ZADD', KEYS[3], ARGV[4], token)
+return {1, token, held + quantity}
+"""
+
+CLAIM_SCRIPT = """
+local token = redis.call('HGET', KEYS[3], ARGV[1])
+if token ~= ARGV[2] then return 0 end
+local entry = redis.call('HGET', KEYS[1], token)
+redis.call('HDEL', KEYS[3], ARGV[1])
+if not entry then return 0 end
+redis.call('HDEL', KEYS[1], token)
+redis.call('ZREM', KEYS[2], token)
+return tonumber(string.match(entry, ':(%d+)$'))
+"""
+
+# Puts a claimed reservation back when the order that claimed it rolls back.
+REINSTATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[1] .. ':' .. ARGV[3])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[2])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+local token = redis.call('HGET', KEYS[4], ARGV[1])
+if not token then return 0 end
+redis.call('HDEL', KEYS[4], ARGV[1])
+local entry = redis.call('HGET', KEYS[2], token)
+if not entry then return 0 end
+local quantity = tonumber(string.match(entry, ':(%d+)$'))
+redis.call('HDEL', KEYS[2], token)
+redis.call('ZREM', KEYS[3], token)
+if redis.call('EXISTS', KEYS[1]) == 1 then redis.call('INCRBY', KEYS[1], quantity) end
+return quantity
+"""
+
+EXPIRE_SCRIPT = """
+local tokens = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local returned = 0
+for _, token in ipairs(tokens) do
+    local entry = redis.call('HGET', KEYS[2], token)
+    if entry then
+        local user, quantity = string.match(entry, '^(%d+):(%d+)$')
+        returned = returned + tonumber(quantity)
+        redis.call('HDEL', KEYS[2], token)
+        if redis.call('HGET', KEYS[4], user) == token then redis.call('HDEL', KEYS[4], user) end
+    end
+    redis.call('ZREM', KEYS[3], token)
+end
+if returned > 0 and redis.call('EXISTS', KEYS[1]) == 1 then redis.call('INCRBY', KEYS[1], returned) end
+return {returned, #tokens}
+"""
+
+# Ends the sale: outstanding reservations go back to the counter, the final
+# count is returned and every key of the product is dropped.
+FINISH_SCRIPT = """
+local stock = tonumber(redis.call('GET', KEYS[1]))
+if not stock then return nil end
+for _, entry in ipairs(redis.call('HVALS', KEYS[2])) do
+    stock = stock + tonumber(string.match(entry, ':(%d+)$'))
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+redis.call('SREM', KEYS[5], ARGV[1])
+return stock
+"""
+
+RETURN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('INCRBY', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def _keys(product_id):
+    return [
+        STOCK_KEY.format(product_id=product_id),
+        RESERVATIONS_KEY.format(product_id=product_id),
+        EXPIRY_KEY.format(product_id=product_id),
+        HOLDERS_KEY.format(product_id=product_id),
+    ]
+
+
+def _start(connection, product_id):
+    # Seeds the counter from the row the first time the product is touched in
+    # flash-sale mode. NX makes concurrent first requests agree on one value.
+    # Carts' holds go back on the shelf first: flash checkouts never consume
+    # them, and once expired they would land in a column the counter then
+    # overwrites.
+    with transaction.atomic():
+        release_product_holds(product_id)
+        stock = Product.objects.filter(pk=product_id).values_list('stock', flat=True).first() or 0
+    pipe = connection.pipeline()
+    pipe.set(STOCK_KEY.format(product_id=product_id), max(stock, 0), nx=True)
+    pipe.sadd(ACTIVE_KEY, product_id)
+    pipe.execute()
+
+
+def reserve(product_id, user_id, quantity):
+    # Returns the user's Reservation (covering everything they reserved so
+    # far) or None when the units are not there.
+    connection = get_redis()
+    expires_at = timezone.now() + RESERVATION_TTL
+    args = [user_id, quantity, uuid.uuid4().hex, expires_at.timestamp()]
+    result = get_script(RESERVE_SCRIPT)(keys=_keys(product_id), args=args)
+    if result[0] == NOT_STARTED:
+        _start(connection, product_id)
+        result = get_script(RESERVE_SCRIPT)(keys=_keys(product_id), args=args)
+    if result[0] != 1:
+        return None
+    return Reservation(result[1], int(result[2]), expires_at)
+
+
+def claim(product_id, user_id, token):
+    # Consumes the user's reservation for an order; returns its quantity, or 0
+    # when there is none, it has expired or it is not the one token names.
+    if not token:
+        return 0
+    stock_key, reservations_key, expiry_key, holders_key = _keys(product_id)
+    return get_script(CLAIM_SCRIPT)(keys=[reservations_key, expiry_key, holders_key], args=[user_id, token])
+
+
+def claim_for_order(product_id, user_id, quantity, token):
+    # Claims exactly quantity units: the reservation token names when it still
+    # covers them, otherwise a fresh one if the counter allows. False when the
+    # units are gone.
+    claimed = claim(product_id, user_id, token)
+    if claimed < quantity:
+        release_units(product_id, claimed)
+        reservation = reserve(product_id, user_id, quantity)
+        if reservation is None:
+            return False
+        claimed = claim(product_id, user_id, reservation.token)
+    release_units(product_id, claimed - quantity)
+    return True
+
+
+def reinstate(product_id, user_id, quantity, token=None):
+    # Puts the reservation back under the token of the cart line that claimed
+    # it, so the next checkout of that line redeems it again.
+    expires_at = timezone.now() + RESERVATION_TTL
+    restored = get_script(REINSTATE_SCRIPT)(
+        keys=_keys(product_id), args=[user_id, token or uuid.uuid4().hex, quantity, expires_at.timestamp()]
+    )
+    if not restored:
+        return_stock(product_id, quantity)
+
+
+def release(product_id, user_id):
+    return get_script(RELEASE_SCRIPT)(keys=_keys(product_id), args=[user_id])
+
+
+def release_units(product_id, quantity):
+    # Returns units to the running sale (a cancelled order, an over-claim), or
+    # to Product.stock once the sale is over.
+    if quantity > 0 and not get_script(RETURN_SCRIPT)(keys=[STOCK_KEY.format(product_id=product_id)], args=[quantity]):
+        return_stock(product_id, quantity)
+
+
+def join_queue(user, product):
+    # Losers go to the pre-order queue. The position is only drawn when the
+    # user is not in the queue yet.
+    entry, created = PreOrderQueue.objects.get_or_create(
+        user=user, product=product,
+        defaults={
+            'position': partial(next_queue_position, product.id),
+            'reservation_expires_at': timezone.now() + PREORDER_RESERVATION_TTL,
+        },
+    )
+    return entry
+
+
+def _sync(connection, product_id, now):
+    keys = _keys(product_id)
+    while True:
+        returned, seen = get_script(EXPIRE_SCRIPT)(keys=keys, args=[now.timestamp(), EXPIRE_BATCH])
+        if seen < EXPIRE_BATCH:
+            break
+    stock = connection.get(keys[0])
+    return None if stock is None else int(stock)
+
+
+def _finish(product_id):
+    return get_script(FINISH_SCRIPT)(keys=_keys(product_id) + [ACTIVE_KEY], args=[product_id])
+
+
+def reconcile_flash_sales(now=None):
+    # Returns expired reservations to the counters and writes them to
+    # Product.stock. A product whose flash_sale flag was switched off has its
+    # sale finished here: reservations still open go back to stock.
+    now = now or timezone.now()
+    connection = get_redis()
+    product_ids = [int(product_id) for product_id in connection.smembers(ACTIVE_KEY)]
+    active = set(Product.objects.filter(pk__in=product_ids, flash_sale=True).values_list('id', flat=True))
+
+    written = 0
+    for product_id in product_ids:
+        stock = _sync(connection, product_id, now) if product_id in active else _finish(product_id)
+        if stock is None:
+            connection.srem(ACTIVE_KEY, product_id)
+            continue
+        if Product.objects.filter(pk=product_id).exclude(stock=stock).update(stock=stock, updated_at=now):
+            invalidate_product(product_id)
+            written += 1
+            logger.info(f"Flash sale stock of product {product_id} written back as {stock}")
+    return written
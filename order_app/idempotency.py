@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import time
+import uuid
+from datetime import timedelta
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from redis.exceptions import RedisError
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from SilverShop.redis_client import get_redis, get_script
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+# How long a stored response is replayed for a retried key.
+RESPONSE_TTL = timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24))
+# A request holding the lock longer than this is taken to have died.
+LOCK_TTL = timedelta(seconds=30)
+# How long a concurrent retry waits for the first request to finish.
+LOCK_WAIT = 10
+POLL_INTERVAL = 0.05
+
+RECORD_KEY = 'idempotency:{scope}'
+
+# The record key holds the in-progress marker and is overwritten by the stored
+# response, so the check for a response and taking the lock are one SET NX: a
+# retry can never take the lock after the first request has finished.
+SAVE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class RedisStore:
+    def get(self, scope):
+        record = get_redis().get(RECORD_KEY.format(scope=scope))
+        return json.loads(record) if record else None
+
+    def acquire(self, scope, fingerprint):
+        # The marker itself is the lock token; it is unique per request.
+        marker = json.dumps({'fingerprint': fingerprint, 'status': None, 'lock': uuid.uuid4().hex})
+        locked = get_redis().set(RECORD_KEY.format(scope=scope), marker, nx=True, ex=int(LOCK_TTL.total_seconds()))
+        return marker if locked else None
+
+    def save(self, scope, token, fingerprint, status_code, body):
+        record = json.dumps({'fingerprint': fingerprint, 'status': status_code, 'body': body})
+        get_script(SAVE_SCRIPT)(
+            keys=[RECORD_KEY.format(scope=scope)], args=[token, record, int(RESPONSE_TTL.total_seconds())]
+        )
+
+    def release(self, scope, token):
+        get_script(RELEASE_SCRIPT)(keys=[RECORD_KEY.format(scope=scope)], args=[token])
+
+
+class DatabaseStore:
+    # Used while Redis is unreachable. The row is the lock: the unique
+    # (user, key) constraint lets only one request insert it, and it carries
+    # the response once that request is done.
+    def __init__(self, user):
+        self.user = user
+
+    def get(self, scope):
+        now = timezone.now()
+        row = IdempotencyKey.objects.filter(user=self.user, key=scope).first()
+        if row is None:
+            return None
+        if row.expires_at <= now or (row.status_code is None and row.created_at <= now - LOCK_TTL):
+            IdempotencyKey.objects.filter(pk=row.pk).delete()
+            return None
+        record = {'fingerprint': row.fingerprint, 'status': row.status_code}
+        if row.status_code is not None:
+            record['body'] = row.response_body
+        return record
+
+    def acquire(self, scope, fingerprint):
+        try:
+            with transaction.atomic():
+                row = IdempotencyKey.objects.create(
+                    user=self.user, key=scope, fingerprint=fingerprint, expires_at=timezone.now() + RESPONSE_TTL
+                )
+        except IntegrityError:
+            return None
+        return row.pk
+
+    def save(self, scope, token, fingerprint, status_code, body):
+        IdempotencyKey.objects.filter(pk=token).update(
+            status_code=status_code, response_body=body, expires_at=timezone.now() + RESPONSE_TTL
+        )
+
+    def release(self, scope, token):
+        IdempotencyKey.objects.filter(pk=token, status_code__isnull=True).delete()
+
+
+def _scope(request, key):
+    # Keys are per user and per endpoint, so one client's key can never
+    # replay another client's response.
+    return hashlib.sha256(f'{request.user.pk}:{request.method}:{request.path}:{key}'.encode()).hexdigest()
+
+
+def _fingerprint(request):
+    body = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(f'{request.method}:{request.path}:{body}'.encode()).hexdigest()
+
+
+def _replay(record):
+    body = json.loads(record['body']) if record['body'] else None
+    response = Response(body, status=record['status'])
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def _error(detail, status_code):
+    return Response({"detail": detail}, status=status_code)
+
+
+def _acquire(store, scope, fingerprint):
+    # Returns (response, None) when the request must not run (a replay or a
+    # conflict) and (None, lock token) when it should.
+    deadline = time.monotonic() + LOCK_WAIT
+    while True:
+        record = store.get(scope)
+        if record is not None:
+            if record['fingerprint'] != fingerprint:
+                return _error(f"{HEADER} was already used for a different request.", status.HTTP_422_UNPROCESSABLE_ENTITY), None
+            if record['status'] is not None:
+                return _replay(record), None
+        token = store.acquire(scope, fingerprint)
+        if token is not None:
+            return None, token
+        if time.monotonic() >= deadline:
+            return _error(f"A request with this {HEADER} is still being processed.", status.HTTP_409_CONFLICT), None
+        time.sleep(POLL_INTERVAL)
+
+
+def _execute(store, scope, fingerprint, token, execute, store_if):
+    try:
+        response = execute()
+        # Server errors are not stored, so a retry runs the request again.
+        if response.status_code < 500 and store_if(response):
+            try:
+                body = json.dumps(response.data, cls=JSONEncoder) if response.data is not None else ''
+                store.save(scope, token, fingerprint, response.status_code, body)
+            except Exception as e:
+                logger.error(f"Error storing idempotent response: {str(e)}")
+        return response
+    finally:
+        try:
+            store.release(scope, token)
+        except Exception as e:
+            logger.error(f"Error releasing idempotency lock: {str(e)}")
+
+
+def idempotent(view=None, *, store_if=lambda response: True):
+    # For POST handlers of authenticated views, function or method. Without an
+    # Idempotency-Key header the request runs as usual; with one, the first
+    # response is stored and retries get it back instead of running again.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            request = next(arg for arg in args if isinstance(arg, Request))
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error(f"{HEADER} must be at most {MAX_KEY_LENGTH} characters.", status.HTTP_400_BAD_REQUEST)
+
+            scope = _scope(request, key)
+            fingerprint = _fingerprint(request)
+            store = RedisStore()
+            try:
+                response, token = _acquire(store, scope, fingerprint)
+            except RedisError as e:
+                logger.warning(f"Redis unavailable for idempotency keys, using the database: {str(e)}")
+                store = DatabaseStore(request.user)
+                response, token = _acquire(store, scope, fingerprint)
+            if response is not None:
+                return response
+            return _execute(store, scope, fingerprint, token, lambda: view(*args, **kwargs), store_if)
+        return wrapper
+
+    return decorator(view) if view is not None else decorator
+
+
+def purge_expired_keys(batch_size=1000):
+    deleted = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.utils.crypto import get_random_string
+from product_app.models import Category, Product
+from order_app.stock import allocate_order_stock
+
+
+class Command(BaseCommand):
+    help = 'Run parallel checkouts against one SKU and check that stock never oversells.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=200)
+        parser.add_argument('--stock', type=int, default=50)
+        parser.add_argument('--quantity', type=int, default=1)
+        parser.add_argument('--workers', type=int, default=100)
+        parser.add_argument('--naive', action='store_true',
+                            help='Use the old read-check-save path instead of the conditional UPDATE, for comparison.')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            raise CommandError('SQLite serializes every writer; run this against the MySQL database.')
+
+        suffix = get_random_string(8).lower()
+        category = Category.objects.create(name=f'Checkout benchmark {suffix}', slugname=f'checkout-benchmark-{suffix}')
+        product = Product.objects.create(
+            name=f'Checkout benchmark {suffix}', price=1000, stock=options['stock'], category=category
+        )
+        quantity = options['quantity']
+        checkout = self.naive_checkout if options['naive'] else self.checkout
+        barrier = threading.Barrier(min(options['workers'], options['checkouts']))
+
+        def run(_):
+            try:
+                try:
+                    barrier.wait(timeout=10)
+                except threading.BrokenBarrierError:
+                    pass
+                start = time.perf_counter()
+                sold = checkout(product.id, quantity)
+                return sold, (time.perf_counter() - start) * 1000
+            finally:
+                connections.close_all()
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                results = list(executor.map(run, range(options['checkouts'])))
+            elapsed = time.perf_counter() - start
+
+            product.refresh_from_db()
+            sold = sum(quantity for succeeded, _ in results if succeeded)
+            latencies = sorted(latency for _, latency in results)
+            self.stdout.write(
+                f'{options["checkouts"]} checkouts in {elapsed:.2f}s, '
+                f'p50 {latencies[len(latencies) // 2]:.1f}ms, max {latencies[-1]:.1f}ms'
+            )
+            self.stdout.write(f'sold {sold} of {options["stock"]}, stock left {product.stock}')
+            if product.stock < 0 or sold + product.stock != options['stock']:
+                raise CommandError(f'Oversold: {sold} units sold from {options["stock"]}, stock is now {product.stock}.')
+            self.stdout.write(self.style.SUCCESS('No oversell.'))
+        finally:
+            product.delete()
+            category.delete()
+
+    def checkout(self, product_id, quantity):
+        # The stock step of OrderSerializer.create, as checkout runs it.
+        with transaction.atomic():
+            return allocate_order_stock([(product_id, quantity)])[0]
+
+    def naive_checkout(self, product_id, quantity):
+        with transaction.atomic():
+            product = Product.objects.get(pk=product_id)
+            if product.stock < quantity:
+                return False
+            product.stock -= quantity
+            product.save(update_fields=['stock'])
+            return True
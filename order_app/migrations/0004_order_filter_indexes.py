@@ -0,0 +1,40 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order_app', '0003_alter_preorderqueue_reservation_status'),
+        ('product_app', '0004_product_filter_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(fields=['cart', 'product', 'is_preordered'], name='cartitem_cart_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'delivery_status', 'order_date'], name='order_user_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'order_date', 'id'], name='order_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['order_date', 'id'], name='order_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='preorderqueue',
+            index=models.Index(fields=['product', 'reservation_status', 'position'], name='preorder_product_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='preorderqueue',
+            index=models.Index(fields=['reservation_status', 'reservation_expires_at'], name='preorder_status_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order_app', '0005_order_updated_at'),
+        ('product_app', '0010_product_view_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('expires_at', models.DateTimeField()),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='order_app.cart')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='product_app.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='stockhold_expiry_idx')],
+                'unique_together': {('cart', 'product')},
+            },
+        ),
+    ]
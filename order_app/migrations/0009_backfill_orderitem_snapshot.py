@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:58
+
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 1000
+
+# Kept here rather than imported from order_app.utils, which works on the live
+# models; this migration sees the historical ones.
+SNAPSHOT_FIELDS = (
+    'id', 'name', 'slugname', 'brand', 'price', 'discount_percentage', 'promotion_percentage',
+    'price_after_discount', 'pre_order_price', 'category_id', 'subcategory_id',
+)
+
+
+def backfill_snapshots(apps, schema_editor):
+    # Orders placed before snapshots existed get the catalog's values as of
+    # this migration, the closest record there is of what was sold. Each chunk
+    # commits on its own so a large table does not sit in one transaction.
+    OrderItem = apps.get_model('order_app', 'OrderItem')
+    Product = apps.get_model('product_app', 'Product')
+
+    last_id = 0
+    while True:
+        items = list(OrderItem.objects.filter(id__gt=last_id, product_snapshot={}).order_by('id')[:CHUNK_SIZE])
+        if not items:
+            break
+        last_id = items[-1].id
+        products = Product.objects.in_bulk({item.product_id for item in items})
+        for item in items:
+            product = products[item.product_id]
+            item.unit_price = (product.pre_order_price if item.is_preordered else product.price_after_discount) or 0
+            if not item.total_amount:
+                item.total_amount = item.unit_price * item.quantity
+            item.product_snapshot = {field: getattr(product, field) for field in SNAPSHOT_FIELDS}
+            item.product_snapshot['thumbnail'] = product.thumbnail.name or None
+        with transaction.atomic():
+            OrderItem.objects.bulk_update(items, ['unit_price', 'total_amount', 'product_snapshot'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('order_app', '0008_orderitem_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order_app', '0011_outbox_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cancelled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
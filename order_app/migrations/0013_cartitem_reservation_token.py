@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order_app', '0012_order_cancelled_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='reservation_token',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -1,8 +1,11 @@
 from django.db import models
 from user_app.models import User
 from product_app.models import Product
+from product_app.leaderboard import record_sales
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
+from functools import partial
 
 class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -20,8 +23,30 @@ class Order(models.Model):
     total_price = models.PositiveIntegerField(default=0)
     order_date = models.DateTimeField(auto_now_add=True)
     shipped_at = models.DateTimeField(null=True, blank=True)
+    cancelled_at = models.DateTimeField(null=True, blank=True)
     products = models.ManyToManyField(Product, through='OrderItem')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'delivery_status', 'order_date'], name='order_user_status_date_idx'),
+            models.Index(fields=['user', 'order_date', 'id'], name='order_user_date_idx'),
+            models.Index(fields=['order_date', 'id'], name='order_date_id_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What the order added to the owner's total_spent as loaded, so a save
+        # can apply the difference instead of summing every order again.
+        if not {'total_price', 'delivery_status'} & instance.get_deferred_fields():
+            instance._counted_total = instance.counted_total
+        return instance
+
+    @property
+    def counted_total(self):
+        return 0 if self.delivery_status == 'cancelled' else self.total_price
 
     def save(self, *args, **kwargs):
         if not self.delivery_address and self.user.address:
@@ -29,13 +54,31 @@ class Order(models.Model):
         super().save(*args, **kwargs)
 
     def cancel_order(self):
-        for item in self.order_items.all():
-            product = item.product
-            product.stock += item.quantity
-            product.save()
-
-        self.delivery_status = 'cancelled'
-        self.save()
+        from .flash_sale import release_units
+        from .stock import return_stock
+
+        with transaction.atomic():
+            # Locking the order first means two concurrent cancels cannot both
+            # put the stock back.
+            current = Order.objects.select_for_update().filter(pk=self.pk).values_list('delivery_status', flat=True).first()
+            if current == 'cancelled':
+                self.delivery_status = current
+                return
+
+            returned = []
+            for item in self.order_items.select_related('product'):
+                # Pre-ordered units never came out of stock. A running flash
+                # sale gets its units back in Redis once this commits.
+                if item.product.flash_sale and not item.is_preordered:
+                    transaction.on_commit(partial(release_units, item.product_id, item.quantity))
+                elif not item.is_preordered:
+                    return_stock(item.product_id, item.quantity)
+                returned.append((item.product_id, item.product.category_id, item.quantity))
+
+            self.delivery_status = 'cancelled'
+            self.cancelled_at = timezone.now()
+            self.save()
+            transaction.on_commit(lambda: record_sales(returned, when=self.order_date, sign=-1, at=self.cancelled_at))
 
 
 class OrderItem(models.Model):
@@ -43,6 +86,10 @@ class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     is_preordered = models.BooleanField(default=False)
+    # The product as it was sold; order history is rendered from these and
+    # never from the live catalog.
+    unit_price = models.PositiveIntegerField(default=0)
+    product_snapshot = models.JSONField(default=dict, blank=True)
     total_amount = models.PositiveIntegerField(default=0)  
     paid_amount = models.PositiveIntegerField(default=0) 
 
@@ -62,6 +109,75 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField(default=0)
     is_preordered = models.BooleanField(default=False)
     price = models.PositiveIntegerField(default=0)
+    # The flash-sale reservation this line redeems at checkout.
+    reservation_token = models.CharField(max_length=32, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cart', 'product', 'is_preordered'], name='cartitem_cart_product_idx'),
+        ]
+
+
+class StockHold(models.Model):
+    # Stock set aside for a cart. The units are taken out of Product.stock when
+    # the hold is made and go back if it expires before checkout.
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='stock_holds')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField(default=0)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('cart', 'product')
+        indexes = [
+            models.Index(fields=['expires_at'], name='stockhold_expiry_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    # Database copy of the Idempotency-Key store, used while Redis is down.
+    # key is a digest of the user, endpoint and client key; status_code stays
+    # empty while the first request is still running.
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'key')
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expiry_idx'),
+        ]
+
+
+class OutboxMessage(models.Model):
+    # A side effect recorded in the transaction that caused it and carried
+    # out later by order_app.outbox.drain.
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    dedup_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(
+        max_length=10,
+        choices=[
+            ('pending', 'Pending'),
+            ('processing', 'Processing'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed')
+        ],
+        default='pending'
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='outbox_status_due_idx'),
+        ]
 
 
 class Wishlist(models.Model):
@@ -105,6 +221,11 @@ class PreOrderQueue(models.Model):
     class Meta:
         unique_together = ('user', 'product')
         ordering = ['position']
+        indexes = [
+            models.Index(fields=['product', 'reservation_status', 'position'], name='preorder_product_status_idx'),
+            # Equality column first so the expiry range scan stays inside one status.
+            models.Index(fields=['reservation_status', 'reservation_expires_at'], name='preorder_status_expiry_idx'),
+        ]
 
     def __str__(self):
         return f"User {self.user.id} in queue for Product {self.product.id} at position {self.position}"
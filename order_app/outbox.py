@@ -0,0 +1,131 @@
+import json
+import logging
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+# Side effects of a write are recorded as rows in the same transaction and
+# carried out afterwards by drain(), so a rollback takes them back with it and
+# a slow or failing provider never holds up the request that caused them.
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+RETRY_BASE = timedelta(seconds=30)
+RETRY_CAP = timedelta(hours=1)
+# How long a claimed batch belongs to its worker; well above a batch of
+# handlers that each wait on a provider timeout.
+LEASE = timedelta(minutes=30)
+
+HANDLERS = {}
+
+
+class RetryLater(Exception):
+    pass
+
+
+def handler(topic):
+    def register(func):
+        HANDLERS[topic] = func
+        return func
+    return register
+
+
+def enqueue(topic, payload, dedup_key=None):
+    # A message with a dedup_key that was already enqueued is dropped.
+    OutboxMessage.objects.bulk_create(
+        [OutboxMessage(topic=topic, payload=payload, dedup_key=dedup_key)],
+        ignore_conflicts=dedup_key is not None,
+    )
+    _kick_on_commit()
+
+
+def _kick_on_commit():
+    # The beat schedule picks up anything a lost kick leaves behind.
+    from .tasks import drain_outbox
+    transaction.on_commit(drain_outbox.delay, robust=True)
+
+
+def _retry_delay(attempts):
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_CAP)
+
+
+def _claim(batch_size, now):
+    # Leases a batch in a short transaction of its own: the rows are moved to
+    # processing until now + LEASE and committed before any handler runs.
+    # skip_locked lets several workers claim side by side; a worker that dies
+    # leaves its rows to be claimed again once the lease runs out.
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(status__in=('pending', 'processing'), available_at__lte=now).order_by('id')[:batch_size]
+        )
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            status='processing', available_at=now + LEASE, attempts=F('attempts') + 1
+        )
+    for message in messages:
+        message.attempts += 1
+    return messages
+
+
+def _record(message, error, now):
+    if error is None:
+        changes = {'status': 'sent', 'processed_at': now}
+    elif message.attempts >= MAX_ATTEMPTS:
+        changes = {'status': 'failed', 'last_error': error}
+        logger.error(f"Outbox message {message.id} ({message.topic}) failed for good: {error}")
+    else:
+        changes = {'status': 'pending', 'available_at': now + _retry_delay(message.attempts), 'last_error': error}
+    OutboxMessage.objects.filter(pk=message.pk, status='processing').update(**changes)
+
+
+def drain(batch_size=BATCH_SIZE, now=None):
+    # Handlers run outside the claiming transaction, each outcome is written
+    # as soon as it is known, so a crash mid-batch repeats at most the message
+    # that was in flight. Messages with the same topic and payload in a batch
+    # are handled once.
+    now = now or timezone.now()
+    messages = _claim(batch_size, now)
+    done = {}
+    for message in messages:
+        signature = (message.topic, json.dumps(message.payload, sort_keys=True))
+        if signature not in done:
+            done[signature] = _handle(message)
+        _record(message, done[signature], now)
+    return len(messages)
+
+
+def _handle(message):
+    func = HANDLERS.get(message.topic)
+    if func is None:
+        return f'no handler for {message.topic}'
+    try:
+        with transaction.atomic():
+            func(**message.payload)
+    except Exception as e:
+        logger.warning(f"Outbox message {message.id} ({message.topic}) will be retried: {str(e)}")
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def drain_all(batch_size=BATCH_SIZE):
+    drained = 0
+    while True:
+        count = drain(batch_size)
+        drained += count
+        if count < batch_size:
+            return drained
+
+
+def purge_sent(older_than=timedelta(days=7), batch_size=1000):
+    cutoff = timezone.now() - older_than
+    deleted = 0
+    while True:
+        ids = list(
+            OutboxMessage.objects.filter(status='sent', processed_at__lt=cutoff).values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += OutboxMessage.objects.filter(id__in=ids).delete()[0]
@@ -5,12 +5,25 @@ from datetime import timedelta
 from celery import shared_task
 from .utils import notify_user 
 from django.db import models
+from SilverShop.redis_client import get_redis
+
+QUEUE_POSITION_KEY = 'preorder:position:{product_id}'
+
+
+def next_queue_position(product_id):
+    # Every queue position comes from this Redis counter, seeded once from the
+    # highest position on record, so concurrent joins never share a number.
+    connection = get_redis()
+    key = QUEUE_POSITION_KEY.format(product_id=product_id)
+    if not connection.exists(key):
+        last = PreOrderQueue.objects.filter(product_id=product_id).aggregate(last=models.Max('position'))['last'] or 0
+        connection.set(key, last, nx=True)
+    return connection.incr(key)
 
 
 @shared_task
 def create_queue(user, product):
-    # Get the current position in the queue
-    position = PreOrderQueue.objects.filter(product=product).count() + 1
+    position = next_queue_position(product.id)
 
     # Calculate reservation expiration time
     reservation_expires_at = timezone.now() + timedelta(hours=4)
@@ -28,16 +41,19 @@ def create_queue(user, product):
     notify_user(user.phone_number, message)
 
 
+def expired_reservations(now):
+    return PreOrderQueue.objects.filter(
+        reservation_expires_at__lt=now, reservation_status="waiting"
+    )
+
+
 @shared_task
 def check_reservations():
     now = timezone.now()
-    expired_reservations = PreOrderQueue.objects.filter(
-        reservation_expires_at__lt=now, reservation_status="waiting"
-    )
     
-    for reservation in expired_reservations:
+    for reservation in expired_reservations(now):
         # Move the user to the end of the queue
-        reservation.position = PreOrderQueue.objects.filter(product=reservation.product).count() + 1
+        reservation.position = next_queue_position(reservation.product_id)
         reservation.save()
 
 
@@ -1,31 +1,25 @@
 from rest_framework import serializers
 from .models import Order,CartItem,Cart,OrderItem,Wishlist, WishlistItem
-from product_app.serializers import ProductSerializer
+from product_app.serializers import ProductListSerializer
 from product_app.models import Product
+from product_app.leaderboard import record_sales
 from django.db import transaction
+from django.db.models import prefetch_related_objects
+from .stock import allocate_order_stock
+from .utils import product_snapshot, snapshot_detail
 
 class OrderItemSerializer(serializers.ModelSerializer):
     product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all()) 
-    product_detail = ProductSerializer(read_only=True)
+    product_detail = serializers.SerializerMethodField()
     is_preordered = serializers.BooleanField(default=False, read_only=True)
+    unit_price = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = OrderItem
-        fields = ['product', 'quantity', 'product_detail', 'is_preordered']
+        fields = ['product', 'quantity', 'product_detail', 'is_preordered', 'unit_price']
 
-    def create(self, validated_data):
-        product = validated_data.pop('product')
-        quantity = validated_data.pop('quantity')
-        is_preordered = (product.stock < quantity) and product.pre_order_available
-        
-        order_item = OrderItem.objects.create(
-            product=product,
-            quantity=quantity,
-            is_preordered=is_preordered,
-            **validated_data
-        )
-        order_item.product_detail = ProductSerializer(product).data
-        return order_item
+    def get_product_detail(self, obj):
+        return snapshot_detail(obj.product_snapshot, self.context.get('request'))
 
 class OrderSerializer(serializers.ModelSerializer):
     order_items = OrderItemSerializer(many=True, required=False)
@@ -46,19 +40,40 @@ class OrderSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         order_items_data = validated_data.pop('order_items', [])
+        cart = validated_data.pop('cart', None)
         with transaction.atomic():
-            order = Order.objects.create(**validated_data)
+            # Stock for every line is decided in one locked pass; flash-sale
+            # lines arrive already claimed in Redis.
+            lines = [(item['product'].id, item['quantity']) for item in order_items_data if item.get('reserved') is None]
+            allocated = iter(allocate_order_stock(lines, cart=cart))
+
             total_price = 0
+            order_items = []
+            sold = []
             for item_data in order_items_data:
                 product = item_data['product']
                 quantity = item_data['quantity']
-                is_preordered = (product.stock < quantity) and product.pre_order_available
-                OrderItem.objects.create(order=order, product=product, quantity=quantity, is_preordered=is_preordered)
+                reserved = item_data.get('reserved')
+                if reserved is None:
+                    reserved = next(allocated)
+                is_preordered = not reserved
+                if is_preordered and not product.pre_order_available:
+                    raise serializers.ValidationError(f"Not enough stock for {product.name}, and pre-order is not available.")
                 price = product.pre_order_price if is_preordered else product.price_after_discount
                 total_price += price * quantity
-
-            order.total_price = total_price
-            order.save()
+                order_items.append(OrderItem(
+                    product=product, quantity=quantity, is_preordered=is_preordered, unit_price=price,
+                    total_amount=price * quantity, product_snapshot=product_snapshot(product),
+                ))
+                sold.append((product.id, product.category_id, quantity))
+
+            order = Order.objects.create(total_price=total_price, **validated_data)
+            for order_item in order_items:
+                order_item.order = order
+            OrderItem.objects.bulk_create(order_items)
+            # The response renders the items: one read, whatever their number.
+            prefetch_related_objects([order], 'order_items')
+            transaction.on_commit(lambda: record_sales(sold, when=order.order_date))
 
         return order
 
@@ -68,14 +83,10 @@ class OrderSerializer(serializers.ModelSerializer):
         preorder_items = []
         regular_items = []
 
-        for item in instance.order_items.all():
-            item_data = {
-                'product': item.product.id,
-                'quantity': item.quantity,
-                'product_detail': ProductSerializer(item.product).data,
-                'is_preordered': item.is_preordered
-            }
-            if item.is_preordered:
+        # order_items is already rendered from the snapshots; split it
+        # rather than serializing every item a second time.
+        for item_data in representation['order_items']:
+            if item_data['is_preordered']:
                 preorder_items.append(item_data)
             else:
                 regular_items.append(item_data)
@@ -86,7 +97,7 @@ class OrderSerializer(serializers.ModelSerializer):
 
 
 class CartItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
+    product = ProductListSerializer(read_only=True)
     price = serializers.SerializerMethodField()
 
     class Meta:
@@ -122,7 +133,7 @@ class CartSerializer(serializers.ModelSerializer):
             item_data = {
                 'product': item.product.id,
                 'quantity': item.quantity,
-                'product_detail': ProductSerializer(item.product).data,
+                'product_detail': ProductListSerializer(item.product, context=self.context).data,
                 'is_preordered': item.is_preordered
             }
             if item.is_preordered:
@@ -139,7 +150,7 @@ class CartSerializer(serializers.ModelSerializer):
 
 
 class WishlistItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)  
+    product = ProductListSerializer(read_only=True)  
 
     class Meta:
         model = WishlistItem
@@ -1,19 +1,55 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from .models import Order
+from .models import Order, Cart
 from product_app.utils import send_sms
 from django.conf import settings
-from django.db.models import Sum
+from . import outbox
+from .spending import add_total_spent, recompute_total_spent
 @receiver(post_save, sender=Order)
 def send_order_notification(sender, instance, created, **kwargs):
+    # Recorded in the checkout transaction and sent by the outbox worker, so
+    # the SMS provider is never on the checkout path.
     if created:
-        owner_phone_number = settings.OWNER_PHONE_NUMBER
-        message = f"New order submitted! Order ID: {instance.id}, Total Price: {instance.total_price}"
-        send_sms(owner_phone_number, message)
+        outbox.enqueue('order.created', {'order_id': instance.id}, dedup_key=f'order.created:{instance.id}')
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_stock(sender, instance, **kwargs):
+    # The cascade would drop the holds without putting their stock back.
+    from .stock import release_cart_holds
+    release_cart_holds(instance)
 
 @receiver(post_save, sender=Order)
-def update_total_spent(sender, instance, created, **kwargs):
-    user = instance.user
-    total_spent = Order.objects.filter(user=user).aggregate(total=Sum('total_price'))['total'] or 0
-    user.total_spent = total_spent
-    user.save()
\ No newline at end of file
+def update_total_spent(sender, instance, created, update_fields=None, **kwargs):
+    # Status changes, shipping dates and the like leave the total alone and
+    # cost nothing here.
+    if update_fields is not None and not {'total_price', 'delivery_status'} & set(update_fields):
+        return
+    previous = 0 if created else getattr(instance, '_counted_total', None)
+    instance._counted_total = instance.counted_total
+    if previous is None:
+        # Nothing to diff against (deferred fields, an instance not loaded
+        # from the database): recount this user's orders after commit.
+        outbox.enqueue('user.total_spent', {'user_id': instance.user_id})
+    elif instance.counted_total != previous:
+        add_total_spent(instance.user_id, instance.counted_total - previous)
+
+@receiver(post_delete, sender=Order)
+def remove_from_total_spent(sender, instance, **kwargs):
+    previous = getattr(instance, '_counted_total', None)
+    if previous is None:
+        outbox.enqueue('user.total_spent', {'user_id': instance.user_id})
+    elif previous:
+        add_total_spent(instance.user_id, -previous)
+
+@outbox.handler('order.created')
+def notify_owner_of_order(order_id):
+    order = Order.objects.filter(pk=order_id).values('id', 'total_price').first()
+    if order is None:
+        return
+    message = f"New order submitted! Order ID: {order['id']}, Total Price: {order['total_price']}"
+    if send_sms(settings.OWNER_PHONE_NUMBER, message) is None:
+        raise outbox.RetryLater(f"SMS for order {order_id} was not accepted")
+
+@outbox.handler('user.total_spent')
+def recount_total_spent(user_id):
+    recompute_total_spent(user_id)
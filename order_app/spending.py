@@ -0,0 +1,65 @@
+import logging
+from django.db import transaction
+from django.db.models import Case, F, Sum, Value, When
+from user_app.models import User
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+# User.total_spent is the sum of the user's orders that are not cancelled. Order
+# saves move it by the difference they make; reconcile_total_spent puts right
+# whatever slips past that (queryset updates, raw SQL, stale instances).
+RECONCILE_BATCH = 1000
+
+
+def spent_orders():
+    return Order.objects.exclude(delivery_status='cancelled')
+
+
+def add_total_spent(user_id, delta):
+    if delta >= 0:
+        total_spent = F('total_spent') + delta
+    else:
+        # The column is unsigned, so never let the expression go below zero.
+        total_spent = Case(When(total_spent__gt=abs(delta), then=F('total_spent') - abs(delta)), default=Value(0))
+    User.objects.filter(pk=user_id).update(total_spent=total_spent)
+
+
+def recompute_total_spent(user_id):
+    total_spent = spent_orders().filter(user_id=user_id).aggregate(total=Sum('total_price'))['total'] or 0
+    User.objects.filter(pk=user_id).update(total_spent=total_spent)
+
+
+def reconcile_total_spent(batch_size=RECONCILE_BATCH):
+    # One grouped query per chunk of users. The chunk's rows stay locked while
+    # they are compared and fixed, so a delta landing meanwhile waits for the
+    # corrected value instead of being overwritten by it.
+    last_id = 0
+    checked = drifted = 0
+    while True:
+        with transaction.atomic():
+            users = list(
+                User.objects.select_for_update().filter(id__gt=last_id).order_by('id').only('id', 'total_spent')[:batch_size]
+            )
+            if not users:
+                break
+            last_id = users[-1].id
+            totals = dict(
+                spent_orders().filter(user_id__in=[user.id for user in users]).order_by()
+                .values('user_id').annotate(total=Sum('total_price')).values_list('user_id', 'total')
+            )
+            stale = []
+            for user in users:
+                expected = totals.get(user.id) or 0
+                if user.total_spent != expected:
+                    logger.warning(
+                        f"total_spent of user {user.id} drifted by {user.total_spent - expected}: "
+                        f"{user.total_spent} stored, {expected} from orders"
+                    )
+                    user.total_spent = expected
+                    stale.append(user)
+            User.objects.bulk_update(stale, ['total_spent'])
+        checked += len(users)
+        drifted += len(stale)
+    logger.info(f"Reconciled total_spent of {checked} users, {drifted} had drifted")
+    return drifted
@@ -0,0 +1,198 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+from product_app.models import Product
+from product_app.cache import invalidate_on_commit, invalidate_product_details, invalidate_products
+from .models import StockHold
+
+# How long stock put in a cart stays set aside for it.
+HOLD_TTL = timedelta(seconds=getattr(settings, 'CART_HOLD_SECONDS', 15 * 60))
+
+
+def take_stock(product_id, quantity):
+    # UPDATE ... SET stock = stock - q WHERE id = ? AND stock > q. The check
+    # and the decrement happen under the row lock of a single statement, so
+    # concurrent checkouts can never drive stock below zero. Taking the last
+    # units is a second statement: only a sell-out changes what the cached
+    # product lists show, everything else just refreshes the detail.
+    if quantity <= 0:
+        return True
+    now = timezone.now()
+    products = Product.objects.filter(pk=product_id)
+    if products.filter(stock__gt=quantity).update(stock=F('stock') - quantity, updated_at=now):
+        invalidate_on_commit(invalidate_product_details, [product_id])
+        return True
+    if products.filter(stock=quantity).update(stock=0, updated_at=now):
+        invalidate_on_commit(invalidate_products, [product_id])
+        return True
+    return False
+
+
+def take_available_stock(product_id, quantity, attempts=3):
+    # Takes as much of quantity as is on hand and returns how much that was.
+    for _ in range(attempts):
+        if take_stock(product_id, quantity):
+            return quantity
+        available = Product.objects.filter(pk=product_id).values_list('stock', flat=True).first() or 0
+        quantity = min(quantity, available)
+        if quantity <= 0:
+            return 0
+    return 0
+
+
+def return_stock(product_id, quantity):
+    # F() restore. The first, conditional statement only matches a product
+    # that was sold out, which is when wishlists have to hear about it.
+    if quantity <= 0:
+        return
+    from product_app.tasks import notify_back_in_stock
+
+    now = timezone.now()
+    restocked = Product.objects.filter(pk=product_id, stock__lte=0).update(stock=F('stock') + quantity, updated_at=now)
+    if restocked:
+        invalidate_on_commit(invalidate_products, [product_id])
+        transaction.on_commit(lambda: notify_back_in_stock.delay([product_id]), robust=True)
+    else:
+        Product.objects.filter(pk=product_id).update(stock=F('stock') + quantity, updated_at=now)
+        invalidate_on_commit(invalidate_product_details, [product_id])
+
+
+def _locked_hold(cart, product_id):
+    return StockHold.objects.select_for_update().filter(cart=cart, product_id=product_id).first()
+
+
+def _save_hold(hold, cart, product_id, quantity):
+    if quantity <= 0:
+        if hold is not None:
+            hold.delete()
+        return
+    if hold is None:
+        hold = StockHold(cart=cart, product_id=product_id)
+    hold.quantity = quantity
+    hold.expires_at = timezone.now() + HOLD_TTL
+    hold.save()
+
+
+def hold_stock(cart, product_id, quantity):
+    # Sets aside up to quantity more units for a cart; returns how many it got.
+    hold = _locked_hold(cart, product_id)
+    taken = take_available_stock(product_id, quantity)
+    _save_hold(hold, cart, product_id, (hold.quantity if hold else 0) + taken)
+    return taken
+
+
+def set_hold(cart, product_id, quantity):
+    # Moves a cart's hold to exactly quantity units. Returns False, leaving the
+    # hold as it was, when the extra units are not in stock.
+    hold = _locked_hold(cart, product_id)
+    held = hold.quantity if hold else 0
+    if quantity > held and not take_stock(product_id, quantity - held):
+        return False
+    return_stock(product_id, held - quantity)
+    _save_hold(hold, cart, product_id, quantity)
+    return True
+
+
+def shrink_hold(cart, product_id, quantity):
+    # Like set_hold, but never takes stock: a cart that shrinks after its hold
+    # expired just keeps no hold.
+    hold = _locked_hold(cart, product_id)
+    if hold is not None and hold.quantity > quantity:
+        return_stock(product_id, hold.quantity - quantity)
+        _save_hold(hold, cart, product_id, quantity)
+
+
+def release_hold(cart, product_id):
+    shrink_hold(cart, product_id, 0)
+
+
+def release_cart_holds(cart):
+    with transaction.atomic():
+        for hold in StockHold.objects.select_for_update().filter(cart=cart):
+            return_stock(hold.product_id, hold.quantity)
+            hold.delete()
+
+
+def release_product_holds(product_id):
+    # Every cart's hold on one product goes back to Product.stock, e.g. when
+    # the product switches to flash-sale mode and carts stop using holds.
+    holds = list(StockHold.objects.select_for_update().filter(product_id=product_id))
+    return_stock(product_id, sum(hold.quantity for hold in holds))
+    StockHold.objects.filter(id__in=[hold.id for hold in holds]).delete()
+
+
+def allocate_order_stock(lines, cart=None):
+    # Secures stock for a whole order, drawing on the cart's holds first. lines
+    # is a list of (product_id, quantity); returns one bool per line, True when
+    # the line was taken from stock. The product rows are locked once, in id order so
+    # two checkouts cannot deadlock, and every change goes out in one UPDATE.
+    from product_app.tasks import notify_back_in_stock
+
+    product_ids = sorted({product_id for product_id, _ in lines})
+    if not product_ids:
+        return []
+    held = {}
+    if cart is not None:
+        held = dict(
+            StockHold.objects.select_for_update()
+            .filter(cart=cart, product_id__in=product_ids).values_list('product_id', 'quantity')
+        )
+    stock = dict(
+        Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('id', 'stock')
+    )
+
+    # Held units are already out of Product.stock.
+    available = {product_id: max(stock.get(product_id, 0), 0) + held.get(product_id, 0) for product_id in product_ids}
+    used = dict.fromkeys(product_ids, 0)
+    allocated = []
+    for product_id, quantity in lines:
+        taken = available[product_id] >= quantity
+        if taken:
+            available[product_id] -= quantity
+            used[product_id] += quantity
+        allocated.append(taken)
+
+    deltas = {
+        product_id: held.get(product_id, 0) - used[product_id]
+        for product_id in product_ids if product_id in stock and held.get(product_id, 0) != used[product_id]
+    }
+    if deltas:
+        Product.objects.filter(pk__in=deltas).update(
+            stock=F('stock') + Case(
+                *[When(pk=product_id, then=Value(delta)) for product_id, delta in deltas.items()],
+                default=Value(0), output_field=IntegerField(),
+            ),
+            updated_at=timezone.now(),
+        )
+        # The lists only change for products that sold out or came back.
+        crossed = any((stock[product_id] > 0) != (stock[product_id] + delta > 0) for product_id, delta in deltas.items())
+        invalidate_on_commit(invalidate_products if crossed else invalidate_product_details, list(deltas))
+    if held:
+        StockHold.objects.filter(cart=cart, product_id__in=held).delete()
+
+    restocked = [product_id for product_id, delta in deltas.items() if delta > 0 and stock[product_id] <= 0]
+    if restocked:
+        transaction.on_commit(lambda: notify_back_in_stock.delay(restocked), robust=True)
+    return allocated
+
+
+def release_expired_holds(now=None, batch_size=500):
+    # Holds locked by a checkout in progress are skipped; that checkout is
+    # about to consume them anyway.
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                StockHold.objects.select_for_update(skip_locked=True)
+                .filter(expires_at__lte=now).order_by('expires_at')[:batch_size]
+            )
+            if not holds:
+                break
+            for hold in holds:
+                return_stock(hold.product_id, hold.quantity)
+            StockHold.objects.filter(id__in=[hold.id for hold in holds]).delete()
+        released += len(holds)
+    return released
@@ -1,11 +1,12 @@
 from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
-from django.db import models, transaction
+from django.db import transaction
 import logging
 from .models import Order
 from .utils import notify_user,reserve_for_first_in_queue
 from order_app.models import PreOrderQueue
+from .queue_management import next_queue_position
 
 logger = logging.getLogger(__name__)
 
@@ -26,11 +27,8 @@ def check_reservation_expiry(queue_item_id):
         if queue_item.reservation_status == 'reserved' and queue_item.reservation_expires_at < timezone.now():
             # Expired - move to the end of the queue
             with transaction.atomic():
-                product_queue = PreOrderQueue.objects.filter(product=queue_item.product)
-                max_position = product_queue.aggregate(max_position=models.Max('position'))['max_position']
-                
                 # Update reservation status and position
-                queue_item.position = max_position + 1
+                queue_item.position = next_queue_position(queue_item.product_id)
                 queue_item.reservation_status = 'expired'
                 queue_item.save()
 
@@ -42,4 +40,51 @@ def check_reservation_expiry(queue_item_id):
     except PreOrderQueue.DoesNotExist:
         logger.warning(f"Queue item with ID {queue_item_id} does not exist.")
     except Exception as e:
-        logger.error(f"Error in check_reservation_expiry for queue item {queue_item_id}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error in check_reservation_expiry for queue item {queue_item_id}: {str(e)}")
+
+@shared_task
+def release_expired_cart_holds():
+    from .stock import release_expired_holds
+
+    released = release_expired_holds()
+    logger.info(f"Returned stock from {released} expired cart holds")
+
+
+@shared_task
+def reconcile_flash_sale_stock():
+    from .flash_sale import reconcile_flash_sales
+
+    written = reconcile_flash_sales()
+    logger.info(f"Wrote flash sale stock back for {written} products")
+
+
+@shared_task
+def purge_idempotency_keys():
+    from .idempotency import purge_expired_keys
+
+    deleted = purge_expired_keys()
+    logger.info(f"Purged {deleted} expired idempotency keys")
+
+
+@shared_task
+def drain_outbox():
+    from .outbox import drain_all
+
+    drained = drain_all()
+    if drained:
+        logger.info(f"Handled {drained} outbox messages")
+
+
+@shared_task
+def purge_outbox():
+    from .outbox import purge_sent
+
+    deleted = purge_sent()
+    logger.info(f"Purged {deleted} sent outbox messages")
+
+
+@shared_task
+def reconcile_total_spent():
+    from .spending import reconcile_total_spent as reconcile
+
+    reconcile()
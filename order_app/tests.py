@@ -1,8 +1,31 @@
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
-from .models import Order, OrderItem, Cart, CartItem
+from .models import Order, OrderItem, Cart, CartItem, PreOrderQueue, StockHold, IdempotencyKey, OutboxMessage
+from .queue_management import check_reservations, expired_reservations
+from .spending import reconcile_total_spent
+from .stock import release_expired_holds, return_stock, take_stock
+from . import flash_sale
+from . import idempotency
+from . import outbox
+from .utils import waiting_queue, product_snapshot
+from .views import OrderViewSet
+from product_app.cache import PRODUCT_LIST_VERSION_KEY, get_version
 from product_app.models import Product, Category
+from SilverShop.testing import QueryPlanMixin, redis_available
+from SilverShop.redis_client import get_redis
+from redis.exceptions import ConnectionError as RedisConnectionError
 from user_app.models import User
 
 class OrderTests(APITestCase):
@@ -121,4 +144,596 @@ class CartTests(APITestCase):
         url = reverse('user-cart', args=[self.user.id])
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['items'][0]['product']['id'], self.product1.id)
\ No newline at end of file
+        self.assertEqual(response.data['items'][0]['product']['id'], self.product1.id)
+
+class OrderQueryPlanTests(QueryPlanMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        other = User.objects.create(phone_number='09222222222')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product 1', slugname='product-1', price=100, stock=0, category=self.category)
+        Order.objects.bulk_create([
+            Order(user=self.user if i % 20 == 0 else other, delivery_address='Somewhere',
+                  delivery_status='pending' if i % 2 else 'delivered')
+            for i in range(200)
+        ])
+        queue_users = [User(phone_number=f'0930000{i:04d}') for i in range(50)]
+        User.objects.bulk_create(queue_users)
+        PreOrderQueue.objects.bulk_create([
+            PreOrderQueue(user=user, product=self.product, position=i + 1, paid_amount=1, total_amount_due=1,
+                          reservation_expires_at=timezone.now() - timedelta(hours=i % 5))
+            for i, user in enumerate(User.objects.filter(phone_number__startswith='0930000'))
+        ])
+
+    def test_order_list_filters_use_index(self):
+        view = self.build_view(OrderViewSet, {'delivery_status': 'pending'}, user=self.user)
+        self.assertUsesIndex(view.get_queryset())
+
+    def test_reservation_expiry_scan_uses_index(self):
+        self.assertUsesIndex(expired_reservations(timezone.now()))
+
+    def test_first_in_queue_uses_index(self):
+        self.assertUsesIndex(waiting_queue(self.product.id))
+
+    def test_cart_item_lookup_uses_index(self):
+        cart = Cart.objects.create(user=self.user)
+        self.assertUsesIndex(CartItem.objects.filter(cart=cart, product=self.product, is_preordered=True))
+
+
+class OrderConditionalGetTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product 1', slugname='product-1', price=100, stock=5, category=self.category)
+        self.order = Order.objects.create(user=self.user, delivery_address='Somewhere')
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=1, product_snapshot=product_snapshot(self.product))
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('order-detail', args=[self.order.id])
+
+    def test_unchanged_order_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_catalog_change_keeps_order_etag(self):
+        # Orders render from their snapshots, so a product edit changes nothing.
+        etag = self.client.get(self.url)['ETag']
+        self.product.name = 'Product 1 (renamed)'
+        self.product.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_order_change_refreshes_order_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.order.delivery_address = 'Elsewhere'
+        self.order.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_nested_products_are_compact(self):
+        response = self.client.get(self.url)
+        detail = response.data['regular_items'][0]['product_detail']
+        self.assertEqual(detail['name'], 'Product 1')
+        self.assertNotIn('description', detail)
+
+
+class StockLedgerTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(
+            name='Product 1', slugname='product-1', price=100, stock=5, category=self.category, pre_order_available=False
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def add_to_cart(self, quantity):
+        return self.client.post(reverse('cart-add-to-cart'), {'product_id': self.product.id, 'quantity': quantity}, format='json')
+
+    def checkout(self):
+        return self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json')
+
+    def stock(self):
+        return Product.objects.values_list('stock', flat=True).get(pk=self.product.pk)
+
+    def test_conditional_decrement_never_oversells(self):
+        self.assertTrue(take_stock(self.product.id, 3))
+        self.assertFalse(take_stock(self.product.id, 3))
+        self.assertEqual(self.stock(), 2)
+
+    def test_cart_holds_stock_until_checkout(self):
+        self.assertEqual(self.add_to_cart(3).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.stock(), 2)
+        self.assertEqual(StockHold.objects.get().quantity, 3)
+
+        self.assertEqual(self.checkout().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.stock(), 2)
+        self.assertFalse(StockHold.objects.exists())
+        self.assertFalse(OrderItem.objects.get().is_preordered)
+
+    def test_stock_beyond_the_shelf_goes_to_preorder(self):
+        Product.objects.filter(pk=self.product.pk).update(pre_order_available=True)
+        self.add_to_cart(7)
+        self.assertEqual(self.stock(), 0)
+        items = dict(CartItem.objects.values_list('is_preordered', 'quantity'))
+        self.assertEqual(items, {False: 5, True: 2})
+
+    def test_expired_hold_returns_stock(self):
+        self.add_to_cart(3)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertEqual(self.stock(), 5)
+
+        # The stock went to someone else meanwhile, so the checkout fails whole.
+        take_stock(self.product.id, 4)
+        self.assertEqual(self.checkout().status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), 1)
+
+    # The checkout's outbox kick runs on commit here; keep its SMS local.
+    @patch('order_app.signals.send_sms', return_value={'status': 200})
+    def test_only_selling_out_or_restocking_touches_the_list_cache(self, send_sms):
+        def list_version():
+            return get_version(PRODUCT_LIST_VERSION_KEY)
+
+        version = list_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_to_cart(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout()
+        self.assertEqual(list_version(), version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            take_stock(self.product.id, 3)
+        self.assertNotEqual(list_version(), version)
+        version = list_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            return_stock(self.product.id, 1)
+        self.assertNotEqual(list_version(), version)
+
+    def test_cancel_returns_stock_once(self):
+        self.add_to_cart(3)
+        order_id = self.checkout().data['id']
+        url = reverse('order-cancel', args=[order_id])
+        self.assertEqual(self.client.post(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(self.client.post(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(), 5)
+
+
+@skipIf(connection.vendor == 'sqlite', 'SQLite serializes writers, so there is no race to check.')
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def test_parallel_checkouts_do_not_oversell(self):
+        call_command('benchmark_checkout', checkouts=200, stock=50, workers=50, stdout=StringIO())
+
+
+@skipUnless(redis_available(), 'Redis is not reachable')
+class FlashSaleTests(APITestCase):
+    def setUp(self):
+        connection = get_redis()
+        for pattern in ('flash:*', 'preorder:*'):
+            for key in connection.scan_iter(match=pattern):
+                connection.delete(key)
+        self.user = User.objects.create(phone_number='09111111111')
+        self.other = User.objects.create(phone_number='09222222222')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(
+            name='Drop', slugname='drop', price=100, stock=2, category=self.category, flash_sale=True
+        )
+
+    def add_to_cart(self, user, quantity=1):
+        self.client.force_authenticate(user=user)
+        return self.client.post(reverse('cart-add-to-cart'), {'product_id': self.product.id, 'quantity': quantity}, format='json')
+
+    def checkout(self, user):
+        self.client.force_authenticate(user=user)
+        return self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json')
+
+    def stock(self):
+        return Product.objects.values_list('stock', flat=True).get(pk=self.product.pk)
+
+    def test_winner_checks_out_without_touching_the_row(self):
+        response = self.add_to_cart(self.user, 2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['reservation_token'])
+
+        self.assertEqual(self.checkout(self.user).status_code, status.HTTP_201_CREATED)
+        self.assertFalse(OrderItem.objects.get().is_preordered)
+        self.assertEqual(self.stock(), 2)
+
+        flash_sale.reconcile_flash_sales()
+        self.assertEqual(self.stock(), 0)
+
+    def test_claim_needs_the_cart_lines_token(self):
+        token = self.add_to_cart(self.user, 2).data['reservation_token']
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).reservation_token, token)
+
+        self.assertEqual(flash_sale.claim(self.product.id, self.user.id, 'not-the-token'), 0)
+        self.assertEqual(flash_sale.claim(self.product.id, self.user.id, token), 2)
+        self.assertEqual(flash_sale.claim(self.product.id, self.user.id, token), 0)
+
+    def test_loser_joins_preorder_queue(self):
+        self.add_to_cart(self.user, 2)
+        response = self.add_to_cart(self.other)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(PreOrderQueue.objects.get(user=self.other).position, response.data['queue_position'])
+
+    def test_queue_positions_are_unique_and_drawn_once(self):
+        third = User.objects.create(phone_number='09333333333')
+        first = flash_sale.join_queue(self.user, self.product)
+        self.assertEqual(flash_sale.join_queue(self.user, self.product).position, first.position)
+        self.assertEqual(flash_sale.join_queue(self.other, self.product).position, first.position + 1)
+
+        # An expired reservation goes to the back through the same counter.
+        PreOrderQueue.objects.filter(pk=first.pk).update(reservation_expires_at=timezone.now() - timedelta(hours=1))
+        check_reservations()
+        self.assertEqual(flash_sale.join_queue(third, self.product).position, first.position + 3)
+        positions = list(PreOrderQueue.objects.values_list('position', flat=True))
+        self.assertEqual(len(positions), len(set(positions)))
+
+    def test_holds_taken_before_the_sale_join_the_counter(self):
+        Product.objects.filter(pk=self.product.pk).update(flash_sale=False)
+        self.add_to_cart(self.user, 2)
+        self.assertEqual(self.stock(), 0)
+
+        Product.objects.filter(pk=self.product.pk).update(flash_sale=True)
+        self.assertEqual(self.add_to_cart(self.other, 2).status_code, status.HTTP_201_CREATED)
+        self.assertFalse(StockHold.objects.exists())
+        flash_sale.reconcile_flash_sales()
+        self.assertEqual(self.stock(), 0)
+
+    def test_expired_reservation_goes_back_to_the_counter(self):
+        self.add_to_cart(self.user, 2)
+        flash_sale.reconcile_flash_sales(now=timezone.now() + flash_sale.RESERVATION_TTL + timedelta(seconds=1))
+        self.assertEqual(self.stock(), 2)
+        self.assertEqual(self.add_to_cart(self.other, 2).status_code, status.HTTP_201_CREATED)
+
+    def test_cancel_returns_units_to_the_sale(self):
+        self.add_to_cart(self.user, 2)
+        order_id = self.checkout(self.user).data['id']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('order-cancel', args=[order_id]))
+        self.assertEqual(self.add_to_cart(self.other, 2).status_code, status.HTTP_201_CREATED)
+
+    def test_switching_the_mode_off_finishes_the_sale(self):
+        self.add_to_cart(self.user, 1)
+        self.add_to_cart(self.other, 1)
+        self.checkout(self.user)
+        Product.objects.filter(pk=self.product.pk).update(flash_sale=False)
+
+        flash_sale.reconcile_flash_sales()
+        self.assertEqual(self.stock(), 1)
+        self.assertFalse(list(get_redis().scan_iter(match='flash:*')))
+
+
+class CheckoutQueryBudgetTests(APITestCase):
+    # Checkout must cost the same number of queries for one line or thirty.
+    QUERY_BUDGET = 16
+
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.products = [
+            Product.objects.create(name=f'Product {i}', slugname=f'product-{i}', price=100, stock=5, category=self.category)
+            for i in range(30)
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def checkout_queries(self, products):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=2) for product in products])
+        # Half the lines come with a cart hold, as they would after add_to_cart.
+        StockHold.objects.bulk_create([
+            StockHold(cart=cart, product=product, quantity=2, expires_at=timezone.now() + timedelta(minutes=5))
+            for product in products[::2]
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['regular_items']), len(products))
+        return len(queries)
+
+    def test_checkout_query_count_does_not_grow_with_the_cart(self):
+        small = self.checkout_queries(self.products[:2])
+        large = self.checkout_queries(self.products[2:])
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+
+    def test_checkout_takes_stock_and_consumes_holds(self):
+        self.checkout_queries(self.products[:4])
+        stock = dict(Product.objects.filter(pk__in=[p.pk for p in self.products[:4]]).values_list('id', 'stock'))
+        # Held lines were already taken out when the hold was made.
+        self.assertEqual(list(stock.values()), [5, 3, 5, 3])
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(Order.objects.get().total_price, 4 * 2 * 100)
+
+
+@skipUnless(redis_available(), 'Redis is not reachable')
+class IdempotencyKeyTests(APITestCase):
+    def setUp(self):
+        connection = get_redis()
+        for key in connection.scan_iter(match='idempotency:*'):
+            connection.delete(key)
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product 1', slugname='product-1', price=100, stock=10, category=self.category)
+        self.client.force_authenticate(user=self.user)
+
+    def add_to_cart(self, key, quantity=2):
+        return self.client.post(
+            reverse('cart-add-to-cart'), {'product_id': self.product.id, 'quantity': quantity},
+            format='json', HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retried_cart_add_runs_once(self):
+        first = self.add_to_cart('retry-1')
+        second = self.add_to_cart('retry-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data['cart']['regular_items'], first.data['cart']['regular_items'])
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+        self.add_to_cart('retry-2')
+        self.assertEqual(CartItem.objects.get().quantity, 4)
+
+    def test_key_reused_for_another_body_is_rejected(self):
+        self.add_to_cart('retry-1')
+        self.assertEqual(self.add_to_cart('retry-1', quantity=3).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_retried_checkout_places_one_order(self):
+        self.add_to_cart('add')
+        url = reverse('order-list')
+        first = self.client.post(url, {'delivery_address': 'Somewhere'}, format='json', HTTP_IDEMPOTENCY_KEY='checkout')
+        second = self.client.post(url, {'delivery_address': 'Somewhere'}, format='json', HTTP_IDEMPOTENCY_KEY='checkout')
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_retry_during_the_first_request_gets_a_conflict(self):
+        # The lock stays with a first request that has not finished.
+        with patch.object(idempotency.RedisStore, 'acquire', return_value=None), patch.object(idempotency, 'LOCK_WAIT', 0):
+            self.assertEqual(self.add_to_cart('retry-1').status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_retry_that_missed_the_stored_response_replays_it(self):
+        # The retry looks before the first request stores its response and
+        # tries the lock after; it must still get the replay.
+        first = self.add_to_cart('retry-1')
+        get = idempotency.RedisStore.get
+        looks = iter([None])
+        with patch.object(idempotency.RedisStore, 'get', lambda store, scope: next(looks, get(store, scope))):
+            second = self.add_to_cart('retry-1')
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data['cart']['regular_items'], first.data['cart']['regular_items'])
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_database_fallback_when_redis_is_down(self):
+        with patch.object(idempotency.RedisStore, 'get', side_effect=RedisConnectionError('down')):
+            self.add_to_cart('retry-1')
+            replayed = self.add_to_cart('retry-1')
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, status.HTTP_201_CREATED)
+
+
+class OrderSnapshotTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.products = [
+            Product.objects.create(name=f'Product {i}', slugname=f'product-{i}', price=100, stock=50, category=self.category)
+            for i in range(5)
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def place_order(self, products):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for product in products])
+        return self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json').data['id']
+
+    def test_order_shows_what_was_paid(self):
+        order_id = self.place_order(self.products[:1])
+        product = self.products[0]
+        product.name = 'Renamed'
+        product.price = 500
+        product.save()
+
+        item = self.client.get(reverse('order-detail', args=[order_id])).data['regular_items'][0]
+        self.assertEqual(item['unit_price'], 100)
+        self.assertEqual(item['product_detail']['name'], 'Product 0')
+        self.assertEqual(item['product_detail']['price_after_discount'], 100)
+
+    def test_order_list_does_not_touch_the_catalog(self):
+        self.place_order(self.products[:1])
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('order-list'))
+        for _ in range(3):
+            self.place_order(self.products)
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(reverse('order-list'))
+        self.assertEqual(len(small), len(large))
+        self.assertFalse([query for query in large if 'product_app_product' in query['sql']])
+
+    def test_backfill_snapshots_existing_items(self):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere')
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=2) for product in self.products])
+        migration = import_module('order_app.migrations.0009_backfill_orderitem_snapshot')
+        with patch.object(migration, 'CHUNK_SIZE', 2):
+            migration.backfill_snapshots(apps, None)
+
+        for item in OrderItem.objects.all():
+            self.assertEqual(item.unit_price, 100)
+            self.assertEqual(item.total_amount, 200)
+            self.assertEqual(item.product_snapshot['name'], item.product.name)
+
+
+class OutboxTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product 1', slugname='product-1', price=100, stock=10, category=self.category)
+        self.client.force_authenticate(user=self.user)
+
+    def place_order(self):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        return self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json')
+
+    @patch('order_app.signals.send_sms')
+    def test_checkout_records_side_effects_without_running_them(self, send_sms):
+        order_id = self.place_order().data['id']
+        send_sms.assert_not_called()
+        self.assertEqual(list(OutboxMessage.objects.values_list('topic', flat=True)), ['order.created'])
+
+        send_sms.return_value = {'status': 200}
+        outbox.drain()
+        send_sms.assert_called_once()
+        self.assertIn(f'Order ID: {order_id}', send_sms.call_args[0][1])
+        self.assertFalse(OutboxMessage.objects.exclude(status='sent').exists())
+
+    def test_rolled_back_checkout_leaves_no_messages(self):
+        with patch('order_app.serializers.OrderItem.objects.bulk_create', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.place_order()
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_duplicates_are_handled_once(self):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere', total_price=300)
+        outbox.enqueue('order.created', {'order_id': order.id}, dedup_key=f'order.created:{order.id}')
+        for _ in range(3):
+            outbox.enqueue('user.total_spent', {'user_id': self.user.id})
+        self.assertEqual(OutboxMessage.objects.filter(topic='order.created').count(), 1)
+
+        with patch('order_app.signals.send_sms', return_value={'status': 200}) as send_sms, \
+                CaptureQueriesContext(connection) as queries:
+            outbox.drain()
+        send_sms.assert_called_once()
+        self.assertEqual(len([query for query in queries if 'SUM(' in query['sql']]), 1)
+        self.assertFalse(OutboxMessage.objects.exclude(status='sent').exists())
+
+    def test_failed_message_is_retried_with_backoff(self):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere')
+        now = timezone.now()
+        with patch('order_app.signals.send_sms', return_value=None):
+            outbox.drain(now=now)
+            message = OutboxMessage.objects.get()
+            self.assertEqual((message.status, message.attempts), ('pending', 1))
+            self.assertEqual(message.available_at, now + outbox.RETRY_BASE)
+            # Not due yet, so the next pass leaves it alone.
+            self.assertEqual(outbox.drain(now=now + timedelta(seconds=1)), 0)
+
+            with patch.object(outbox, 'MAX_ATTEMPTS', 2):
+                outbox.drain(now=message.available_at)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', 2))
+        self.assertIn(f'order {order.id}', message.last_error)
+
+    def test_outcomes_are_kept_when_the_worker_dies_mid_batch(self):
+        first = Order.objects.create(user=self.user, delivery_address='Somewhere')
+        second = Order.objects.create(user=self.user, delivery_address='Somewhere')
+        now = timezone.now()
+        with patch('order_app.signals.send_sms', side_effect=[{'status': 200}, SystemExit]):
+            with self.assertRaises(SystemExit):
+                outbox.drain(now=now)
+        statuses = dict(OutboxMessage.objects.values_list('payload__order_id', 'status'))
+        self.assertEqual(statuses, {first.id: 'sent', second.id: 'processing'})
+
+        # The lost message waits out its lease, then goes again on its own.
+        with patch('order_app.signals.send_sms', return_value={'status': 200}) as send_sms:
+            self.assertEqual(outbox.drain(now=now + timedelta(minutes=1)), 0)
+            self.assertEqual(outbox.drain(now=now + outbox.LEASE), 1)
+        send_sms.assert_called_once()
+        self.assertIn(f'Order ID: {second.id}', send_sms.call_args[0][1])
+        self.assertEqual(OutboxMessage.objects.get(payload__order_id=second.id).attempts, 2)
+
+    def test_purge_keeps_recent_and_unsent_messages(self):
+        old = timezone.now() - timedelta(days=30)
+        OutboxMessage.objects.bulk_create([
+            OutboxMessage(topic='order.created', payload={}, status='sent', processed_at=old),
+            OutboxMessage(topic='order.created', payload={}, status='sent', processed_at=timezone.now()),
+            OutboxMessage(topic='order.created', payload={}, status='failed'),
+        ])
+        self.assertEqual(outbox.purge_sent(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+
+class TotalSpentTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product 1', slugname='product-1', price=100, stock=10, category=self.category)
+
+    def total_spent(self, user=None):
+        return User.objects.values_list('total_spent', flat=True).get(pk=(user or self.user).pk)
+
+    def test_checkout_adds_to_total_spent(self):
+        self.client.force_authenticate(user=self.user)
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.post(reverse('order-list'), {'delivery_address': 'Somewhere'}, format='json')
+        self.assertEqual(self.total_spent(), 200)
+
+    def test_saves_apply_only_what_changed(self):
+        Order.objects.create(user=self.user, delivery_address='Somewhere', total_price=500)
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere', total_price=300)
+        self.assertEqual(self.total_spent(), 800)
+
+        order = Order.objects.get(pk=order.pk)
+        order.delivery_status = 'shipped'
+        order.shipped_at = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            order.save()
+        self.assertFalse([query for query in queries if 'user_app_user' in query['sql']])
+
+        order.total_price = 350
+        order.save()
+        self.assertEqual(self.total_spent(), 850)
+
+        order.cancel_order()
+        self.assertEqual(self.total_spent(), 500)
+        # Cancelling again changes nothing.
+        Order.objects.get(pk=order.pk).cancel_order()
+        self.assertEqual(self.total_spent(), 500)
+
+        Order.objects.exclude(pk=order.pk).get().delete()
+        self.assertEqual(self.total_spent(), 0)
+
+    def test_total_spent_never_goes_below_zero(self):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere', total_price=300)
+        User.objects.filter(pk=self.user.pk).update(total_spent=100)
+        order.delete()
+        self.assertEqual(self.total_spent(), 0)
+
+    def test_deferred_order_is_recounted_through_the_outbox(self):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere', total_price=300)
+        order = Order.objects.defer('total_price').get(pk=order.pk)
+        order.delivery_status = 'cancelled'
+        order.save()
+        self.assertEqual(OutboxMessage.objects.filter(topic='user.total_spent').count(), 1)
+        with patch('order_app.signals.send_sms', return_value={'status': 200}):
+            outbox.drain()
+        self.assertEqual(self.total_spent(), 0)
+
+    def test_reconcile_fixes_and_reports_drift(self):
+        other = User.objects.create(phone_number='09122222222')
+        for user, price in [(self.user, 300), (self.user, 200), (other, 400)]:
+            Order.objects.create(user=user, delivery_address='Somewhere', total_price=price)
+        Order.objects.filter(total_price=200).update(delivery_status='cancelled')
+        User.objects.filter(pk=other.pk).update(total_spent=999)
+
+        with self.assertLogs('order_app.spending', level='WARNING') as logs, \
+                CaptureQueriesContext(connection) as queries:
+            drifted = reconcile_total_spent(batch_size=1)
+        self.assertEqual(drifted, 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(self.total_spent(), 300)
+        self.assertEqual(self.total_spent(other), 400)
+        self.assertEqual(len([query for query in queries if 'SUM(' in query['sql']]), 2)
@@ -3,6 +3,7 @@ from django.conf import settings
 from .models import PreOrderQueue
 from datetime import timedelta
 from django.utils import timezone
+from django.core.files.storage import default_storage
 def notify_user(phone_number, message):
     try:
         api = KavenegarAPI(settings.KAVENEGAR_API_KEY)
@@ -18,11 +19,14 @@ def notify_user(phone_number, message):
     except HTTPException as e:
         print("HTTP Exception:", e)
 
+def waiting_queue(product_id):
+    return PreOrderQueue.objects.filter(
+        product_id=product_id, reservation_status='waiting'
+    ).order_by('position')
+
 def reserve_for_first_in_queue(product_id):
     # Get the first user in the queue for the specified product
-    first_in_queue = PreOrderQueue.objects.filter(
-        product_id=product_id, reservation_status='waiting'
-    ).order_by('position').first()
+    first_in_queue = waiting_queue(product_id).first()
     
     if first_in_queue:
         # Update the reservation status and set the expiration time
@@ -39,3 +43,26 @@ def reserve_for_first_in_queue(product_id):
 
         return first_in_queue.user  # Return the user for further processing if needed
     return None  # No user in the queue
+
+
+# Product fields copied onto an OrderItem at checkout.
+SNAPSHOT_FIELDS = (
+    'id', 'name', 'slugname', 'brand', 'price', 'discount_percentage', 'promotion_percentage',
+    'price_after_discount', 'pre_order_price', 'category_id', 'subcategory_id',
+)
+
+
+def product_snapshot(product):
+    snapshot = {field: getattr(product, field) for field in SNAPSHOT_FIELDS}
+    snapshot['thumbnail'] = product.thumbnail.name or None
+    return snapshot
+
+
+def snapshot_detail(snapshot, request=None):
+    detail = dict(snapshot)
+    detail['category'] = detail.pop('category_id', None)
+    detail['subcategory'] = detail.pop('subcategory_id', None)
+    if detail.get('thumbnail'):
+        url = default_storage.url(detail['thumbnail'])
+        detail['thumbnail'] = request.build_absolute_uri(url) if request else url
+    return detail
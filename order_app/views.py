@@ -6,7 +6,12 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.parsers import JSONParser
 from .models import *
 from .serializers import OrderSerializer, CartSerializer,WishlistSerializer
+from .stock import hold_stock, set_hold, shrink_hold, release_hold
+from . import flash_sale
+from .idempotency import idempotent
 from product_app.models import Product
+from product_app.pagination import KeysetPaginationMixin
+from product_app.cache import response_etag, not_modified, set_validators
 from rest_framework.permissions import IsAuthenticated,IsAuthenticatedOrReadOnly,IsAdminUser
 from .permissions import IsOwnerOrAdmin
 from django.db import  transaction
@@ -18,7 +23,7 @@ from .utils import notify_user
 
 
 #Order
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsOwnerOrAdmin]
@@ -26,6 +31,7 @@ class OrderViewSet(viewsets.ModelViewSet):
     parser_classes = [JSONParser]
     ordering_fields = ['delivery_date', 'order_date']
     ordering = ['-order_date']
+    keyset_ordering = ('-order_date', '-id')
     
     def get_serializer_context(self):
         return {'request': self.request}
@@ -33,7 +39,8 @@ class OrderViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        queryset = super().get_queryset().prefetch_related('order_items__product')
+        # Items carry their own product snapshot, so the catalog is not joined.
+        queryset = super().get_queryset().select_related('user').prefetch_related('order_items')
 
         
         if not user.is_staff:
@@ -62,24 +69,42 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         return queryset
 
-    def perform_create(self, serializer):
-        with transaction.atomic():
-            user = self.request.user
-            cart = Cart.objects.get(user=user)
-
-            if not cart.cartitem_set.exists():
-                raise ValidationError("Your cart is empty. Add items to your cart before placing an order.")
-
-            order_items_data = [
-                {'product': cart_item.product, 'quantity': cart_item.quantity}
-                for cart_item in cart.cartitem_set.all()
-            ]
-
-            order = serializer.save(user=user, order_items=order_items_data)
-
-
-            cart.cartitem_set.all().delete()
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        user = self.request.user
+        claimed = []
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.get(user=user)
+                cart_items = list(cart.cartitem_set.select_related('product'))
+
+                if not cart_items:
+                    raise ValidationError("Your cart is empty. Add items to your cart before placing an order.")
+
+                order_items_data = []
+                for cart_item in cart_items:
+                    item_data = {'product': cart_item.product, 'quantity': cart_item.quantity}
+                    if cart_item.product.flash_sale and not cart_item.is_preordered:
+                        # Redeems the reservation add_to_cart handed out for this line.
+                        item_data['reserved'] = flash_sale.claim_for_order(
+                            cart_item.product_id, user.id, cart_item.quantity, cart_item.reservation_token
+                        )
+                        if item_data['reserved']:
+                            claimed.append((cart_item.product_id, cart_item.quantity, cart_item.reservation_token))
+                    order_items_data.append(item_data)
+
+                order = serializer.save(user=user, order_items=order_items_data, cart=cart)
+
+
+                cart.cartitem_set.all().delete()
+        except Exception:
+            # Redis is outside the transaction, so claims are undone by hand.
+            for product_id, quantity, token in claimed:
+                flash_sale.reinstate(product_id, user.id, quantity, token)
+            raise
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
@@ -98,6 +123,27 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data)
 
+    def get_validators(self, request, pk):
+        # One narrow query over the order and its owner; a 304 goes out before
+        # the order and its items are loaded. Items are snapshots, so catalog
+        # edits do not change the representation.
+        row = (
+            self.get_queryset().select_related(None).prefetch_related(None).order_by()
+            .filter(pk=pk)
+            .values_list('updated_at', 'user__first_name', 'user__last_name', 'user__phone_number')
+            .first()
+        )
+        if row is None:
+            return None, None
+        return response_etag(request, request.build_absolute_uri(), *row), row[0]
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request, kwargs['pk'])
+        cached = not_modified(request, etag, last_modified)
+        if cached is not None:
+            return cached
+        return set_validators(super().retrieve(request, *args, **kwargs), etag, last_modified)
+
     @action(detail=True, methods=['post'], permission_classes=[IsOwnerOrAdmin])
     def cancel(self, request, pk=None):
         try:
@@ -129,6 +175,7 @@ class CartViewSet(viewsets.ViewSet):
         return serializer_class(*args, **kwargs)
 
     @action(detail=False, methods=['post'], url_path='add', permission_classes=[IsAuthenticated])
+    @idempotent
     def add_to_cart(self, request):
         user = request.user
         product_id = request.data.get('product_id')
@@ -142,40 +189,75 @@ class CartViewSet(viewsets.ViewSet):
         if quantity <= 0:
             return Response({"detail": "Quantity must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
 
+        if product.flash_sale:
+            return self.add_flash_sale_item(user, product, quantity)
+
         try:
             with transaction.atomic():
                 cart = self.get_cart(user)
-                cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
 
-                if product.stock >= quantity:
-                    cart_item.is_preordered = False
+                # Whatever is in stock is held for this cart right away; the
+                # rest can only go in as a pre-order.
+                held = hold_stock(cart, product.id, quantity)
+                if held:
+                    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product, is_preordered=False)
                     cart_item.price = product.price_after_discount
-                    cart_item.quantity += quantity
-                else:
-                    if product.stock > 0:
-                        cart_item.is_preordered = False
-                        cart_item.price = product.price_after_discount
-                        cart_item.quantity += product.stock
-                        quantity -= product.stock
+                    cart_item.quantity += held
+                    cart_item.save()
 
+                remaining = quantity - held
+                if remaining:
                     if product.pre_order_available:
                         pre_order_item, created = CartItem.objects.get_or_create(cart=cart, product=product, is_preordered=True)
                         pre_order_item.price = product.pre_order_price
-                        pre_order_item.quantity += quantity
+                        pre_order_item.quantity += remaining
                         pre_order_item.save()
                     else:
                         raise ValidationError(f"Not enough stock for {product.name}, and pre-order is not available.")
 
-                cart_item.save()
-
                 cart_serializer = self.get_serializer(cart)
                 return Response({
-                    "detail": "Product added to cart." if product.stock >= quantity else "Product added as pre-order.",
+                    "detail": "Product added to cart." if not remaining else "Product added as pre-order.",
                     "cart": cart_serializer.data
                 }, status=status.HTTP_201_CREATED)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def add_flash_sale_item(self, user, product, quantity):
+        # No product row lock on this path: the units come out of the Redis
+        # counter, and whoever finds it short joins the pre-order queue.
+        try:
+            reservation = flash_sale.reserve(product.id, user.id, quantity)
+            if reservation is None:
+                queue_item = flash_sale.join_queue(user, product)
+                return Response({
+                    "detail": "Sold out. You have been added to the pre-order queue.",
+                    "queue_position": queue_item.position
+                }, status=status.HTTP_202_ACCEPTED)
+
+            try:
+                with transaction.atomic():
+                    cart = self.get_cart(user)
+                    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product, is_preordered=False)
+                    cart_item.price = product.price_after_discount
+                    cart_item.quantity = reservation.quantity
+                    cart_item.reservation_token = reservation.token
+                    cart_item.save()
+            except Exception:
+                flash_sale.release(product.id, user.id)
+                raise
+
+            cart_serializer = self.get_serializer(cart)
+            return Response({
+                "detail": "Product reserved.",
+                "reservation_token": reservation.token,
+                "reservation_expires_at": reservation.expires_at,
+                "cart": cart_serializer.data
+            }, status=status.HTTP_201_CREATED)
+        except Exception as e:
+            logger.error(f"Error reserving flash sale product {product.id} for user {user.id}: {str(e)}")
+            return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     @action(detail=False, methods=['post'], url_path='decrease-item', permission_classes=[IsAuthenticated])
     def decrease_cart_item(self, request):
         user = request.user
@@ -185,17 +267,24 @@ class CartViewSet(viewsets.ViewSet):
             return Response({"detail": "Product ID is required."}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            cart_item = CartItem.objects.get(cart__user=user, product_id=product_id)
-            if cart_item.quantity > 1:
-                cart_item.quantity -= 1
-                cart_item.save()
+            with transaction.atomic():
+                cart_item = CartItem.objects.get(cart__user=user, product_id=product_id)
+                if cart_item.product.flash_sale and not cart_item.is_preordered:
+                    return Response({"detail": "Flash sale items can only be removed from the cart."}, status=status.HTTP_400_BAD_REQUEST)
+                if not cart_item.is_preordered:
+                    shrink_hold(cart_item.cart, cart_item.product_id, cart_item.quantity - 1)
+                if cart_item.quantity > 1:
+                    cart_item.quantity -= 1
+                    cart_item.save()
+                else:
+                    cart_item.delete()
+            if cart_item.pk is not None:
                 cart_serializer = self.get_serializer(cart_item.cart)
                 return Response({
                     "detail": "Cart item quantity decreased.",
                     "cart": cart_serializer.data
                 }, status=status.HTTP_200_OK)
             else:
-                cart_item.delete()
                 cart_serializer = self.get_serializer(cart_item.cart)
                 return Response({
                     "detail": "Cart item removed from cart.",
@@ -226,8 +315,13 @@ class CartViewSet(viewsets.ViewSet):
             quantity = request.data.get('quantity')
             if quantity is None or quantity <= 0:
                 return Response({"detail": "Invalid quantity."}, status=status.HTTP_400_BAD_REQUEST)
-            cart_item.quantity = quantity
-            cart_item.save()
+            if cart_item.product.flash_sale and not cart_item.is_preordered:
+                return Response({"detail": "Flash sale items can only be removed from the cart."}, status=status.HTTP_400_BAD_REQUEST)
+            with transaction.atomic():
+                if not cart_item.is_preordered and not set_hold(cart_item.cart, cart_item.product_id, quantity):
+                    return Response({"detail": "Not enough stock."}, status=status.HTTP_400_BAD_REQUEST)
+                cart_item.quantity = quantity
+                cart_item.save()
             cart_serializer = self.get_serializer(cart_item.cart)
             return Response({
                 "detail": "Cart item updated.",
@@ -244,7 +338,12 @@ class CartViewSet(viewsets.ViewSet):
         try:
             cart_item = CartItem.objects.get(cart__user=user, product_id=product_id)
             cart = cart_item.cart
-            cart_item.delete()
+            with transaction.atomic():
+                if cart_item.product.flash_sale and not cart_item.is_preordered:
+                    transaction.on_commit(lambda: flash_sale.release(cart_item.product_id, user.id))
+                elif not cart_item.is_preordered:
+                    release_hold(cart, cart_item.product_id)
+                cart_item.delete()
             cart_serializer = self.get_serializer(cart)
             return Response({
                 "detail": "Product removed from cart.",
@@ -0,0 +1,177 @@
+import heapq
+import re
+from bisect import bisect_left
+from .cache import IncrementalIndex
+from .models import Product
+from .taxonomy import taxonomy
+
+SPACE_RE = re.compile(r'\s+')
+DEFAULT_BRAND = Product._meta.get_field('brand').default
+
+SUGGESTION_LIMIT = 10
+MAX_SUGGESTION_LIMIT = 20
+# Prefixes this short match a large slice of the vocabulary, so their top
+# suggestions are memoized until the next change.
+MEMO_PREFIX_LENGTH = 2
+
+
+def normalize(text):
+    return SPACE_RE.sub(' ', (text or '').casefold()).strip()
+
+
+def terms_for(text):
+    # The whole name plus every word-start suffix, so "galaxy" finds
+    # "Samsung Galaxy S21".
+    words = normalize(text).split(' ')
+    return [' '.join(words[index:]) for index in range(len(words)) if words[index]]
+
+
+class Suggestions:
+    # Once published to readers a Suggestions is never changed: updates go to
+    # a copy() that replaces it, so suggest() needs no lock.
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+        self.entry_terms = {}
+        self.products = {}
+        self.group_weights = {}
+        self.memo = {}
+        self.synced_at = None
+        self.changes_version = None
+
+    def copy(self):
+        patched = Suggestions()
+        patched.keys = list(self.keys)
+        patched.entries = dict(self.entries)
+        patched.entry_terms = dict(self.entry_terms)
+        patched.products = dict(self.products)
+        patched.group_weights = dict(self.group_weights)
+        patched.synced_at = self.synced_at
+        patched.changes_version = self.changes_version
+        return patched
+
+    def _set_entry(self, key, text, weight, **extra):
+        current = self.entries.get(key)
+        if current is not None and current['text'] == text:
+            self.entries[key] = {**current, 'weight': weight}
+            return
+        self._remove_entry(key)
+        self.entries[key] = {'type': key[0], 'text': text, 'weight': weight, **extra}
+        terms = terms_for(text)
+        self.entry_terms[key] = terms
+        for term in terms:
+            position = bisect_left(self.keys, (term, key))
+            self.keys.insert(position, (term, key))
+
+    def _remove_entry(self, key):
+        if self.entries.pop(key, None) is None:
+            return
+        for term in self.entry_terms.pop(key):
+            position = bisect_left(self.keys, (term, key))
+            if position < len(self.keys) and self.keys[position] == (term, key):
+                del self.keys[position]
+
+    def _groups(self, brand, category_id, category_name):
+        groups = [(('category', category_id), category_name, {'id': category_id})]
+        if brand and brand != DEFAULT_BRAND:
+            groups.append((('brand', brand), brand, {}))
+        return groups
+
+    def _adjust_groups(self, product, sign):
+        # Brands and categories weigh what their products sell together and
+        # disappear once no product refers to them.
+        _, _, brand, category_id, weight, category_name = product
+        for key, text, extra in self._groups(brand, category_id, category_name):
+            count, total = self.group_weights.get(key, (0, 0))
+            count, total = count + sign, total + sign * weight
+            if count <= 0 or not text:
+                self.group_weights.pop(key, None)
+                self._remove_entry(key)
+                continue
+            self.group_weights[key] = (count, total)
+            self._set_entry(key, text, total, **extra)
+
+    def upsert_product(self, product_id, name, slugname, brand, category_id, weight, category_name):
+        previous = self.products.get(product_id)
+        if previous is not None:
+            self._adjust_groups(previous, -1)
+        product = (name, slugname, brand, category_id, max(weight or 0, 0), category_name)
+        self.products[product_id] = product
+        self._set_entry(('product', product_id), name, product[4], id=product_id, slugname=slugname)
+        self._adjust_groups(product, 1)
+        self.memo.clear()
+
+    def build(self, rows):
+        # Bulk path: collect everything, then sort once.
+        for product_id, name, slugname, brand, category_id, weight, category_name in rows:
+            weight = max(weight or 0, 0)
+            self.products[product_id] = (name, slugname, brand, category_id, weight, category_name)
+            self.entries[('product', product_id)] = {
+                'type': 'product', 'text': name, 'weight': weight, 'id': product_id, 'slugname': slugname,
+            }
+            for key, text, extra in self._groups(brand, category_id, category_name):
+                count, total = self.group_weights.get(key, (0, 0))
+                self.group_weights[key] = (count + 1, total + weight)
+                if text:
+                    self.entries[key] = {'type': key[0], 'text': text, 'weight': total + weight, **extra}
+        for key, entry in self.entries.items():
+            terms = terms_for(entry['text'])
+            self.entry_terms[key] = terms
+            self.keys.extend((term, key) for term in terms)
+        self.keys.sort()
+
+    def suggest(self, query, limit=SUGGESTION_LIMIT):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        memoize = len(prefix) <= MEMO_PREFIX_LENGTH and limit <= MAX_SUGGESTION_LIMIT
+        if memoize and prefix in self.memo:
+            return self.memo[prefix][:limit]
+
+        matched = set()
+        keys = self.keys
+        for index in range(bisect_left(keys, (prefix,)), len(keys)):
+            term, key = keys[index]
+            if not term.startswith(prefix):
+                break
+            matched.add(key)
+        top = heapq.nsmallest(
+            MAX_SUGGESTION_LIMIT if memoize else limit, matched,
+            key=lambda key: (-self.entries[key]['weight'], self.entries[key]['text'], str(key)),
+        )
+        suggestions = [
+            {name: value for name, value in self.entries[key].items() if name != 'weight'} for key in top
+        ]
+        if memoize:
+            self.memo[prefix] = suggestions
+        return suggestions[:limit]
+
+
+def _product_rows(queryset):
+    categories = taxonomy.get().categories
+    rows = queryset.values_list('id', 'name', 'slugname', 'brand', 'category_id', 'sales_count')
+    for product_id, name, slugname, brand, category_id, sales_count in rows.iterator(chunk_size=2000):
+        category = categories.get(category_id)
+        yield product_id, name, slugname, brand, category_id, sales_count, category['name'] if category else None
+
+
+class AutocompleteIndex(IncrementalIndex):
+    version_key = 'products:autocomplete:version'
+    changes_key = 'products:autocomplete:changes'
+
+    def load(self):
+        data = Suggestions()
+        data.build(_product_rows(Product.objects.all()))
+        return data
+
+    def patch(self, data, since):
+        patched = data.copy()
+        for row in _product_rows(Product.objects.filter(updated_at__gte=since)):
+            patched.upsert_product(*row)
+        return patched
+
+    def suggest(self, query, limit=SUGGESTION_LIMIT):
+        return self.get().suggest(query, limit)
+
+
+autocomplete_index = AutocompleteIndex()
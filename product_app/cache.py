@@ -0,0 +1,299 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_CACHE_TIMEOUT = getattr(settings, 'PRODUCT_CACHE_TIMEOUT', 60 * 15)
+
+PRODUCT_LIST_VERSION_KEY = 'products:list:version'
+# Moves on every product write, including the stock-only ones that leave
+# PRODUCT_LIST_VERSION_KEY alone.
+PRODUCT_STOCK_VERSION_KEY = 'products:stock:version'
+PRODUCT_DETAIL_VERSION_KEY = 'products:detail:version:{product_id}'
+# Part of every detail key, so set-based writes can drop all of them at once.
+PRODUCT_DETAIL_GENERATION_KEY = 'products:detail:generation'
+
+COMMENT_VERSION_KEY = 'comments:version:{product_id}'
+PRODUCT_RELATED_VERSION_KEY = 'products:related:version'
+
+# Query params that change the product list response; anything else is ignored
+# when building the cache key.
+PRODUCT_LIST_PARAMS = (
+    'category', 'subcategory', 'brand', 'minPrice', 'maxPrice', 'minRating',
+    'sort', 'sort_order', 'page', 'search', 'pagination', 'cursor', 'q',
+    'fields', 'expand',
+)
+PRODUCT_DETAIL_PARAMS = ('fields', 'expand')
+
+
+def _initial_version():
+    # Seeding from the clock means a version key that was evicted never comes
+    # back with a number that old entries were stored under.
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, _initial_version(), None)
+            version = cache.get(key)
+        return version
+    except Exception as e:
+        logger.error(f"Error reading cache version {key}: {str(e)}")
+        return None
+
+
+def bump_version(key):
+    cache.add(key, _initial_version(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        cache.set(key, version, None)
+        return version
+
+
+def normalize_params(params, names):
+    normalized = []
+    for name in names:
+        value = params.get(name)
+        if value is None:
+            continue
+        value = value.strip()
+        if value:
+            normalized.append((name, value))
+    return urlencode(normalized)
+
+
+def _origin(request):
+    # Serialized products embed absolute image URLs, so the host is part of the key.
+    return f'{request.scheme}://{request.get_host()}'
+
+
+def _digest(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def product_list_cache_key(request):
+    version = get_version(PRODUCT_LIST_VERSION_KEY)
+    if version is None:
+        return None
+    query = normalize_params(request.query_params, PRODUCT_LIST_PARAMS)
+    return f'products:list:{version}:{_digest(_origin(request), request.path, query)}'
+
+
+def product_detail_cache_key(request, product_id):
+    version = get_version(PRODUCT_DETAIL_VERSION_KEY.format(product_id=product_id))
+    generation = get_version(PRODUCT_DETAIL_GENERATION_KEY)
+    if version is None or generation is None:
+        return None
+    query = normalize_params(request.query_params, PRODUCT_DETAIL_PARAMS)
+    return f'products:detail:{product_id}:{generation}.{version}:{_digest(_origin(request), query)}'
+
+
+def comment_page_cache_key(request, product_id):
+    version = get_version(COMMENT_VERSION_KEY.format(product_id=product_id))
+    if version is None:
+        return None
+    return f'comments:first:{product_id}:{version}:{_digest(_origin(request), request.path)}'
+
+
+def product_related_cache_key(request, product_id):
+    # Neighbours are other products, so any product change (the list
+    # version) as well as a co-occurrence run makes the entry stale.
+    related_version = get_version(PRODUCT_RELATED_VERSION_KEY)
+    list_version = get_version(PRODUCT_LIST_VERSION_KEY)
+    if related_version is None or list_version is None:
+        return None
+    query = normalize_params(request.query_params, PRODUCT_DETAIL_PARAMS)
+    return f'products:related:{product_id}:{related_version}.{list_version}:{_digest(_origin(request), query)}'
+
+
+def invalidate_related():
+    bump_version(PRODUCT_RELATED_VERSION_KEY)
+
+
+def invalidate_comments(product_id):
+    bump_version(COMMENT_VERSION_KEY.format(product_id=product_id))
+
+
+def invalidate_product_lists():
+    bump_version(PRODUCT_LIST_VERSION_KEY)
+
+
+def invalidate_product_details(product_ids):
+    # Leaves the cached lists alone. For writes that only move the exact stock
+    # count: lists may show a count up to PRODUCT_CACHE_TIMEOUT old, while
+    # whether a product is in stock at all still goes through the lists.
+    # Their ETag follows the cached body (content_digest), so a 304 always
+    # agrees with what a full GET would return.
+    for product_id in product_ids:
+        bump_version(PRODUCT_DETAIL_VERSION_KEY.format(product_id=product_id))
+    bump_version(PRODUCT_STOCK_VERSION_KEY)
+
+
+def invalidate_product(product_id):
+    invalidate_products([product_id])
+
+
+def invalidate_products(product_ids):
+    # For bulk writes: one detail bump per product, but the lists only once.
+    invalidate_product_details(product_ids)
+    invalidate_product_lists()
+
+
+def invalidate_all_products():
+    bump_version(PRODUCT_DETAIL_GENERATION_KEY)
+    invalidate_product_lists()
+
+
+def invalidate_on_commit(func, *args):
+    # Invalidating before the transaction commits would let a concurrent reader
+    # cache the old rows again under the new version.
+    transaction.on_commit(lambda: _safe_invalidate(func, *args))
+
+
+def _safe_invalidate(func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error(f"Error invalidating product cache: {str(e)}")
+
+
+def cached_response_data(key):
+    if key is None:
+        return None
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.error(f"Error reading product cache: {str(e)}")
+        return None
+
+
+def store_response_data(key, data, timeout=PRODUCT_CACHE_TIMEOUT):
+    if key is None:
+        return
+    try:
+        cache.set(key, data, timeout)
+    except Exception as e:
+        logger.error(f"Error writing product cache: {str(e)}")
+
+
+def response_etag(request, *parts):
+    # Strong validator built from version counters and other cheap inputs, so a
+    # matching If-None-Match is answered before any row is read. The renderer
+    # is part of it because JSON and the browsable API are different bytes.
+    renderer = getattr(request, 'accepted_renderer', None)
+    if any(part is None for part in parts):
+        return None
+    return f'"{_digest(getattr(renderer, "format", ""), *parts)}"'
+
+
+def content_digest(data):
+    # For responses whose cache key outlives some of the writes they show:
+    # the validator then has to follow the bytes actually served.
+    return _digest(json.dumps(data, sort_keys=True, default=str))
+
+
+def not_modified(request, etag, last_modified=None):
+    if etag is None:
+        return None
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        response['ETag'] = etag
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    if response.status_code == 200:
+        if etag is not None:
+            response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+class LocalIndex:
+    # A structure built once per worker process and rebuilt lazily whenever the
+    # shared version key in the cache moves, so every worker converges after a
+    # write without any cross-process messaging.
+    version_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+
+    def build(self):
+        raise NotImplementedError
+
+    def get(self):
+        version = get_version(self.version_key)
+        if self._data is not None and (version is None or version == self._version):
+            return self._data
+        with self._lock:
+            if self._data is None or (version is not None and version != self._version):
+                self._data = self.build()
+                self._version = version
+            return self._data
+
+    def invalidate(self):
+        bump_version(self.version_key)
+
+
+class IncrementalIndex(LocalIndex):
+    # Full rebuilds follow version_key (deletes, bulk imports); saves only
+    # move changes_key, and workers then re-read just the products updated
+    # since their last sync and patch a copy of their data. Subclasses
+    # provide load() and patch(data, since).
+    changes_key = None
+    # Rows are re-read from a little before the last sync, so a write whose
+    # transaction committed late is still picked up.
+    sync_overlap = timedelta(seconds=30)
+
+    def load(self):
+        raise NotImplementedError
+
+    def patch(self, data, since):
+        raise NotImplementedError
+
+    def build(self):
+        changes_version = get_version(self.changes_key)
+        synced_at = timezone.now()
+        data = self.load()
+        data.changes_version = changes_version
+        data.synced_at = synced_at
+        return data
+
+    def get(self):
+        data = super().get()
+        changes_version = get_version(self.changes_key)
+        if changes_version is not None and changes_version != data.changes_version:
+            with self._lock:
+                data = self._data
+                if changes_version != data.changes_version:
+                    data = self._data = self.apply_changes(data, changes_version)
+        return data
+
+    def apply_changes(self, data, changes_version):
+        synced_at = timezone.now()
+        patched = self.patch(data, data.synced_at - self.sync_overlap)
+        patched.synced_at = synced_at
+        patched.changes_version = changes_version
+        return patched
+
+    def changed(self):
+        bump_version(self.changes_key)
@@ -0,0 +1,191 @@
+import csv
+import json
+import os
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Product
+from .utils import compute_prices
+
+# Columns of the supplier feed, in export order. category and subcategory are
+# slugnames (a numeric id is accepted on import as well).
+COLUMNS = [
+    'slugname', 'name', 'brand', 'description', 'price', 'discount_percentage',
+    'stock', 'pre_order_available', 'category', 'subcategory',
+]
+INTEGER_COLUMNS = ('price', 'discount_percentage', 'stock')
+REQUIRED_FIELDS = {'name', 'price', 'category_id'}
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+FORMATS = ('csv', 'jsonl')
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(path, format=None):
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension in ('json', 'jsonl', 'ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(stream, format):
+    # Yields one dict per record without reading the whole file.
+    if format == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(stream)
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _taxonomy_id(value, by_slug, exists):
+    if value in (None, ''):
+        return None
+    value = str(value).strip()
+    node = by_slug(value)
+    if node is not None:
+        return node['id']
+    if value.isdigit() and exists(value):
+        return int(value)
+    raise RowError(f'unknown category or subcategory {value!r}')
+
+
+def parse_row(row, tree):
+    values = {}
+    for column in COLUMNS:
+        if column not in row:
+            continue
+        value = row[column]
+        if isinstance(value, str):
+            value = value.strip()
+        if column in INTEGER_COLUMNS:
+            if value in (None, ''):
+                raise RowError(f'{column} is required')
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise RowError(f'{column} must be an integer, got {value!r}')
+            if value < 0 and column != 'stock':
+                raise RowError(f'{column} must not be negative')
+        elif column == 'pre_order_available':
+            value = value if isinstance(value, bool) else str(value).lower() in TRUE_VALUES
+        elif column == 'category':
+            value = _taxonomy_id(value, tree.category_by_slug, tree.has_category)
+        elif column == 'subcategory':
+            value = _taxonomy_id(value, tree.subcategory_by_slug, tree.has_subcategory)
+        values[column] = value
+
+    if not values.get('slugname'):
+        raise RowError('slugname is required')
+    if values.get('discount_percentage', 0) > 100:
+        raise RowError('discount_percentage must be between 0 and 100')
+    return values
+
+
+def _model_fields(values):
+    fields = dict(values)
+    for column in ('category', 'subcategory'):
+        if column in fields:
+            fields[f'{column}_id'] = fields.pop(column)
+    return fields
+
+
+def import_chunk(rows):
+    # Upserts one chunk keyed on slugname. Prices are computed here because
+    # bulk writes skip calculate_prices. Returns the number of created
+    # products, the ids of updated ones, the ids that went from 0 to positive
+    # stock, and (slugname, message) pairs for rows that were skipped.
+    rows = list({values['slugname']: values for values in rows}.values())
+    existing = {
+        slugname: (product_id, stock, price, discount, promotion)
+        for slugname, product_id, stock, price, discount, promotion in Product.objects.filter(
+            slugname__in=[values['slugname'] for values in rows]
+        ).values_list('slugname', 'id', 'stock', 'price', 'discount_percentage', 'promotion_percentage')
+    }
+
+    created = 0
+    updated = []
+    restocked = []
+    errors = []
+    groups = {}
+    for values in rows:
+        fields = _model_fields(values)
+        current = existing.get(values['slugname'])
+        if current is None:
+            if not REQUIRED_FIELDS <= set(fields) or fields['category_id'] is None:
+                errors.append((values['slugname'], 'name, price and category are required for new products'))
+                continue
+            price, discount, promotion = fields['price'], fields.get('discount_percentage', 0), 0
+            created += 1
+        else:
+            product_id, old_stock, price, discount, promotion = current
+            price = fields.get('price', price)
+            discount = fields.get('discount_percentage', discount)
+            if old_stock == 0 and fields.get('stock', 0) > 0:
+                restocked.append(product_id)
+            updated.append(product_id)
+        fields['price_after_discount'], fields['pre_order_price'] = compute_prices(price, discount, promotion)
+        # Rows are grouped by the columns they carry so that a file without,
+        # say, a description column never blanks the stored descriptions.
+        groups.setdefault(frozenset(fields), []).append((current, Product(**fields)))
+
+    now = timezone.now()
+    with transaction.atomic():
+        for names, entries in groups.items():
+            update_fields = sorted((names | {'updated_at'}) - {'slugname'})
+            # MySQL has no conflict target, so it always takes the fallback below.
+            if REQUIRED_FIELDS <= names and connection.features.supports_update_conflicts_with_target:
+                Product.objects.bulk_create(
+                    [product for _, product in entries],
+                    update_conflicts=True, unique_fields=['slugname'], update_fields=update_fields,
+                )
+                continue
+
+            Product.objects.bulk_create([product for current, product in entries if current is None])
+            changed = []
+            for current, product in entries:
+                if current is not None:
+                    product.pk = current[0]
+                    product.updated_at = now
+                    changed.append(product)
+            Product.objects.bulk_update(changed, update_fields)
+    return created, updated, restocked, errors
+
+
+def export_rows(queryset, chunk_size=2000):
+    rows = queryset.order_by('id').values(
+        *[column for column in COLUMNS if column not in ('category', 'subcategory')],
+        category_slug=F('category__slugname'), subcategory_slug=F('subcategory__slugname'),
+    )
+    for row in rows.iterator(chunk_size=chunk_size):
+        row['category'] = row.pop('category_slug')
+        row['subcategory'] = row.pop('subcategory_slug') or ''
+        yield {column: row[column] for column in COLUMNS}
+
+
+def write_rows(stream, rows, format):
+    if format == 'jsonl':
+        for row in rows:
+            stream.write(json.dumps(row, ensure_ascii=False) + '\n')
+        return
+    writer = csv.DictWriter(stream, fieldnames=COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
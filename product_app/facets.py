@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.db.models import BooleanField, Case, Count, IntegerField, Value, When
+
+# Lower bounds of the price bands, in the same unit as Product.price.
+PRICE_BANDS = getattr(settings, 'PRODUCT_PRICE_BANDS', [0, 1_000_000, 5_000_000, 10_000_000, 50_000_000, 100_000_000])
+
+
+# The filter each facet leaves out of its own counts, so picking one brand
+# still shows how many products the other brands have.
+FACET_FILTERS = {'categories': 'taxonomy', 'subcategories': 'taxonomy', 'brands': 'brand', 'price_bands': 'price'}
+
+
+def price_band_expression():
+    # Products without a price are in no band.
+    whens = [When(price_after_discount__isnull=True, then=Value(None))] + [
+        When(price_after_discount__lt=upper, then=Value(index))
+        for index, upper in enumerate(PRICE_BANDS[1:])
+    ]
+    return Case(*whens, default=Value(len(PRICE_BANDS) - 1), output_field=IntegerField())
+
+
+def compute_facets(queryset, filters=None):
+    # One GROUP BY over every facet dimension at once, plus a flag per filter
+    # telling whether the row passes it; the per-facet totals are folded
+    # together here instead of running one COUNT per facet. filters maps the
+    # names in FACET_FILTERS to conditions; queryset has the others applied.
+    filters = filters or {}
+    flags = {
+        f'passes_{name}': Case(When(condition, then=Value(True)), default=Value(False), output_field=BooleanField())
+        for name, condition in filters.items()
+    }
+    rows = (
+        queryset.order_by()
+        .annotate(price_band=price_band_expression(), **flags)
+        .values('category_id', 'category__name', 'subcategory_id', 'subcategory__name', 'brand', 'price_band', *flags)
+        .annotate(count=Count('id'))
+    )
+
+    total = 0
+    categories = {}
+    subcategories = {}
+    brands = {}
+    bands = {}
+    for row in rows:
+        count = row['count']
+        failed = {name for name in filters if not row[f'passes_{name}']}
+        counts = {facet: failed <= {name} for facet, name in FACET_FILTERS.items()}
+        if not failed:
+            total += count
+
+        if counts['categories']:
+            category = categories.setdefault(row['category_id'], {'id': row['category_id'], 'name': row['category__name'], 'count': 0})
+            category['count'] += count
+
+        if counts['subcategories'] and row['subcategory_id'] is not None:
+            subcategory = subcategories.setdefault(row['subcategory_id'], {
+                'id': row['subcategory_id'], 'name': row['subcategory__name'], 'count': 0
+            })
+            subcategory['count'] += count
+
+        if counts['brands'] and row['brand']:
+            brands[row['brand']] = brands.get(row['brand'], 0) + count
+
+        if counts['price_bands'] and row['price_band'] is not None:
+            bands[row['price_band']] = bands.get(row['price_band'], 0) + count
+
+    price_bands = []
+    for index, lower in enumerate(PRICE_BANDS):
+        if index not in bands:
+            continue
+        upper = PRICE_BANDS[index + 1] if index + 1 < len(PRICE_BANDS) else None
+        price_bands.append({'min': lower, 'max': upper, 'count': bands[index]})
+
+    def by_count(facet):
+        return -facet['count'], str(facet.get('name', facet.get('brand')))
+
+    return {
+        'total': total,
+        'categories': sorted(categories.values(), key=by_count),
+        'subcategories': sorted(subcategories.values(), key=by_count),
+        'brands': sorted(({'brand': brand, 'count': count} for brand, count in brands.items()), key=by_count),
+        'price_bands': price_bands,
+    }
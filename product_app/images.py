@@ -0,0 +1,188 @@
+import logging
+import os
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FIELDS = ('image1', 'image2', 'image3', 'image4')
+
+DERIVATIVE_WIDTHS = getattr(settings, 'PRODUCT_IMAGE_WIDTHS', (320, 640, 1024))
+THUMBNAIL_SIZE = getattr(settings, 'PRODUCT_THUMBNAIL_SIZE', (300, 300))
+# How long a released original is kept before its references are re-checked
+# and it is deleted: an identical upload that resolved to the same blob may
+# not have committed yet when the release is scheduled.
+IMAGE_RELEASE_GRACE = getattr(settings, 'PRODUCT_IMAGE_RELEASE_GRACE', 60 * 60)
+DERIVED_DIR = 'products/images/derived'
+THUMBNAIL_DIR = 'products/thumbnails'
+
+FORMAT_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 6},
+    'avif': {'format': 'AVIF', 'quality': 60},
+}
+
+
+def available_formats():
+    # AVIF needs a Pillow built with libavif; WebP is in every stock wheel.
+    return [name for name in FORMAT_OPTIONS if features.check(name)]
+
+
+def _encode(image, name):
+    options = dict(FORMAT_OPTIONS[name])
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    buffer = BytesIO()
+    image.save(buffer, **options)
+    return ContentFile(buffer.getvalue())
+
+
+def _resize_to_width(image, width):
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def _stem(source_name):
+    return os.path.splitext(os.path.basename(source_name))[0]
+
+
+def _derived_dir(source_name):
+    return f'{DERIVED_DIR}/{_stem(source_name)}'
+
+
+def thumbnail_name(source_name):
+    return f'{THUMBNAIL_DIR}/{_stem(source_name)}.webp'
+
+
+def _open_original(source_name):
+    with default_storage.open(source_name, 'rb') as source:
+        image = ImageOps.exif_transpose(Image.open(source))
+        image.load()
+    return image
+
+
+def _save_once(name, render):
+    # Originals are content-addressed, so a derived name always describes the
+    # same bytes; when another product already produced it, reuse the file.
+    if default_storage.exists(name):
+        return name
+    return default_storage.save(name, render())
+
+
+def build_derivatives(source_name, formats=None):
+    # Writes every size/format for one original and returns
+    # {'source': ..., 'sizes': {width: {format: storage name}}}.
+    formats = formats or available_formats()
+    original = None
+    sizes = {}
+    for width in DERIVATIVE_WIDTHS:
+        if original is None:
+            original = _open_original(source_name)
+        if width > original.width and sizes:
+            break
+        resized = _resize_to_width(original, width)
+        sizes[str(resized.width)] = {
+            name: _save_once(f'{_derived_dir(source_name)}/{resized.width}.{name}', lambda: _encode(resized, name))
+            for name in formats
+        }
+    return {'source': source_name, 'sizes': sizes}
+
+
+def build_thumbnail(source_name):
+    def render():
+        image = _open_original(source_name)
+        image.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        return _encode(image, 'webp')
+    return _save_once(thumbnail_name(source_name), render)
+
+
+def delete_image_files(source_name):
+    # Removes an original together with everything derived from it.
+    directory = _derived_dir(source_name)
+    if default_storage.exists(directory):
+        for filename in default_storage.listdir(directory)[1]:
+            default_storage.delete(f'{directory}/{filename}')
+        default_storage.delete(directory)
+    for name in (thumbnail_name(source_name), source_name):
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+
+def srcset_for(variants, request):
+    # Size-keyed URLs plus ready-made srcset strings per format for <picture>.
+    sizes = {}
+    srcset = {}
+    for width, formats in sorted(variants.get('sizes', {}).items(), key=lambda item: int(item[0])):
+        for name, storage_name in formats.items():
+            url = request.build_absolute_uri(default_storage.url(storage_name))
+            sizes.setdefault(width, {})[name] = url
+            srcset.setdefault(name, []).append(f'{url} {width}w')
+    return {'sizes': sizes, 'srcset': {name: ', '.join(entries) for name, entries in srcset.items()}}
+
+
+def refresh_product_images(product):
+    # Regenerates derivatives only for image fields whose original changed
+    # since the last run. Files of replaced originals are left to
+    # release_unreferenced_images, since other products may share them.
+    variants = dict(product.image_variants or {})
+    changed = False
+    for field in IMAGE_FIELDS:
+        image = getattr(product, field)
+        previous = variants.get(field)
+        if previous and (not image or previous.get('source') != image.name):
+            del variants[field]
+            changed = True
+        if image and field not in variants:
+            try:
+                variants[field] = build_derivatives(image.name)
+                changed = True
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not build derivatives for {image.name} of product {product.id}: {str(e)}")
+
+    thumbnail = product.thumbnail.name or ''
+    primary = next((getattr(product, field) for field in IMAGE_FIELDS if getattr(product, field)), None)
+    thumbnail_source = variants.get('thumbnail', {}).get('source')
+    if primary is None or thumbnail_source != primary.name or not thumbnail:
+        thumbnail = ''
+        variants.pop('thumbnail', None)
+        if primary is not None:
+            try:
+                thumbnail = build_thumbnail(primary.name)
+                variants['thumbnail'] = {'source': primary.name}
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not build thumbnail for product {product.id}: {str(e)}")
+    changed = changed or thumbnail != (product.thumbnail.name or '')
+
+    return changed, thumbnail, variants
+
+
+def image_reference_count(name):
+    # Products pointing at the original, plus order items whose snapshot
+    # still shows the thumbnail derived from it.
+    from order_app.models import OrderItem
+    from .models import Product
+    references = Q()
+    for field in IMAGE_FIELDS:
+        references |= Q(**{field: name})
+    snapshots = OrderItem.objects.filter(product_snapshot__thumbnail=thumbnail_name(name))
+    return Product.objects.filter(references).count() + snapshots.count()
+
+
+def release_unreferenced_images(names):
+    # Reference counting across image1..image4 of every product and the
+    # order item snapshots: an original (and its derivatives) is deleted only
+    # once nothing points at it.
+    released = []
+    for name in set(filter(None, names)):
+        if image_reference_count(name) == 0:
+            try:
+                delete_image_files(name)
+                released.append(name)
+            except OSError as e:
+                logger.error(f"Could not delete unreferenced image {name}: {str(e)}")
+    return released
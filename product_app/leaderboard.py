@@ -0,0 +1,327 @@
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import transaction
+from django.db.models import Case, F, Q, Sum, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from redis.exceptions import ResponseError
+from SilverShop.redis_client import get_redis, get_script
+from .models import Product
+from .cache import invalidate_on_commit, invalidate_products
+from .autocomplete import autocomplete_index
+
+logger = logging.getLogger(__name__)
+
+ALL_TIME_KEY = 'leaderboard:all'
+CATEGORY_KEY = 'leaderboard:category:{category_id}'
+DAY_KEY = 'leaderboard:day:{day}'
+WEEK_KEY = 'leaderboard:7d'
+# Pending sales are bucketed by the second their database change was made in
+# (the order date of a sale, cancelled_at of a cancellation), so a rebuild
+# can split them at the same point as the rows it reads. Each field is
+# "product:category:day" so a bucket can be replayed onto the boards.
+PENDING_SALES_KEY = 'sales:pending:{second}'
+TAKEN_MARK = ':taken:'
+TAKEN_GRACE = timedelta(minutes=10)
+# Changes older than this are taken to have committed and been recorded.
+# flush_sales_counts only applies buckets past it, and a rebuild reads only
+# the rows before it.
+SALES_SETTLE = 60 * 5
+# How far ahead of the rebuilding worker's clock a bucket may be stamped.
+SALES_CLOCK_SKEW = 60
+# Held by a flush or a rebuild of sales counts; they must not interleave.
+SALES_LOCK_KEY = 'sales:lock'
+SALES_LOCK_TTL = 60 * 30
+REBUILD_LOCK_WAIT = 60
+REBUILD_SUFFIX = ':rebuild'
+
+# KEYS: the pending buckets not settled yet. ARGV: the number of boards, the
+# boards, then the day boards in the window. Adds the buckets to the boards
+# built under their ":rebuild" keys and swaps every board in, in one step,
+# so no record_sales can land between the read and the swap.
+SWAP_BOARDS_SCRIPT = """
+local boards = {}
+local count = tonumber(ARGV[1])
+for i = 2, count + 1 do boards[ARGV[i]] = true end
+local days = {}
+for i = count + 2, #ARGV do days[ARGV[i]] = true end
+for _, bucket in ipairs(KEYS) do
+    local entries = redis.call('HGETALL', bucket)
+    for i = 1, #entries, 2 do
+        local product, category, day = string.match(entries[i], '^(%d+):([^:]*):(%d+)$')
+        if product then
+            local targets = {'leaderboard:all', 'leaderboard:category:' .. category}
+            if days['leaderboard:day:' .. day] then
+                table.insert(targets, 'leaderboard:day:' .. day)
+            end
+            for _, key in ipairs(targets) do
+                redis.call('ZINCRBY', key .. ':rebuild', entries[i + 1], product)
+                boards[key] = true
+            end
+        end
+    end
+end
+for key in pairs(boards) do
+    if redis.call('EXISTS', key .. ':rebuild') == 1 then
+        redis.call('RENAME', key .. ':rebuild', key)
+    else
+        redis.call('DEL', key)
+    end
+end
+return 1
+"""
+
+WINDOW_DAYS = 7
+# Day sets only feed the rolling window, so they can go once they fall out of it.
+DAY_KEY_TTL = 60 * 60 * 24 * (WINDOW_DAYS + 1)
+# The 7-day board is a union of the day sets, recomputed at most this often.
+WEEK_KEY_TTL = 60 * 5
+
+
+def _day_key(day):
+    return DAY_KEY.format(day=day.strftime('%Y%m%d'))
+
+
+def _window_days(now=None):
+    today = timezone.localdate(now)
+    return [today - timedelta(days=offset) for offset in range(WINDOW_DAYS)]
+
+
+def record_sales(items, when=None, sign=1, at=None):
+    # items: iterable of (product_id, category_id, quantity). Counts go to the
+    # sorted sets for ranking and to a pending hash that flush_sales_counts
+    # folds into Product.sales_count, so a hot product never has every
+    # checkout queue on its row. when is the order date, which picks the day
+    # board; at is when the change was written, which defaults to when.
+    items = [(product_id, category_id, quantity * sign) for product_id, category_id, quantity in items if quantity]
+    if not items:
+        return
+    day = timezone.localdate(when)
+    day_key = _day_key(day)
+    at = at or when or timezone.now()
+    pending_key = PENDING_SALES_KEY.format(second=int(at.timestamp()))
+    try:
+        # MULTI, so a rebuild swapping the boards sees all of a sale or none of it.
+        pipe = get_redis().pipeline(transaction=True)
+        for product_id, category_id, quantity in items:
+            pipe.zincrby(ALL_TIME_KEY, quantity, product_id)
+            pipe.zincrby(CATEGORY_KEY.format(category_id=category_id), quantity, product_id)
+            pipe.zincrby(day_key, quantity, product_id)
+            pipe.hincrby(pending_key, f'{product_id}:{category_id}:{day.strftime("%Y%m%d")}', quantity)
+        pipe.expire(day_key, DAY_KEY_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording sales in leaderboards: {str(e)}")
+
+
+def top_product_ids(limit=10, category_id=None, window=None):
+    # Returns None when the board is missing or Redis is unreachable so the
+    # caller can fall back to ordering by Product.sales_count.
+    try:
+        connection = get_redis()
+        if window == '7d':
+            key = WEEK_KEY
+            if not connection.exists(key):
+                day_keys = [_day_key(day) for day in _window_days()]
+                pipe = connection.pipeline()
+                pipe.zunionstore(key, day_keys)
+                pipe.expire(key, WEEK_KEY_TTL)
+                pipe.execute()
+        elif category_id:
+            key = CATEGORY_KEY.format(category_id=category_id)
+        else:
+            key = ALL_TIME_KEY
+
+        ids = connection.zrevrangebyscore(key, '+inf', '(0', start=0, num=limit)
+    except Exception as e:
+        logger.error(f"Error reading leaderboard: {str(e)}")
+        return None
+    if not ids:
+        return None
+    return [int(product_id) for product_id in ids]
+
+
+def _take_hash(connection, key):
+    # RENAME is atomic, so increments that land after it start a fresh hash
+    # and are picked up by the next flush instead of being lost. The taken
+    # hash stays in Redis until the values it held are committed (see
+    # _release_on_commit). Returns (taken key, values), or (None, {}) when
+    # nothing was pending.
+    taken = f'{key}{TAKEN_MARK}{int(time.time())}:{uuid.uuid4().hex}'
+    try:
+        connection.rename(key, taken)
+    except ResponseError as e:
+        if 'no such key' not in str(e).lower():
+            raise
+        return None, {}
+    return taken, connection.hgetall(taken)
+
+
+def _is_abandoned(taken):
+    # A taken hash still around after TAKEN_GRACE belongs to a flush that
+    # failed before its database write committed; the next flush applies it.
+    try:
+        taken_at = int(taken.split(TAKEN_MARK, 1)[1].split(':', 1)[0])
+    except (IndexError, ValueError):
+        return True
+    return taken_at <= time.time() - TAKEN_GRACE.total_seconds()
+
+
+def _pending_hashes(connection, pattern, ready=None):
+    # Yields (key, taken key, values) for every pending hash matching pattern,
+    # including ones abandoned by a flush that failed. ready, if given, picks
+    # the hashes that may be taken yet.
+    for key in connection.scan_iter(match=pattern):
+        if TAKEN_MARK in key:
+            # Left by a flush that failed, or taken by one still running.
+            if _is_abandoned(key):
+                yield key.split(TAKEN_MARK, 1)[0], key, connection.hgetall(key)
+            continue
+        if ready is not None and not ready(key):
+            continue
+        taken, values = _take_hash(connection, key)
+        if taken is not None:
+            yield key, taken, values
+
+
+def _release_on_commit(connection, taken):
+    transaction.on_commit(lambda: connection.delete(taken))
+
+
+def _bucket_second(key):
+    return int(key.split(TAKEN_MARK, 1)[0].rsplit(':', 1)[1])
+
+
+def _bucket_deltas(values):
+    deltas = {}
+    for field, delta in values.items():
+        product_id = int(field.split(':', 1)[0])
+        deltas[product_id] = deltas.get(product_id, 0) + int(delta)
+    return {product_id: delta for product_id, delta in deltas.items() if delta}
+
+
+def flush_sales_counts():
+    connection = get_redis()
+    lock = connection.lock(SALES_LOCK_KEY, timeout=SALES_LOCK_TTL)
+    # A rebuild in progress decides which pending sales it already counted.
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        flushed = set()
+        # Unsettled buckets are left for the next rebuild to split at its cutoff.
+        settled = int(time.time()) - SALES_SETTLE
+        pending = _pending_hashes(connection, PENDING_SALES_KEY.format(second='*'),
+                                  ready=lambda key: _bucket_second(key) < settled)
+        for _, taken, values in pending:
+            deltas = _bucket_deltas(values)
+            with transaction.atomic():
+                if deltas:
+                    Product.objects.filter(id__in=deltas).update(
+                        sales_count=F('sales_count') + Case(
+                            *[When(id=product_id, then=delta) for product_id, delta in deltas.items()], default=0
+                        ),
+                        updated_at=timezone.now(),
+                    )
+                _release_on_commit(connection, taken)
+            flushed.update(deltas)
+    finally:
+        lock.release()
+    if flushed:
+        # sales_count is on the detail responses as well as the lists.
+        invalidate_on_commit(invalidate_products, list(flushed))
+        autocomplete_index.changed()
+    return len(flushed)
+
+
+def rebuild_leaderboards():
+    # Rows and pending buckets are split at the same cutoff: sales_count and
+    # the boards are set from the rows before it, whose buckets are dropped,
+    # the boards get the later buckets on top and flush_sales_counts applies
+    # those to sales_count once they settle. The lock keeps flushes out.
+    connection = get_redis()
+    with connection.lock(SALES_LOCK_KEY, timeout=SALES_LOCK_TTL, blocking_timeout=REBUILD_LOCK_WAIT):
+        now = int(time.time())
+        return _rebuild(connection, now - SALES_SETTLE, now)
+
+
+def _settled_sales(cutoff):
+    from order_app.models import OrderItem
+
+    cutoff = datetime.fromtimestamp(cutoff, tz=dt_timezone.utc)
+    # Orders cancelled before cancelled_at existed have none; they are long settled.
+    cancelled = Q(order__delivery_status='cancelled') & (
+        Q(order__cancelled_at__lt=cutoff) | Q(order__cancelled_at__isnull=True)
+    )
+    return OrderItem.objects.filter(order__order_date__lt=cutoff).exclude(cancelled)
+
+
+def _rebuild(connection, cutoff, now):
+    sold = _settled_sales(cutoff)
+
+    all_time = {}
+    by_category = {}
+    for row in sold.values('product_id', 'product__category_id').annotate(quantity=Sum('quantity')).order_by():
+        all_time[row['product_id']] = row['quantity']
+        by_category.setdefault(row['product__category_id'], {})[row['product_id']] = row['quantity']
+
+    window = _window_days()
+    by_day = {}
+    recent = (
+        sold.filter(order__order_date__date__gte=window[-1])
+        .annotate(day=TruncDate('order__order_date'))
+        .values('product_id', 'day')
+        .annotate(quantity=Sum('quantity'))
+        .order_by()
+    )
+    for row in recent:
+        by_day.setdefault(row['day'], {})[row['product_id']] = row['quantity']
+
+    boards = {ALL_TIME_KEY: all_time}
+    for category_id, scores in by_category.items():
+        boards[CATEGORY_KEY.format(category_id=category_id)] = scores
+    for day in window:
+        boards[_day_key(day)] = by_day.get(day, {})
+
+    # Build each board under a scratch key; the swap script renames them in so
+    # readers never see a half-written set.
+    stale = set(connection.scan_iter(match=CATEGORY_KEY.format(category_id='*'))) - set(boards)
+    stale = {key for key in stale if not key.endswith(REBUILD_SUFFIX)}
+    pipe = connection.pipeline()
+    for key, scores in boards.items():
+        pipe.delete(f'{key}{REBUILD_SUFFIX}')
+        if scores:
+            pipe.zadd(f'{key}{REBUILD_SUFFIX}', scores)
+    pipe.execute()
+
+    unsettled = [PENDING_SALES_KEY.format(second=second) for second in range(cutoff, now + SALES_CLOCK_SKEW)]
+    board_keys = list(boards) + list(stale)
+    get_script(SWAP_BOARDS_SCRIPT)(keys=unsettled, args=[len(board_keys), *board_keys, *[_day_key(day) for day in window]])
+
+    pipe = connection.pipeline()
+    for day in window:
+        pipe.expire(_day_key(day), DAY_KEY_TTL)
+    pipe.delete(WEEK_KEY)
+    pipe.execute()
+
+    updated_at = timezone.now()
+    changed = []
+    with transaction.atomic():
+        for product in Product.objects.only('id', 'sales_count').iterator(chunk_size=2000):
+            count = all_time.get(product.id, 0)
+            if product.sales_count != count:
+                product.sales_count = count
+                product.updated_at = updated_at
+                changed.append(product)
+        Product.objects.bulk_update(changed, ['sales_count', 'updated_at'], batch_size=1000)
+        # Whatever is left of the buckets before the cutoff is covered by the
+        # counts just written.
+        for key in connection.scan_iter(match=PENDING_SALES_KEY.format(second='*')):
+            if _bucket_second(key) < cutoff:
+                _release_on_commit(connection, key)
+        if changed:
+            invalidate_on_commit(invalidate_products, [product.id for product in changed])
+    if changed:
+        autocomplete_index.changed()
+    return len(changed)
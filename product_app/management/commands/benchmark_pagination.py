@@ -0,0 +1,60 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from product_app.models import Product, Comment, Rating
+from order_app.models import Order
+from product_app.pagination import KeysetPagination
+
+TARGETS = {
+    'products': (Product, ('price_after_discount', 'id')),
+    'orders': (Order, ('-order_date', '-id')),
+    'comments': (Comment, ('-created_at', '-id')),
+    'ratings': (Rating, ('product_id', 'id')),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare OFFSET page fetches with keyset (cursor) page fetches at increasing depth.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=sorted(TARGETS))
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        model, ordering = TARGETS[options['target']]
+        page_size = options['page_size']
+        queryset = model.objects.order_by(*ordering)
+        total = queryset.count()
+        if not total:
+            raise CommandError(f'No {options["target"]} to paginate.')
+
+        paginator = KeysetPagination()
+        paginator.ordering = ordering
+
+        self.stdout.write(f'{options["target"]}: {total} rows, page size {page_size}')
+        self.stdout.write(f'{"page":>8} {"offset ms":>12} {"keyset ms":>12}')
+        for depth in options['depths']:
+            offset = (depth - 1) * page_size
+            if offset >= total:
+                break
+
+            # The row just before the page is what a client's cursor would carry.
+            position = None
+            if offset:
+                boundary = queryset[offset - 1]
+                position = paginator.get_position(boundary)
+
+            offset_ms = self.time(options['repeat'], lambda: (
+                queryset.count(), list(queryset[offset:offset + page_size])
+            ))
+            keyset_ms = self.time(options['repeat'], lambda: list(
+                (queryset.filter(paginator.build_seek_filter(position)) if position else queryset)[:page_size + 1]
+            ))
+            self.stdout.write(f'{depth:>8} {offset_ms:>12.3f} {keyset_ms:>12.3f}')
+
+    def time(self, repeat, fetch):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fetch()
+        return (time.perf_counter() - start) * 1000 / repeat
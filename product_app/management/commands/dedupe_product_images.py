@@ -0,0 +1,36 @@
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from product_app.models import Product
+from product_app.images import IMAGE_FIELDS, release_unreferenced_images
+from product_app.storage import is_content_addressed
+from product_app.cache import invalidate_product
+from product_app.tasks import generate_image_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Move product images uploaded before content-addressed storage under their content hash and drop duplicates.'
+
+    def handle(self, *args, **options):
+        moved = 0
+        replaced = []
+        for product in Product.objects.iterator(chunk_size=500):
+            updates = {}
+            for field in IMAGE_FIELDS:
+                image = getattr(product, field)
+                if not image or is_content_addressed(image.name):
+                    continue
+                if not image.storage.exists(image.name):
+                    self.stderr.write(f'Product {product.id} {field}: {image.name} is missing, skipped.')
+                    continue
+                with image.storage.open(image.name, 'rb') as source:
+                    updates[field] = image.storage.save(image.name, File(source))
+                replaced.append(image.name)
+
+            if updates:
+                Product.objects.filter(pk=product.pk).update(**updates)
+                invalidate_product(product.pk)
+                generate_image_derivatives.delay(product.pk)
+                moved += len(updates)
+
+        released = release_unreferenced_images(replaced)
+        self.stdout.write(f'Moved {moved} images, deleted {len(released)} legacy files.')
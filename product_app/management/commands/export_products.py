@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from product_app.catalog_io import FORMATS, detect_format, export_rows, write_rows
+from product_app.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Stream the catalog to CSV or JSONL in the same layout import_products reads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Output file, or - for stdout.')
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = detect_format(path, options['format'])
+        rows = export_rows(Product.objects.all(), chunk_size=options['chunk_size'])
+        if path == '-':
+            write_rows(self.stdout, rows, format)
+            return
+        with open(path, 'w', newline='', encoding='utf-8') as stream:
+            write_rows(stream, rows, format)
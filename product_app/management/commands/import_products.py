@@ -0,0 +1,69 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from product_app.catalog_io import FORMATS, RowError, chunked, detect_format, import_chunk, parse_row, read_rows
+from product_app.cache import invalidate_products
+from product_app.search import product_search_index
+from product_app.autocomplete import autocomplete_index
+from product_app.taxonomy import taxonomy
+from product_app.tasks import notify_back_in_stock
+
+
+class Command(BaseCommand):
+    help = 'Upsert products from a CSV or JSONL supplier feed, keyed on slugname, in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Feed to import, or - for stdin.")
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--no-notify', action='store_true', help='Skip the back-in-stock notifications.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = detect_format(path, options['format'])
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+
+        self.invalid_rows = 0
+        created = 0
+        updated = []
+        restocked = []
+        skipped = 0
+        try:
+            for chunk in chunked(self.parsed_rows(stream, format), options['chunk_size']):
+                try:
+                    chunk_created, chunk_updated, chunk_restocked, errors = import_chunk(chunk)
+                except IntegrityError as e:
+                    raise CommandError(f'Import stopped at a chunk starting with {chunk[0]["slugname"]}: {str(e)}')
+                for slugname, message in errors:
+                    self.stderr.write(f'{slugname}: {message}, skipped.')
+                created += chunk_created
+                updated.extend(chunk_updated)
+                restocked.extend(chunk_restocked)
+                skipped += len(errors)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            # Bulk writes bypass the post_save receivers, so caches and the
+            # search index are refreshed once here for whatever was committed.
+            if created or updated:
+                invalidate_products(updated)
+                product_search_index.invalidate()
+                autocomplete_index.changed()
+
+        if restocked and not options['no_notify']:
+            notify_back_in_stock.delay(restocked)
+
+        skipped += self.invalid_rows
+        self.stdout.write(
+            f'Created {created} products, updated {len(updated)}, skipped {skipped}. '
+            f'{len(restocked)} products are back in stock.'
+        )
+
+    def parsed_rows(self, stream, format):
+        tree = taxonomy.get()
+        for number, row in enumerate(read_rows(stream, format), start=1):
+            try:
+                yield parse_row(row, tree)
+            except RowError as e:
+                self.stderr.write(f'Record {number}: {str(e)}, skipped.')
+                self.invalid_rows += 1
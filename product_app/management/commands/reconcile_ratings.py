@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from product_app.models import Product, Rating
+from product_app.cache import invalidate_on_commit, invalidate_products
+
+AGGREGATE_FIELDS = ['rating_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized rating aggregates on Product from the Rating table and fix any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checked = 0
+        drifted = []
+
+        last_id = 0
+        while True:
+            # The chunk's rows stay locked while they are compared and fixed,
+            # so a rating change landing meanwhile applies its delta on top of
+            # the corrected counts instead of being overwritten by them.
+            with transaction.atomic():
+                products = list(
+                    Product.objects.select_for_update().filter(id__gt=last_id).order_by('id')
+                    .only('id', *AGGREGATE_FIELDS)[:chunk_size]
+                )
+                if not products:
+                    break
+                last_id = products[-1].id
+
+                expected = {product.id: dict.fromkeys(AGGREGATE_FIELDS, 0) for product in products}
+                rows = (
+                    Rating.objects.filter(product_id__in=expected)
+                    .values('product_id', 'rating')
+                    .annotate(count=Count('id'))
+                    .order_by()
+                )
+                for row in rows:
+                    fields = expected[row['product_id']]
+                    fields['rating_count'] += row['count']
+                    fields['rating_sum'] += row['rating'] * row['count']
+                    fields[f"rating_{row['rating']}"] = row['count']
+
+                changed = []
+                for product in products:
+                    fields = expected[product.id]
+                    if any(getattr(product, name) != value for name, value in fields.items()):
+                        for name, value in fields.items():
+                            setattr(product, name, value)
+                        changed.append(product)
+                checked += len(products)
+
+                if changed and not options['dry_run']:
+                    Product.objects.bulk_update(changed, AGGREGATE_FIELDS)
+                    invalidate_on_commit(invalidate_products, [product.id for product in changed])
+                drifted.extend(product.id for product in changed)
+
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(f'Checked {checked} products, {len(drifted)} {verb}.')
+        if drifted:
+            self.stdout.write(f'Drifted product ids: {", ".join(map(str, drifted))}')
@@ -0,0 +1,64 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('product_app', 'Product')
+    Rating = apps.get_model('product_app', 'Rating')
+
+    aggregates = {}
+    for row in Rating.objects.values('product_id', 'rating').annotate(count=models.Count('id')).order_by():
+        fields = aggregates.setdefault(row['product_id'], {'rating_count': 0, 'rating_sum': 0})
+        fields['rating_count'] += row['count']
+        fields['rating_sum'] += row['rating'] * row['count']
+        fields[f"rating_{row['rating']}"] = row['count']
+
+    for product_id, fields in aggregates.items():
+        Product.objects.filter(pk=product_id).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:33
+
+import product_app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0005_product_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='image1',
+            field=models.ImageField(blank=True, null=True, storage=product_app.storage.product_image_storage, upload_to='products/images/'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='image2',
+            field=models.ImageField(blank=True, null=True, storage=product_app.storage.product_image_storage, upload_to='products/images/'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='image3',
+            field=models.ImageField(blank=True, null=True, storage=product_app.storage.product_image_storage, upload_to='products/images/'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='image4',
+            field=models.ImageField(blank=True, null=True, storage=product_app.storage.product_image_storage, upload_to='products/images/'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:41
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0006_product_image_content_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='promotion_percentage',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='Promotion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('scope', models.CharField(choices=[('all', 'All products'), ('category', 'Category'), ('subcategory', 'Subcategory'), ('brand', 'Brand')], default='all', max_length=20)),
+                ('brand', models.CharField(blank=True, max_length=50, null=True)),
+                ('percentage', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)])),
+                ('starts_at', models.DateTimeField()),
+                ('ends_at', models.DateTimeField()),
+                ('status', models.CharField(choices=[('scheduled', 'Scheduled'), ('active', 'Active'), ('ended', 'Ended')], default='scheduled', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='product_app.category')),
+                ('subcategory', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='product_app.subcategory')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='promotion',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='promoted_products', to='product_app.promotion'),
+        ),
+        migrations.AddIndex(
+            model_name='promotion',
+            index=models.Index(fields=['status', 'starts_at'], name='promotion_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='promotion',
+            index=models.Index(fields=['status', 'ends_at'], name='promotion_status_end_idx'),
+        ),
+    ]
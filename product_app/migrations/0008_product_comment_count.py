@@ -0,0 +1,33 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_comment_count(apps, schema_editor):
+    Product = apps.get_model('product_app', 'Product')
+    Comment = apps.get_model('product_app', 'Comment')
+    counts = Comment.objects.values('product_id').annotate(count=models.Count('id')).order_by()
+    for row in counts:
+        Product.objects.filter(pk=row['product_id']).update(comment_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0007_promotions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['product', 'created_at', 'id'], name='comment_product_date_idx'),
+        ),
+        migrations.RunPython(backfill_comment_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0008_product_comment_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CooccurrenceProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_order_id', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductCooccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cooccurrences', to='product_app.product')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='product_app.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', '-count'], name='cooccurrence_product_count_idx')],
+                'unique_together': {('product', 'related')},
+            },
+        ),
+    ]
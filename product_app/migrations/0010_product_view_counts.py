@@ -0,0 +1,44 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0009_product_cooccurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='view_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['view_count', 'id'], name='product_views_idx'),
+        ),
+        migrations.AddField(
+            model_name='productdailystats',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='product_app.product'),
+        ),
+        migrations.AddIndex(
+            model_name='productdailystats',
+            index=models.Index(fields=['date', 'product'], name='dailystats_date_product_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productdailystats',
+            unique_together={('product', 'date')},
+        ),
+    ]
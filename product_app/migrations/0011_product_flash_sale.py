@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 07:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0010_product_view_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='flash_sale',
+            field=models.BooleanField(default=False),
+        ),
+    ]
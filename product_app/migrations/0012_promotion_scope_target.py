@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 08:39
+
+from django.db import migrations, models
+
+
+def clear_unused_targets(apps, schema_editor):
+    # products() only ever read the target its scope names; drop the rest.
+    Promotion = apps.get_model('product_app', 'Promotion')
+    Promotion.objects.exclude(scope='category').update(category=None)
+    Promotion.objects.exclude(scope='subcategory').update(subcategory=None)
+    Promotion.objects.exclude(scope='brand').update(brand=None)
+    Promotion.objects.filter(scope='brand', brand='').update(brand=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product_app', '0011_product_flash_sale'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_unused_targets, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='promotion',
+            constraint=models.CheckConstraint(condition=models.Q(models.Q(('brand__isnull', True), ('category__isnull', True), ('scope', 'all'), ('subcategory__isnull', True)), models.Q(('brand__isnull', True), ('category__isnull', False), ('scope', 'category'), ('subcategory__isnull', True)), models.Q(('brand__isnull', True), ('category__isnull', True), ('scope', 'subcategory'), ('subcategory__isnull', False)), models.Q(('brand__isnull', False), ('category__isnull', True), ('scope', 'brand'), ('subcategory__isnull', True), models.Q(('brand', ''), _negated=True)), _connector='OR'), name='promotion_scope_target', violation_error_message='The promotion target must match its scope.'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 from user_app.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
+from .storage import product_image_storage
 
 class Category(models.Model):
     name = models.CharField(max_length=255, null=False, blank=False, unique=True)
@@ -30,6 +32,73 @@ class Rating(models.Model):
     def __str__(self):
         return f'{self.rating} by {self.user}'
 
+class Promotion(models.Model):
+    SCOPE_CHOICES = [
+        ('all', 'All products'),
+        ('category', 'Category'),
+        ('subcategory', 'Subcategory'),
+        ('brand', 'Brand'),
+    ]
+    STATUS_CHOICES = [
+        ('scheduled', 'Scheduled'),
+        ('active', 'Active'),
+        ('ended', 'Ended'),
+    ]
+
+    name = models.CharField(max_length=255)
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES, default='all')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
+    subcategory = models.ForeignKey(Subcategory, on_delete=models.CASCADE, null=True, blank=True)
+    brand = models.CharField(max_length=50, null=True, blank=True)
+    percentage = models.PositiveIntegerField(validators=[MinValueValidator(1), MaxValueValidator(100)])
+    starts_at = models.DateTimeField()
+    ends_at = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='scheduled')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'starts_at'], name='promotion_status_start_idx'),
+            models.Index(fields=['status', 'ends_at'], name='promotion_status_end_idx'),
+        ]
+        constraints = [
+            # Exactly the target the scope names is set; the others stay empty.
+            models.CheckConstraint(
+                condition=(
+                    models.Q(scope='all', category__isnull=True, subcategory__isnull=True, brand__isnull=True)
+                    | models.Q(scope='category', category__isnull=False, subcategory__isnull=True, brand__isnull=True)
+                    | models.Q(scope='subcategory', category__isnull=True, subcategory__isnull=False, brand__isnull=True)
+                    | (models.Q(scope='brand', category__isnull=True, subcategory__isnull=True, brand__isnull=False) & ~models.Q(brand=''))
+                ),
+                name='promotion_scope_target',
+                violation_error_message='The promotion target must match its scope.',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.percentage}%)'
+
+    def clean(self):
+        targets = {'category': self.category_id, 'subcategory': self.subcategory_id, 'brand': self.brand or None}
+        errors = {}
+        for field, value in targets.items():
+            if field == self.scope and value is None:
+                errors[field] = f'Required for a {self.scope} promotion.'
+            elif field != self.scope and value is not None:
+                errors[field] = f'Must be empty for a {self.get_scope_display().lower()} promotion.'
+        if errors:
+            raise ValidationError(errors)
+
+    def products(self):
+        queryset = Product.objects.all()
+        if self.scope == 'category':
+            queryset = queryset.filter(category_id=self.category_id)
+        elif self.scope == 'subcategory':
+            queryset = queryset.filter(subcategory_id=self.subcategory_id)
+        elif self.scope == 'brand':
+            queryset = queryset.filter(brand=self.brand)
+        return queryset
+
 class Product(models.Model):
     name = models.CharField(max_length=255, null=False, blank=False, unique=True)
     description = models.TextField(max_length=2000, null=True, blank=True)
@@ -41,25 +110,60 @@ class Product(models.Model):
         default=0
     )
     price_after_discount = models.PositiveIntegerField(null=True, blank=True)
+    # Set by the promotion engine; the effective discount is the larger of the two.
+    promotion = models.ForeignKey(Promotion, on_delete=models.SET_NULL, null=True, blank=True, related_name='promoted_products')
+    promotion_percentage = models.PositiveIntegerField(default=0)
     stock = models.IntegerField(default=0)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     subcategory = models.ForeignKey(Subcategory, on_delete=models.CASCADE, blank=True, null=True)
 
     pre_order_price=models.PositiveIntegerField(null=True, blank=True)
     pre_order_available = models.BooleanField(default=True)
+    # Limited drops: available stock is counted in Redis while this is on,
+    # see order_app.flash_sale.
+    flash_sale = models.BooleanField(default=False)
 
-    image1 = models.ImageField(upload_to='products/images/', blank=True, null=True)
-    image2 = models.ImageField(upload_to='products/images/', blank=True, null=True)
-    image3 = models.ImageField(upload_to='products/images/', blank=True, null=True)
-    image4 = models.ImageField(upload_to='products/images/', blank=True, null=True)
+    image1 = models.ImageField(upload_to='products/images/', storage=product_image_storage, blank=True, null=True)
+    image2 = models.ImageField(upload_to='products/images/', storage=product_image_storage, blank=True, null=True)
+    image3 = models.ImageField(upload_to='products/images/', storage=product_image_storage, blank=True, null=True)
+    image4 = models.ImageField(upload_to='products/images/', storage=product_image_storage, blank=True, null=True)
 
     thumbnail = models.ImageField(upload_to='products/thumbnails/', blank=True)
+    image_variants = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     sales_count = models.IntegerField(default=0)
 
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    view_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['view_count', 'id'], name='product_views_idx'),
+            models.Index(fields=['category', 'price_after_discount'], name='product_category_price_idx'),
+            models.Index(fields=['subcategory', 'price_after_discount'], name='product_subcat_price_idx'),
+            models.Index(fields=['price_after_discount', 'id'], name='product_price_id_idx'),
+        ]
+
     def __str__(self):
         return self.name
+
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return None
+        return round(self.rating_sum / self.rating_count, 2)
+
+    @property
+    def rating_histogram(self):
+        return {star: getattr(self, f'rating_{star}') for star in range(1, 6)}
     
     
     def get_image_urls(self, request):
@@ -76,11 +180,60 @@ class Product(models.Model):
             urls.append(request.build_absolute_uri(self.image4.url))
         return urls
 
+    def get_image_srcset(self, request):
+        from .images import IMAGE_FIELDS, srcset_for
+        if not request:
+            return []
+        images = []
+        for field in IMAGE_FIELDS:
+            image = getattr(self, field)
+            if not image:
+                continue
+            entry = {'original': request.build_absolute_uri(image.url)}
+            entry.update(srcset_for(self.image_variants.get(field, {}), request))
+            images.append(entry)
+        return images
+
 class Comment(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='comments', null=False, blank=False)
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     text = models.TextField(max_length=200, null=False, blank=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at', 'id'], name='comment_product_date_idx'),
+        ]
+
     def __str__(self):
-        return f'Comment by {self.owner} on {self.product}'
\ No newline at end of file
+        return f'Comment by {self.owner} on {self.product}'
+
+class ProductDailyStats(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'date')
+        indexes = [
+            models.Index(fields=['date', 'product'], name='dailystats_date_product_idx'),
+        ]
+
+class ProductCooccurrence(models.Model):
+    # How many orders contained both products; stored in both directions so
+    # the neighbours of a product are one index range scan.
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='cooccurrences')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'related')
+        indexes = [
+            models.Index(fields=['product', '-count'], name='cooccurrence_product_count_idx'),
+        ]
+
+class CooccurrenceProgress(models.Model):
+    # Highest order id already folded into ProductCooccurrence.
+    name = models.CharField(max_length=50, unique=True)
+    last_order_id = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
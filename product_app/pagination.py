@@ -0,0 +1,158 @@
+import base64
+import binascii
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+# Seeks past the last row of the previous page instead of COUNT + OFFSET, so
+# every page costs the same however deep it is. The ordering must end in a
+# unique field (id) so ties on the other fields still have a strict position.
+# NULLs in a nullable field sort last in either direction.
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    ordering = ('-id',)
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(view)
+        self.fields = [self.get_model_field(queryset.model, field.lstrip('-')) for field in self.ordering]
+        queryset = queryset.order_by(*self.build_ordering())
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.build_seek_filter(position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_ordering(self, view):
+        if view is not None and hasattr(view, 'get_keyset_ordering'):
+            return tuple(view.get_keyset_ordering())
+        return tuple(getattr(view, 'keyset_ordering', self.ordering))
+
+    def get_model_field(self, model, name):
+        *path, name = name.split('__')
+        for part in path:
+            model = model._meta.get_field(part).related_model
+        return model._meta.get_field(name)
+
+    def build_ordering(self):
+        # Backends disagree on where NULLs go, so nullable fields say it.
+        ordering = []
+        for field, model_field in zip(self.ordering, self.fields):
+            if not model_field.null:
+                ordering.append(field)
+            elif field.startswith('-'):
+                ordering.append(F(field[1:]).desc(nulls_last=True))
+            else:
+                ordering.append(F(field).asc(nulls_last=True))
+        return ordering
+
+    def build_seek_filter(self, position):
+        seek = Q()
+        equal = Q()
+        for field, model_field, value in zip(self.ordering, self.fields, position):
+            name = field.lstrip('-')
+            if value is None:
+                # Only other NULLs come after a NULL, ordered by the later fields.
+                equal &= Q(**{f'{name}__isnull': True})
+                continue
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            after = Q(**{f'{name}__{lookup}': value})
+            if model_field.null:
+                after |= Q(**{f'{name}__isnull': True})
+            seek |= equal & after
+            equal &= Q(**{name: value})
+        return seek
+
+    def get_position(self, obj):
+        position = []
+        for field in self.ordering:
+            value = obj
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            position.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return position
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError(position)
+            return [self.to_python(model_field, value) for model_field, value in zip(self.fields, position)]
+        except (TypeError, ValueError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def to_python(self, model_field, value):
+        # A cursor is client input: a value the field cannot take would
+        # otherwise only fail once the filter runs.
+        if value is None:
+            if not model_field.null:
+                raise ValueError(value)
+            return None
+        if isinstance(value, (list, dict)):
+            raise ValueError(value)
+        return model_field.to_python(value)
+
+    def encode_cursor(self, position):
+        encoded = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]))
+
+    def get_first_link(self):
+        url = self.request.build_absolute_uri()
+        return remove_query_param(url, self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+# Existing clients keep page-number pagination; requests opt in to keyset
+# pagination with ?pagination=cursor or by following a cursor link.
+class KeysetPaginationMixin:
+    keyset_pagination_class = KeysetPagination
+
+    def use_keyset_pagination(self):
+        if self.request is None:
+            return False
+        params = self.request.query_params
+        return 'cursor' in params or params.get('pagination') == 'cursor'
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.use_keyset_pagination():
+            self._paginator = self.keyset_pagination_class()
+        return super().paginator
@@ -23,4 +23,5 @@ class IsOwnerOrAdmin(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return request.user.is_staff or obj.owner == request.user
\ No newline at end of file
+        owner = obj.owner if hasattr(obj, 'owner') else obj.user
+        return request.user.is_staff or owner == request.user
\ No newline at end of file
@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime, timedelta
+from django.db import transaction
+from django.db.models import Case, F, Sum, When
+from django.utils import timezone
+from SilverShop.redis_client import get_redis
+from .models import Product, ProductDailyStats
+from .leaderboard import _pending_hashes, _release_on_commit
+
+logger = logging.getLogger(__name__)
+
+PENDING_VIEWS_KEY = 'views:pending:{day}'
+# Buckets normally go at the next flush; the TTL only guards against a
+# flusher that stopped running.
+PENDING_VIEWS_TTL = 60 * 60 * 24 * 3
+# Held by a flush of view counts, so a slow one never has its taken hashes
+# picked up as abandoned by the next.
+VIEWS_LOCK_KEY = 'views:lock'
+VIEWS_LOCK_TTL = 60 * 30
+
+
+def _pending_key(day):
+    return PENDING_VIEWS_KEY.format(day=day.strftime('%Y%m%d'))
+
+
+def record_view(product_id, when=None):
+    # Views are buffered per day in Redis and folded into the database by
+    # flush_view_counts, so a popular product never serializes requests on its row.
+    key = _pending_key(timezone.localdate(when))
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hincrby(key, product_id, 1)
+        pipe.expire(key, PENDING_VIEWS_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording product view: {str(e)}")
+
+
+def _apply_day(day, deltas):
+    with transaction.atomic():
+        Product.objects.filter(id__in=deltas).update(
+            view_count=F('view_count') + Case(*[When(id=product_id, then=delta) for product_id, delta in deltas.items()], default=0)
+        )
+
+        existing = {
+            stats.product_id: stats
+            for stats in ProductDailyStats.objects.select_for_update().filter(date=day, product_id__in=deltas)
+        }
+        changed = []
+        for product_id, stats in existing.items():
+            stats.views += deltas[product_id]
+            changed.append(stats)
+        ProductDailyStats.objects.bulk_update(changed, ['views'])
+        live = set(Product.objects.filter(id__in=set(deltas) - set(existing)).values_list('id', flat=True))
+        ProductDailyStats.objects.bulk_create([
+            ProductDailyStats(product_id=product_id, date=day, views=deltas[product_id]) for product_id in live
+        ])
+
+
+def flush_view_counts():
+    # View counts are allowed to lag in cached responses until those expire;
+    # bumping the list version every flush would empty the product cache.
+    connection = get_redis()
+    lock = connection.lock(VIEWS_LOCK_KEY, timeout=VIEWS_LOCK_TTL)
+    if not lock.acquire(blocking=False):
+        return 0
+    flushed = 0
+    try:
+        for key, taken, values in _pending_hashes(connection, PENDING_VIEWS_KEY.format(day='*')):
+            deltas = {int(product_id): int(delta) for product_id, delta in values.items()}
+            deltas = {product_id: delta for product_id, delta in deltas.items() if delta > 0}
+            day = datetime.strptime(key.rsplit(':', 1)[1], '%Y%m%d').date()
+            with transaction.atomic():
+                if deltas:
+                    _apply_day(day, deltas)
+                _release_on_commit(connection, taken)
+            flushed += len(deltas)
+    finally:
+        lock.release()
+    return flushed
+
+
+def most_viewed_ids(limit=10, category_id=None, days=None):
+    if days:
+        since = timezone.localdate() - timedelta(days=days - 1)
+        rows = ProductDailyStats.objects.filter(date__gte=since)
+        if category_id:
+            rows = rows.filter(product__category_id=category_id)
+        rows = rows.values('product_id').annotate(views=Sum('views')).order_by('-views', 'product_id')
+        return [row['product_id'] for row in rows[:limit]]
+
+    queryset = Product.objects.filter(view_count__gt=0)
+    if category_id:
+        queryset = queryset.filter(category_id=category_id)
+    return list(queryset.order_by('-view_count', '-id').values_list('id', flat=True)[:limit])
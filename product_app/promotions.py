@@ -0,0 +1,63 @@
+import logging
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import Product, Promotion
+from .cache import invalidate_all_products
+from .utils import price_expressions
+
+logger = logging.getLogger(__name__)
+
+
+def apply_promotion(promotion, now=None):
+    # One UPDATE over the promotion's scope. Products already under a promotion
+    # at least as deep keep it, so overlapping promotions resolve to the best one.
+    percentage = Value(promotion.percentage)
+    return promotion.products().filter(promotion_percentage__lt=promotion.percentage).update(
+        promotion=promotion,
+        promotion_percentage=percentage,
+        updated_at=now or timezone.now(),
+        **price_expressions(Greatest(F('discount_percentage'), percentage)),
+    )
+
+
+def revert_promotion(promotion, now=None):
+    return Product.objects.filter(promotion=promotion).update(
+        promotion=None,
+        promotion_percentage=0,
+        updated_at=now or timezone.now(),
+        **price_expressions(F('discount_percentage')),
+    )
+
+
+def run_promotions(now=None):
+    # Ends expired promotions, starts due ones and re-applies the remaining
+    # active ones where an ended promotion left products uncovered. Caches
+    # are dropped once for the whole run instead of once per product.
+    now = now or timezone.now()
+    expired = list(Promotion.objects.filter(status__in=['scheduled', 'active'], ends_at__lte=now))
+    due = list(Promotion.objects.filter(status='scheduled', starts_at__lte=now, ends_at__gt=now))
+    if not expired and not due:
+        return 0
+
+    changed = 0
+    with transaction.atomic():
+        for promotion in expired:
+            changed += revert_promotion(promotion, now)
+            promotion.status = 'ended'
+            promotion.save(update_fields=['status'])
+            logger.info(f"Ended promotion {promotion.id}")
+
+        for promotion in due:
+            promotion.status = 'active'
+            promotion.save(update_fields=['status'])
+            logger.info(f"Started promotion {promotion.id}")
+
+        active = Promotion.objects.filter(status='active') if expired else Promotion.objects.filter(id__in=[p.id for p in due])
+        for promotion in active.order_by('-percentage'):
+            changed += apply_promotion(promotion, now)
+
+    if changed:
+        transaction.on_commit(invalidate_all_products)
+    return changed
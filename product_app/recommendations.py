@@ -0,0 +1,107 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import permutations
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Product, ProductCooccurrence, CooccurrenceProgress
+from .cache import invalidate_related
+
+logger = logging.getLogger(__name__)
+
+RELATED_LIMIT = 10
+ORDER_BATCH_SIZE = 1000
+# Orders younger than this are left for the next run, so one that commits
+# after a higher id was already scanned is not skipped for good.
+SETTLE_DELAY = timedelta(seconds=getattr(settings, 'COOCCURRENCE_SETTLE_SECONDS', 300))
+PROGRESS_NAME = 'orders'
+
+
+def basket_pairs(baskets):
+    pairs = Counter()
+    for products in baskets.values():
+        pairs.update(permutations(sorted(products), 2))
+    return pairs
+
+
+def _apply_pairs(pairs):
+    product_ids = {product_id for product_id, _ in pairs}
+    existing = {
+        (row.product_id, row.related_id): row
+        for row in ProductCooccurrence.objects.select_for_update().filter(
+            product_id__in=product_ids, related_id__in=product_ids
+        )
+    }
+    changed = []
+    new = []
+    for (product_id, related_id), count in pairs.items():
+        row = existing.get((product_id, related_id))
+        if row is None:
+            new.append(ProductCooccurrence(product_id=product_id, related_id=related_id, count=count))
+        else:
+            row.count += count
+            changed.append(row)
+    ProductCooccurrence.objects.bulk_create(new, batch_size=1000)
+    ProductCooccurrence.objects.bulk_update(changed, ['count'], batch_size=1000)
+
+
+def update_cooccurrences(now=None, batch_size=ORDER_BATCH_SIZE):
+    # Folds orders placed since the previous run into the pair counts. Each
+    # batch commits together with the progress marker, so a crash never
+    # counts an order twice.
+    from order_app.models import Order, OrderItem
+
+    cutoff = (now or timezone.now()) - SETTLE_DELAY
+    processed = 0
+    while True:
+        with transaction.atomic():
+            progress, _ = CooccurrenceProgress.objects.select_for_update().get_or_create(name=PROGRESS_NAME)
+            order_ids = list(
+                Order.objects.filter(id__gt=progress.last_order_id, order_date__lt=cutoff)
+                .order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+
+            baskets = defaultdict(set)
+            items = (
+                OrderItem.objects.filter(order_id__in=order_ids)
+                .exclude(order__delivery_status='cancelled')
+                .values_list('order_id', 'product_id')
+            )
+            for order_id, product_id in items:
+                baskets[order_id].add(product_id)
+
+            pairs = basket_pairs(baskets)
+            if pairs:
+                _apply_pairs(pairs)
+            progress.last_order_id = order_ids[-1]
+            progress.save(update_fields=['last_order_id', 'updated_at'])
+        processed += len(order_ids)
+
+    if processed:
+        invalidate_related()
+    return processed
+
+
+def related_products(product, limit=RELATED_LIMIT):
+    # Neighbours by co-occurrence first, then best sellers of the same
+    # subcategory (or category) to fill the remaining slots.
+    related_ids = list(
+        ProductCooccurrence.objects.filter(product=product)
+        .order_by('-count', 'related_id')
+        .values_list('related_id', flat=True)[:limit]
+    )
+    if len(related_ids) < limit:
+        fallback = Product.objects.exclude(id__in=[product.id, *related_ids])
+        if product.subcategory_id:
+            fallback = fallback.filter(subcategory_id=product.subcategory_id)
+        else:
+            fallback = fallback.filter(category_id=product.category_id)
+        related_ids += list(
+            fallback.order_by('-sales_count', 'id').values_list('id', flat=True)[:limit - len(related_ids)]
+        )
+
+    products = Product.objects.defer('description').in_bulk(related_ids)
+    return [products[product_id] for product_id in related_ids if product_id in products]
@@ -0,0 +1,181 @@
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from .cache import IncrementalIndex
+from .models import Product
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+FIELD_WEIGHTS = {'name': 3.0, 'brand': 2.0, 'description': 1.0}
+
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.7
+FUZZY_MATCH = 0.5
+
+# Tokens shorter than this are only matched exactly or by prefix; one edit on a
+# three letter word matches too much of the vocabulary to be useful.
+MIN_FUZZY_LENGTH = 4
+
+# ?search= on the product list keeps this many best ranked matches before
+# its own ordering and pagination; the response says when it was cut.
+MAX_RESULTS = 1000
+# Searches that only narrow another table (ratings by product) keep the best
+# ranked products, which keeps their IN list short.
+FILTER_RESULTS = 100
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.casefold())
+
+
+def search_text(product):
+    # The fields the index is built from; a save that leaves them alone does
+    # not need a rebuild.
+    return product.name, product.brand, product.description
+
+
+def deletions(token):
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def fuzzy_keys(term):
+    if len(term) < MIN_FUZZY_LENGTH:
+        return set()
+    return deletions(term) | {term}
+
+
+def document_weights(name, brand, description):
+    weights = {}
+    for field, text in (('name', name), ('brand', brand), ('description', description)):
+        for token in tokenize(text):
+            weights[token] = weights.get(token, 0) + FIELD_WEIGHTS[field]
+    return weights
+
+
+class SearchData:
+    # Once published to readers a SearchData is never changed: updates go to
+    # a copy() that replaces it, and replace every posting or deletes set
+    # they touch instead of mutating it.
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.terms = []
+        self.deletes = defaultdict(set)
+        self.synced_at = None
+        self.changes_version = None
+
+    def copy(self):
+        patched = SearchData()
+        patched.postings = defaultdict(dict, self.postings)
+        patched.documents = dict(self.documents)
+        patched.terms = list(self.terms)
+        patched.deletes = defaultdict(set, self.deletes)
+        return patched
+
+    def add(self, product_id, name, brand, description):
+        # Bulk path: finalize() sorts the terms once everything is in.
+        weights = document_weights(name, brand, description)
+        for term, weight in weights.items():
+            self.postings[term][product_id] = weight
+        self.documents[product_id] = tuple(weights)
+
+    def finalize(self):
+        self.terms = sorted(self.postings)
+        for term in self.terms:
+            for key in fuzzy_keys(term):
+                self.deletes[key].add(term)
+
+    def upsert(self, product_id, name, brand, description):
+        self.remove(product_id)
+        weights = document_weights(name, brand, description)
+        for term, weight in weights.items():
+            if term not in self.postings:
+                insort(self.terms, term)
+                for key in fuzzy_keys(term):
+                    self.deletes[key] = self.deletes.get(key, set()) | {term}
+            self.postings[term] = {**self.postings.get(term, {}), product_id: weight}
+        self.documents[product_id] = tuple(weights)
+
+    def remove(self, product_id):
+        for term in self.documents.pop(product_id, ()):
+            weights = {key: weight for key, weight in self.postings[term].items() if key != product_id}
+            if weights:
+                self.postings[term] = weights
+                continue
+            del self.postings[term]
+            del self.terms[bisect_left(self.terms, term)]
+            for key in fuzzy_keys(term):
+                terms = self.deletes[key] - {term}
+                if terms:
+                    self.deletes[key] = terms
+                else:
+                    del self.deletes[key]
+
+    def expand(self, token):
+        # Maps index terms that can stand in for the query token to how well
+        # they match it: exact, as a completion of the prefix, or within one edit.
+        matches = {}
+        start = bisect_left(self.terms, token)
+        for term in self.terms[start:]:
+            if not term.startswith(token):
+                break
+            matches[term] = EXACT_MATCH if term == token else PREFIX_MATCH
+
+        if len(token) >= MIN_FUZZY_LENGTH:
+            for variant in deletions(token) | {token}:
+                for term in self.deletes.get(variant, ()):
+                    matches.setdefault(term, FUZZY_MATCH)
+        return matches
+
+    def search(self, query, limit=MAX_RESULTS):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        scores = None
+        for token in tokens:
+            token_scores = defaultdict(float)
+            for term, quality in self.expand(token).items():
+                for product_id, weight in self.postings[term].items():
+                    token_scores[product_id] = max(token_scores[product_id], weight * quality)
+
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {product_id: score + token_scores[product_id]
+                          for product_id, score in scores.items() if product_id in token_scores}
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, score in ranked[:limit]]
+
+
+def _search_rows(queryset):
+    return queryset.values_list('id', 'name', 'brand', 'description').iterator(chunk_size=2000)
+
+
+class ProductSearchIndex(IncrementalIndex):
+    version_key = 'products:search:version'
+    changes_key = 'products:search:changes'
+
+    def load(self):
+        data = SearchData()
+        for row in _search_rows(Product.objects.all()):
+            data.add(*row)
+        data.finalize()
+        return data
+
+    def patch(self, data, since):
+        patched = data.copy()
+        for row in _search_rows(Product.objects.filter(updated_at__gte=since)):
+            patched.upsert(*row)
+        return patched
+
+    def search(self, query, limit=MAX_RESULTS):
+        return self.get().search(query, limit)
+
+
+product_search_index = ProductSearchIndex()
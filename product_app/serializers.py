@@ -16,17 +16,51 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = ['id', 'name', 'slugname', 'sub_categories']
 
-class ProductSerializer(serializers.ModelSerializer):
+def parse_field_list(value):
+    if not value:
+        return []
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+class DynamicFieldsMixin:
+    # fields= keeps only the named fields; expand= adds fields on top of
+    # Meta.default_fields, the set a serializer returns when nothing is asked for.
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+
+        default_fields = getattr(self.Meta, 'default_fields', None)
+        if fields:
+            keep = set(fields)
+        elif default_fields is not None:
+            keep = set(default_fields)
+        else:
+            keep = None
+        if keep is not None:
+            keep.update(expand or [])
+            for name in set(self.fields) - keep:
+                if not self.fields[name].write_only:
+                    self.fields.pop(name)
+
+
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     images = serializers.ListField(
         child=serializers.ImageField(max_length=100000, allow_empty_file=False, use_url=True),
         write_only=True,
         required=False
     )
     images_list = serializers.SerializerMethodField()
+    images_srcset = serializers.SerializerMethodField()
+    average_rating = serializers.FloatField(read_only=True)
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
     class Meta:
         model = Product
         fields = '__all__'
-        read_only_fields = ["id", "created_at", "updated_at"]
+        read_only_fields = ["id", "created_at", "updated_at", "rating_count", "rating_sum",
+                            "rating_1", "rating_2", "rating_3", "rating_4", "rating_5",
+                            "thumbnail", "image_variants", "promotion", "promotion_percentage",
+                            "comment_count", "view_count"]
 
     def get_images_list(self, obj):
         request = self.context.get('request')
@@ -34,6 +68,9 @@ class ProductSerializer(serializers.ModelSerializer):
             return []
         return obj.get_image_urls(request)
 
+    def get_images_srcset(self, obj):
+        return obj.get_image_srcset(self.context.get('request'))
+
     def create(self, validated_data):
         images = validated_data.pop('images', None)
         product = Product.objects.create(**validated_data)
@@ -74,6 +111,16 @@ class ProductSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+class ProductListSerializer(ProductSerializer):
+    # Compact representation for list endpoints and for products nested in
+    # carts, orders and wishlists; ?expand= brings back anything else.
+    class Meta(ProductSerializer.Meta):
+        default_fields = [
+            'id', 'name', 'slugname', 'brand', 'price', 'discount_percentage', 'price_after_discount',
+            'pre_order_price', 'pre_order_available', 'flash_sale', 'stock', 'category', 'subcategory', 'thumbnail',
+            'promotion_percentage', 'average_rating', 'rating_count', 'comment_count',
+        ]
+
 class CommentSerializer(serializers.ModelSerializer):
     owner_name = serializers.SerializerMethodField()
     owner_email = serializers.SerializerMethodField()
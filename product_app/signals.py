@@ -1,31 +1,38 @@
 import logging
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.db import transaction
+from django.db.models import F
 from django.dispatch import receiver
-from .models import Product
-from .utils import notify_users
+from .models import Product, Category, Subcategory, Promotion, Comment
+from .utils import notify_users, compute_prices
+from .cache import (
+    invalidate_on_commit, invalidate_product, invalidate_product_lists, invalidate_all_products, invalidate_comments,
+)
+from .search import product_search_index, search_text
+from .taxonomy import taxonomy
+from .autocomplete import autocomplete_index
+from .images import IMAGE_FIELDS, IMAGE_RELEASE_GRACE
 
 logger = logging.getLogger(__name__)
 
 @receiver(pre_save, sender=Product)
 def calculate_prices(sender, instance, **kwargs):
     if instance.price is not None:
-        if instance.discount_percentage is not None and instance.discount_percentage > 0:
-            discount = instance.discount_percentage / 100
-            instance.price_after_discount = instance.price * (1 - discount)
-        else:
-            instance.price_after_discount = instance.price
+        instance.price_after_discount, instance.pre_order_price = compute_prices(
+            instance.price, instance.discount_percentage, instance.promotion_percentage
+        )
         logger.info(f"Calculated price after discount for product {instance.id}: {instance.price_after_discount}")
-    
-    if instance.price is not None:
-        instance.pre_order_price = instance.price_after_discount * 0.25
         logger.info(f"Calculated pre-order price for product {instance.id}: {instance.pre_order_price}")
         
 @receiver(pre_save, sender=Product)
 def product_stock_update(sender, instance, **kwargs):
+    instance._old_images = {}
     if instance.pk:
         try:
             old_product = Product.objects.get(pk=instance.pk)
             instance._old_stock = old_product.stock  
+            instance._old_images = {field: getattr(old_product, field).name for field in IMAGE_FIELDS}
+            instance._old_search_text = search_text(old_product)
         except Product.DoesNotExist:
             instance._old_stock = None
     else:
@@ -43,4 +50,72 @@ def notify_stock_update(sender, instance, **kwargs):
         else:
             logger.info(f"No stock change from 0 to positive for product {instance.id}")
     else:
-        logger.info(f"New product {instance.id} created with stock {instance.stock}")
\ No newline at end of file
+        logger.info(f"New product {instance.id} created with stock {instance.stock}")
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    invalidate_on_commit(invalidate_product, instance.pk)
+    if kwargs['signal'] is post_delete:
+        # The indexes only patch in rows they can still read.
+        invalidate_on_commit(product_search_index.invalidate)
+        invalidate_on_commit(autocomplete_index.invalidate)
+        return
+    # Saves that leave the indexed text alone leave the search index alone.
+    if getattr(instance, '_old_search_text', None) != search_text(instance):
+        invalidate_on_commit(product_search_index.changed)
+    invalidate_on_commit(autocomplete_index.changed)
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Subcategory)
+@receiver(post_delete, sender=Subcategory)
+def invalidate_taxonomy_cache(sender, instance, **kwargs):
+    invalidate_on_commit(invalidate_product_lists)
+    invalidate_on_commit(taxonomy.invalidate)
+    invalidate_on_commit(autocomplete_index.invalidate)
+
+
+@receiver(post_save, sender=Product)
+def schedule_image_derivatives(sender, instance, **kwargs):
+    from .tasks import generate_image_derivatives
+    old_images = getattr(instance, '_old_images', {})
+    current = {field: getattr(instance, field).name for field in IMAGE_FIELDS}
+    if any(current[field] != old_images.get(field) for field in IMAGE_FIELDS if current[field] or old_images.get(field)):
+        transaction.on_commit(lambda: generate_image_derivatives.delay(instance.pk), robust=True)
+
+    replaced = [name for name in old_images.values() if name and name not in current.values()]
+    if replaced:
+        transaction.on_commit(lambda: schedule_image_release(replaced), robust=True)
+
+def schedule_image_release(names):
+    # Deferred rather than run on commit, so references are counted again
+    # after identical uploads still in flight have committed.
+    from .tasks import release_unreferenced_product_images
+    release_unreferenced_product_images.apply_async((names,), countdown=IMAGE_RELEASE_GRACE)
+
+@receiver(post_delete, sender=Product)
+def release_product_images(sender, instance, **kwargs):
+    names = [getattr(instance, field).name for field in IMAGE_FIELDS if getattr(instance, field)]
+    if names:
+        transaction.on_commit(lambda: schedule_image_release(names), robust=True)
+
+@receiver(pre_delete, sender=Promotion)
+def revert_deleted_promotion(sender, instance, **kwargs):
+    # SET_NULL alone would leave the promoted prices behind.
+    from .promotions import revert_promotion
+    if revert_promotion(instance):
+        invalidate_on_commit(invalidate_all_products)
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    if created:
+        Product.objects.filter(pk=instance.product_id).update(comment_count=F('comment_count') + 1)
+        invalidate_on_commit(invalidate_product, instance.product_id)
+    invalidate_on_commit(invalidate_comments, instance.product_id)
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id, comment_count__gt=0).update(comment_count=F('comment_count') - 1)
+    invalidate_on_commit(invalidate_product, instance.product_id)
+    invalidate_on_commit(invalidate_comments, instance.product_id)
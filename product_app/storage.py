@@ -0,0 +1,59 @@
+import hashlib
+import os
+import re
+import tempfile
+from django.core.files.storage import FileSystemStorage
+
+HASH_NAME_RE = re.compile(r'(^|/)[0-9a-f]{64}(/|\.|$)')
+
+
+def is_content_addressed(name):
+    return bool(HASH_NAME_RE.search(name))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    # Stores each upload under the SHA-256 of its bytes, e.g.
+    # products/images/3f/3f9a...c1.jpg. The digest is computed while the
+    # upload streams to a temp file in the target directory, so nothing is
+    # read into memory whole and an identical upload resolves to the file
+    # that is already there instead of a renamed copy.
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content is hashed in _save.
+        return name
+
+    def _save(self, name, content):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        staging_dir = self.path(directory)
+        os.makedirs(staging_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        handle, staging_path = tempfile.mkstemp(dir=staging_dir, suffix='.upload')
+        try:
+            with os.fdopen(handle, 'wb') as staging:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    staging.write(chunk)
+
+            hexdigest = digest.hexdigest()
+            final_name = f'{directory}/{hexdigest[:2]}/{hexdigest}{extension}' if directory else f'{hexdigest[:2]}/{hexdigest}{extension}'
+            final_path = self.path(final_name)
+            if os.path.exists(final_path):
+                os.remove(staging_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(staging_path, final_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(final_path, self.file_permissions_mode)
+            return final_name
+        except BaseException:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+            raise
+
+
+def product_image_storage():
+    return ContentAddressedStorage()
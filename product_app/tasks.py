@@ -0,0 +1,70 @@
+import logging
+from celery import shared_task
+from django.utils import timezone
+from .leaderboard import flush_sales_counts, rebuild_leaderboards
+from .models import Product
+from .images import refresh_product_images, release_unreferenced_images
+from .utils import notify_users_in_bulk
+from .promotions import run_promotions
+from .recommendations import update_cooccurrences
+from .popularity import flush_view_counts
+from .cache import invalidate_product
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def flush_sales_counters():
+    flushed = flush_sales_counts()
+    logger.info(f"Flushed pending sales counts for {flushed} products")
+
+
+@shared_task
+def rebuild_sales_leaderboards():
+    changed = rebuild_leaderboards()
+    logger.info(f"Rebuilt sales leaderboards, corrected sales_count on {changed} products")
+
+
+@shared_task
+def generate_image_derivatives(product_id):
+    try:
+        product = Product.objects.get(pk=product_id)
+    except Product.DoesNotExist:
+        logger.warning(f"Product {product_id} was deleted before its images were processed")
+        return
+
+    changed, thumbnail, variants = refresh_product_images(product)
+    if changed:
+        # update() keeps this write from re-triggering the post_save receivers.
+        Product.objects.filter(pk=product_id).update(thumbnail=thumbnail, image_variants=variants, updated_at=timezone.now())
+        invalidate_product(product_id)
+
+
+@shared_task
+def release_unreferenced_product_images(names):
+    released = release_unreferenced_images(names)
+    if released:
+        logger.info(f"Deleted {len(released)} unreferenced product images")
+
+
+@shared_task
+def notify_back_in_stock(product_ids):
+    notify_users_in_bulk(product_ids)
+
+
+@shared_task
+def activate_promotions():
+    changed = run_promotions()
+    logger.info(f"Promotions run repriced {changed} product rows")
+
+
+@shared_task
+def update_product_cooccurrences():
+    processed = update_cooccurrences()
+    logger.info(f"Folded {processed} orders into product co-occurrence counts")
+
+
+@shared_task
+def flush_view_counters():
+    flushed = flush_view_counts()
+    logger.info(f"Flushed pending view counts for {flushed} products")
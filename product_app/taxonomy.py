@@ -0,0 +1,68 @@
+from .cache import LocalIndex
+from .models import Category, Subcategory
+
+
+class Taxonomy:
+    def __init__(self, categories, subcategories):
+        self.categories = {}
+        self.subcategories = {}
+        self.category_slugs = {}
+        self.subcategory_slugs = {}
+        self.children = {}
+
+        for category_id, name, slugname in categories:
+            self.categories[category_id] = {'id': category_id, 'name': name, 'slugname': slugname}
+            self.category_slugs[slugname] = category_id
+            self.children[category_id] = []
+
+        for subcategory_id, name, slugname, category_id in subcategories:
+            category = self.categories.get(category_id)
+            self.subcategories[subcategory_id] = {
+                'id': subcategory_id,
+                'name': name,
+                'category': category_id,
+                'category_name': category['name'] if category else None,
+                'slugname': slugname,
+            }
+            self.subcategory_slugs[slugname] = subcategory_id
+            self.children.setdefault(category_id, []).append(subcategory_id)
+
+    def has_category(self, category_id):
+        return _as_id(category_id) in self.categories
+
+    def has_subcategory(self, subcategory_id):
+        return _as_id(subcategory_id) in self.subcategories
+
+    def category_by_slug(self, slugname):
+        return self.categories.get(self.category_slugs.get(slugname))
+
+    def subcategory_by_slug(self, slugname):
+        return self.subcategories.get(self.subcategory_slugs.get(slugname))
+
+    def category_node(self, category_id):
+        # Same shape as CategorySerializer, so the tree can be returned as is.
+        node = dict(self.categories[category_id])
+        node['sub_categories'] = [dict(self.subcategories[child]) for child in self.children.get(category_id, [])]
+        return node
+
+    def tree(self):
+        return [self.category_node(category_id) for category_id in sorted(self.categories)]
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TaxonomyIndex(LocalIndex):
+    version_key = 'taxonomy:version'
+
+    def build(self):
+        categories = Category.objects.order_by('id').values_list('id', 'name', 'slugname')
+        subcategories = Subcategory.objects.order_by('id').values_list('id', 'name', 'slugname', 'category_id')
+        return Taxonomy(list(categories), list(subcategories))
+
+
+taxonomy = TaxonomyIndex()
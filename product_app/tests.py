@@ -1,8 +1,44 @@
-from django.test import TestCase
+import base64
+import json
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from PIL import Image
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase, APIRequestFactory
+from unittest import skipUnless
 from unittest.mock import patch
-from .models import Product, Category
-from .utils import send_sms, notify_users
-from order_app.models import WishlistItem, Wishlist
+from .models import Product, Category, Subcategory, Rating, Promotion, Comment, ProductCooccurrence, ProductDailyStats
+from .utils import send_sms, notify_users, notify_users_in_bulk
+from .cache import get_version
+from .search import product_search_index, ProductSearchIndex
+from .autocomplete import autocomplete_index
+from .promotions import run_promotions
+from .recommendations import update_cooccurrences
+from .signals import calculate_prices
+from .taxonomy import taxonomy
+from . import leaderboard, popularity
+from .views import ProductViewSet, serve_product_media
+from SilverShop.testing import QueryPlanMixin, redis_available
+from .images import image_reference_count, IMAGE_RELEASE_GRACE
+from .tasks import generate_image_derivatives, release_unreferenced_product_images
+from SilverShop.redis_client import get_redis
+from order_app.models import WishlistItem, Wishlist, Order, OrderItem
+from order_app.stock import take_stock
+from order_app.utils import product_snapshot
 from user_app.models import User
 
 class ProductStockUpdateTestCase(TestCase):
@@ -36,4 +72,1062 @@ class ProductStockUpdateTestCase(TestCase):
             'receptor': '1234567890',
             'message': 'Test message'
         })
-        self.assertEqual(response, {'status': 'sent'})
\ No newline at end of file
+        self.assertEqual(response, {'status': 'sent'})
+
+class ProductCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Cached Product', price=100, stock=5, category=self.category, slugname='cached-product')
+
+    def test_list_is_served_from_cache(self):
+        url = reverse('product-list')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+        self.assertEqual(cached.data, response.data)
+
+    def test_list_is_invalidated_on_product_save(self):
+        url = reverse('product-list')
+        self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 250
+            self.product.save()
+
+        response = self.client.get(url)
+        self.assertEqual(response.data['results'][0]['price'], 250)
+
+    def test_detail_is_invalidated_on_product_delete(self):
+        url = reverse('product-detail', args=[self.product.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+
+        response = self.client.get(url)
+        self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+
+
+class KeysetPaginationTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        # Several products share a price so the id tie-breaker is exercised.
+        for i in range(25):
+            Product.objects.create(name=f'Product {i}', slugname=f'product-{i}', price=100 * (i % 4 + 1), stock=1, category=self.category)
+
+    def collect_pages(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_cursor_pages_are_complete_and_ordered(self):
+        ids = self.collect_pages(reverse('product-list') + '?pagination=cursor')
+        expected = list(Product.objects.order_by('price_after_discount', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_cursor_pages_follow_sort_order(self):
+        ids = self.collect_pages(reverse('product-list') + '?pagination=cursor&sort_order=desc')
+        expected = list(Product.objects.order_by('-price_after_discount', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_cursor_pages_put_unpriced_products_last(self):
+        unpriced = list(Product.objects.order_by('id').values_list('id', flat=True)[:3])
+        Product.objects.filter(id__in=unpriced).update(price_after_discount=None)
+        priced = Product.objects.exclude(id__in=unpriced)
+
+        ids = self.collect_pages(reverse('product-list') + '?pagination=cursor')
+        self.assertEqual(ids, list(priced.order_by('price_after_discount', 'id').values_list('id', flat=True)) + unpriced)
+        ids = self.collect_pages(reverse('product-list') + '?pagination=cursor&sort_order=desc')
+        self.assertEqual(ids, list(priced.order_by('-price_after_discount', '-id').values_list('id', flat=True)) + unpriced[::-1])
+
+    def test_cursor_with_values_of_the_wrong_type_is_rejected(self):
+        for position in (['cheap', 1], [100, None], [100, [1]], [100]):
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            response = self.client.get(reverse('product-list'), {'cursor': cursor})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        product = Product.objects.first()
+        cursor = base64.urlsafe_b64encode(b'["not a date", 1]').decode()
+        response = self.client.get(reverse('comment-list'), {'product_id': product.id, 'cursor': cursor})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_page_skips_count_and_offset(self):
+        first = self.client.get(reverse('product-list') + '?pagination=cursor')
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(first.data['next'])
+        sql = ' '.join(query['sql'] for query in queries.captured_queries).upper()
+        self.assertNotIn('COUNT(', sql)
+        self.assertNotIn('OFFSET', sql)
+
+    def test_page_number_pagination_is_default(self):
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.data['count'], 25)
+
+
+class ProductSearchTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones', slugname='phones')
+        self.laptops = Category.objects.create(name='Laptops', slugname='laptops')
+        self.galaxy = Product.objects.create(name='Galaxy S24', slugname='galaxy-s24', brand='Samsung', price=900, category=self.phones,
+                                             description='Android smartphone')
+        self.iphone = Product.objects.create(name='iPhone 15', slugname='iphone-15', brand='Apple', price=1000, category=self.phones,
+                                             description='Smartphone with a Samsung display')
+        self.book = Product.objects.create(name='Galaxy Book', slugname='galaxy-book', brand='Samsung', price=1500, category=self.laptops)
+        product_search_index.invalidate()
+
+    def test_ranks_name_and_brand_above_description(self):
+        self.assertEqual(product_search_index.search('samsung')[-1], self.iphone.id)
+
+    def test_prefix_and_typo_matching(self):
+        self.assertEqual(set(product_search_index.search('gala')), {self.galaxy.id, self.book.id})
+        self.assertEqual(set(product_search_index.search('samsnug')), {self.galaxy.id, self.book.id, self.iphone.id})
+        self.assertEqual(product_search_index.search('galxy book'), [self.book.id])
+
+    def test_search_endpoint_composes_with_filters(self):
+        url = reverse('product-search')
+        response = self.client.get(url, {'q': 'galaxy', 'category': self.laptops.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in response.data['results']], [self.book.id])
+
+        response = self.client.get(url, {'q': 'galaxy', 'maxPrice': 1000})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.galaxy.id])
+
+    def test_index_follows_product_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.iphone.name = 'Pixel 9'
+            self.iphone.save()
+        self.assertEqual(product_search_index.search('pixel'), [self.iphone.id])
+        self.assertEqual(product_search_index.search('iphone'), [])
+
+    def test_saves_outside_the_indexed_text_keep_the_index(self):
+        product_search_index.search('galaxy')
+        versions = [get_version(ProductSearchIndex.version_key), get_version(ProductSearchIndex.changes_key)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.galaxy.price = 800
+            self.galaxy.stock = 3
+            self.galaxy.save()
+        self.assertEqual([get_version(ProductSearchIndex.version_key), get_version(ProductSearchIndex.changes_key)], versions)
+
+    def test_saves_patch_the_index_without_a_rebuild(self):
+        product_search_index.search('galaxy')
+        with patch.object(ProductSearchIndex, 'load', side_effect=AssertionError('rebuilt')):
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.create(name='Galaxy Watch', slugname='galaxy-watch', brand='Samsung', price=300,
+                                       category=self.phones)
+                self.book.name = 'Notebook Pro'
+                self.book.save()
+            self.assertEqual(len(product_search_index.search('galaxy')), 2)
+            self.assertEqual(product_search_index.search('notebook'), [self.book.id])
+            self.assertEqual(product_search_index.search('book'), [])
+            self.assertEqual(product_search_index.search('notebok'), [self.book.id])
+
+    @patch('product_app.views.MAX_RESULTS', 2)
+    def test_list_search_says_when_matches_were_cut(self):
+        response = self.client.get(reverse('product-list'), {'search': 'samsung'})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertTrue(response.data['search_truncated'])
+
+        response = self.client.get(reverse('product-list'), {'search': 'book'})
+        self.assertNotIn('search_truncated', response.data)
+
+
+class ProductFacetsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones', slugname='phones')
+        self.laptops = Category.objects.create(name='Laptops', slugname='laptops')
+        self.android = Subcategory.objects.create(name='Android', slugname='android', category=self.phones)
+        Product.objects.create(name='Galaxy S24', slugname='galaxy-s24', brand='Samsung', price=900_000, category=self.phones, subcategory=self.android)
+        Product.objects.create(name='Pixel 9', slugname='pixel-9', brand='Google', price=2_000_000, category=self.phones, subcategory=self.android)
+        Product.objects.create(name='Galaxy Book', slugname='galaxy-book', brand='Samsung', price=20_000_000, category=self.laptops)
+
+    def test_facet_counts_in_one_query(self):
+        url = reverse('product-facets')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 3)
+        self.assertEqual(response.data['categories'][0], {'id': self.phones.id, 'name': 'Phones', 'count': 2})
+        self.assertEqual(response.data['subcategories'], [{'id': self.android.id, 'name': 'Android', 'count': 2}])
+        self.assertEqual(response.data['brands'], [{'brand': 'Samsung', 'count': 2}, {'brand': 'Google', 'count': 1}])
+        self.assertEqual([band['count'] for band in response.data['price_bands']], [1, 1, 1])
+
+    def test_facets_follow_filters_and_invalidation(self):
+        url = reverse('product-facets')
+        response = self.client.get(url, {'maxPrice': 1_000_000})
+        self.assertEqual(response.data['total'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Nokia 3310', slugname='nokia-3310', price=500_000, category=self.phones)
+        response = self.client.get(url, {'maxPrice': 1_000_000})
+        self.assertEqual(response.data['total'], 2)
+
+    def test_facets_leave_out_their_own_filter(self):
+        url = reverse('product-facets')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'brand': 'Samsung', 'maxPrice': 1_000_000})
+        self.assertEqual(response.data['total'], 1)
+        # Brands are counted under the price filter only, bands under the brand filter only.
+        self.assertEqual(response.data['brands'], [{'brand': 'Samsung', 'count': 1}])
+        self.assertEqual([band['count'] for band in response.data['price_bands']], [1, 1])
+
+        response = self.client.get(url, {'brand': 'Samsung'})
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['brands'], [{'brand': 'Samsung', 'count': 2}, {'brand': 'Google', 'count': 1}])
+        self.assertEqual(response.data['categories'], [
+            {'id': self.laptops.id, 'name': 'Laptops', 'count': 1}, {'id': self.phones.id, 'name': 'Phones', 'count': 1}
+        ])
+
+        response = self.client.get(reverse('product-list'), {'brand': 'Samsung,Google', 'category': self.phones.id})
+        self.assertEqual(response.data['count'], 2)
+
+    def test_unpriced_products_are_in_no_price_band(self):
+        Product.objects.filter(slugname='galaxy-book').update(price_after_discount=None)
+        response = self.client.get(reverse('product-facets'))
+        self.assertEqual(response.data['total'], 3)
+        self.assertEqual([band['count'] for band in response.data['price_bands']], [1, 1])
+
+
+class RatingAggregatesTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create(phone_number='09000000000', is_staff=True)
+        self.user = User.objects.create(phone_number='09111111111')
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Rated', slugname='rated', price=100, category=self.category)
+        self.other = Product.objects.create(name='Unrated', slugname='unrated', price=200, category=self.category)
+
+    def rate(self, user, product, value):
+        self.client.force_authenticate(user)
+        return self.client.post(reverse('rating-list'), {'product': product.id, 'rating': value}, format='json')
+
+    def test_aggregates_follow_create_update_and_delete(self):
+        self.rate(self.user, self.product, 4)
+        self.rate(self.staff, self.product, 2)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum), (2, 6))
+        self.assertEqual(self.product.rating_histogram, {1: 0, 2: 1, 3: 0, 4: 1, 5: 0})
+
+        rating = Rating.objects.get(user=self.user)
+        self.client.force_authenticate(self.staff)
+        self.client.patch(reverse('rating-detail', args=[rating.id]), {'rating': 5}, format='json')
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum, self.product.rating_4, self.product.rating_5), (2, 7, 0, 1))
+
+        self.client.delete(reverse('rating-detail', args=[rating.id]))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum, self.product.rating_5), (1, 2, 0))
+
+    def test_products_sort_and_filter_by_average_rating(self):
+        self.rate(self.user, self.product, 3)
+        self.client.force_authenticate(None)
+        response = self.client.get(reverse('product-list'), {'sort': 'rating', 'sort_order': 'desc'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.product.id, self.other.id])
+        self.assertEqual(response.data['results'][0]['average_rating'], 3.0)
+
+        response = self.client.get(reverse('product-list'), {'minRating': 2})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.product.id])
+
+    def test_reconcile_ratings_fixes_drift(self):
+        Rating.objects.create(user=self.user, product=self.product, rating=5)
+        call_command('reconcile_ratings', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum, self.product.rating_5), (1, 5, 1))
+
+
+@skipUnless(redis_available(), 'Redis is not reachable')
+class LeaderboardTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        connection = get_redis()
+        for pattern in ('leaderboard:*', 'sales:*'):
+            for key in connection.scan_iter(match=pattern):
+                connection.delete(key)
+
+        self.user = User.objects.create(phone_number='09111111111')
+        self.phones = Category.objects.create(name='Phones', slugname='phones')
+        self.laptops = Category.objects.create(name='Laptops', slugname='laptops')
+        self.phone = Product.objects.create(name='Phone', slugname='phone', price=100, stock=10, category=self.phones)
+        self.laptop = Product.objects.create(name='Laptop', slugname='laptop', price=500, stock=10, category=self.laptops)
+
+    def settled(self):
+        return timezone.now() - timedelta(seconds=leaderboard.SALES_SETTLE + 60)
+
+    def later(self):
+        # Runs leaderboard code once everything recorded so far has settled.
+        clock = patch('product_app.leaderboard.time')
+        mocked = clock.start()
+        self.addCleanup(clock.stop)
+        mocked.time.return_value = time.time() + leaderboard.SALES_SETTLE + leaderboard.SALES_CLOCK_SKEW
+
+    def make_order(self, product, quantity, when, **kwargs):
+        order = Order.objects.create(user=self.user, delivery_address='Somewhere', **kwargs)
+        OrderItem.objects.create(order=order, product=product, quantity=quantity)
+        Order.objects.filter(pk=order.pk).update(order_date=when)
+        return order
+
+    def score(self, product):
+        return get_redis().zscore(leaderboard.ALL_TIME_KEY, product.id)
+
+    def test_sales_are_ranked_and_flushed(self):
+        sold_at = self.settled()
+        leaderboard.record_sales([(self.phone.id, self.phones.id, 2), (self.laptop.id, self.laptops.id, 5)], when=sold_at)
+        leaderboard.record_sales([(self.phone.id, self.phones.id, 1)], when=sold_at)
+
+        response = self.client.get(reverse('top-seller'))
+        self.assertEqual([item['id'] for item in response.data['results']], [self.laptop.id, self.phone.id])
+        response = self.client.get(reverse('top-seller'), {'category': self.phones.id})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.phone.id])
+        response = self.client.get(reverse('top-seller'), {'window': '7d'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.laptop.id, self.phone.id])
+
+        url = reverse('product-detail', args=[self.phone.id])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(leaderboard.flush_sales_counts(), 2)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.sales_count, 3)
+        self.assertEqual(leaderboard.flush_sales_counts(), 0)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['sales_count'], 3)
+
+    def test_flush_leaves_unsettled_sales(self):
+        leaderboard.record_sales([(self.phone.id, self.phones.id, 2)])
+        self.assertEqual(leaderboard.flush_sales_counts(), 0)
+        self.later()
+        self.assertEqual(leaderboard.flush_sales_counts(), 1)
+
+    def test_rebuild_from_order_items_skips_cancelled_orders(self):
+        sold_at = self.settled()
+        self.make_order(self.phone, 4, sold_at)
+        self.make_order(self.laptop, 9, sold_at, delivery_status='cancelled', cancelled_at=sold_at)
+        leaderboard.record_sales([(self.laptop.id, self.laptops.id, 9)], when=sold_at)
+        leaderboard.record_sales([(self.laptop.id, self.laptops.id, 9)], when=sold_at, sign=-1, at=sold_at)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            leaderboard.rebuild_leaderboards()
+
+        self.assertEqual(leaderboard.top_product_ids(), [self.phone.id])
+        self.assertEqual(leaderboard.top_product_ids(window='7d'), [self.phone.id])
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.sales_count, 4)
+        self.assertEqual(leaderboard.flush_sales_counts(), 0)
+
+    def test_rebuild_keeps_unsettled_sales(self):
+        sold_at = self.settled()
+        # Settled, so already in the rows the rebuild reads.
+        self.make_order(self.phone, 4, sold_at)
+        leaderboard.record_sales([(self.phone.id, self.phones.id, 4)], when=sold_at)
+        # Still settling: left to the board and a later flush.
+        self.make_order(self.laptop, 2, timezone.now())
+        leaderboard.record_sales([(self.laptop.id, self.laptops.id, 2)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            leaderboard.rebuild_leaderboards()
+        self.assertEqual((self.score(self.phone), self.score(self.laptop)), (4, 2))
+        self.laptop.refresh_from_db()
+        self.assertEqual(self.laptop.sales_count, 0)
+
+        self.later()
+        self.assertEqual(leaderboard.flush_sales_counts(), 1)
+        self.phone.refresh_from_db()
+        self.laptop.refresh_from_db()
+        self.assertEqual((self.phone.sales_count, self.laptop.sales_count), (4, 2))
+
+    def test_sale_during_rebuild_is_counted_once(self):
+        self.make_order(self.phone, 4, self.settled())
+        swap = leaderboard.get_script
+
+        def checkout_then_swap(source):
+            # A checkout commits and records after the rows were read but
+            # before the boards are swapped in.
+            if source == leaderboard.SWAP_BOARDS_SCRIPT:
+                self.make_order(self.phone, 3, timezone.now())
+                leaderboard.record_sales([(self.phone.id, self.phones.id, 3)])
+            return swap(source)
+
+        with patch('product_app.leaderboard.get_script', side_effect=checkout_then_swap):
+            with self.captureOnCommitCallbacks(execute=True):
+                leaderboard.rebuild_leaderboards()
+        self.assertEqual(self.score(self.phone), 7)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.sales_count, 4)
+
+        self.later()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(leaderboard.flush_sales_counts(), 1)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.sales_count, 7)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            leaderboard.rebuild_leaderboards()
+        self.phone.refresh_from_db()
+        self.assertEqual((self.phone.sales_count, self.score(self.phone)), (7, 7))
+        self.assertEqual(leaderboard.flush_sales_counts(), 0)
+
+    def test_flush_waits_for_a_running_rebuild(self):
+        leaderboard.record_sales([(self.phone.id, self.phones.id, 2)], when=self.settled())
+        with get_redis().lock(leaderboard.SALES_LOCK_KEY, timeout=10):
+            self.assertEqual(leaderboard.flush_sales_counts(), 0)
+        self.assertEqual(leaderboard.flush_sales_counts(), 1)
+
+
+class ProductQueryPlanTestCase(QueryPlanMixin, TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Phones', slugname='phones')
+        self.subcategory = Subcategory.objects.create(name='Android', slugname='android', category=self.category)
+        other = Category.objects.create(name='Laptops', slugname='laptops')
+        Product.objects.bulk_create([
+            Product(name=f'Product {i}', slugname=f'product-{i}', price=i * 10, price_after_discount=i * 10,
+                    category=self.category if i % 10 == 0 else other)
+            for i in range(200)
+        ])
+
+    def test_category_and_price_filter_uses_index(self):
+        view = self.build_view(ProductViewSet, {'category': self.category.id, 'minPrice': 100, 'maxPrice': 900})
+        self.assertUsesIndex(view.get_queryset())
+
+    def test_subcategory_filter_uses_index(self):
+        view = self.build_view(ProductViewSet, {'subcategory': self.subcategory.id})
+        self.assertUsesIndex(view.get_queryset())
+
+
+class ImageDerivativesTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+
+    def make_image(self, name, size=(1600, 1200)):
+        buffer = BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, format='JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def test_image_upload_schedules_derivatives(self):
+        product = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category)
+        with patch('product_app.tasks.generate_image_derivatives.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                product.image1 = self.make_image('camera.jpg')
+                product.save()
+            delay.assert_called_once_with(product.id)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                product.stock = 5
+                product.save()
+            delay.assert_called_once()
+
+    def test_derivatives_fill_thumbnail_and_srcset(self):
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            product = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                             image1=self.make_image('camera.jpg'))
+        generate_image_derivatives(product.id)
+        product.refresh_from_db()
+
+        self.assertTrue(product.thumbnail.name.endswith('.webp'))
+        with Image.open(product.thumbnail.path) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), 300)
+        self.assertEqual(sorted(product.image_variants['image1']['sizes'], key=int), ['320', '640', '1024'])
+
+        response = self.client.get(reverse('product-detail', args=[product.id]))
+        srcset = response.data['images_srcset'][0]
+        self.assertIn('webp', srcset['sizes']['640'])
+        self.assertIn('640w', srcset['srcset']['webp'])
+
+    def release_now(self):
+        # Runs the deferred release straight away instead of after the grace period.
+        return patch('product_app.tasks.release_unreferenced_product_images.apply_async',
+                     side_effect=lambda args, countdown: release_unreferenced_product_images(*args))
+
+    def test_replaced_original_drops_old_derivatives(self):
+        with patch('product_app.tasks.generate_image_derivatives.delay'), self.release_now():
+            product = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                             image1=self.make_image('camera.jpg'))
+            generate_image_derivatives(product.id)
+            product.refresh_from_db()
+            old_files = [name for formats in product.image_variants['image1']['sizes'].values() for name in formats.values()]
+
+            with self.captureOnCommitCallbacks(execute=True):
+                product.image1 = self.make_image('camera-v2.jpg', size=(500, 400))
+                product.save()
+        generate_image_derivatives(product.id)
+        product.refresh_from_db()
+
+        self.assertFalse(any(default_storage.exists(name) for name in old_files))
+        self.assertEqual(list(product.image_variants['image1']['sizes']), ['320'])
+
+
+    def test_identical_uploads_share_one_file_until_unreferenced(self):
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            first = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                           image1=self.make_image('20230224_203613.jpg'))
+            second = Product.objects.create(name='Camera Kit', slugname='camera-kit', price=150, category=self.category,
+                                            image2=self.make_image('20230224_203613.jpg'))
+
+        self.assertEqual(first.image1.name, second.image2.name)
+        self.assertRegex(first.image1.name, r'^products/images/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(image_reference_count(first.image1.name), 2)
+
+        name = first.image1.name
+        with self.release_now(), self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+        with self.release_now(), self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+
+    def test_release_waits_for_uploads_still_in_flight(self):
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            first = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                           image1=self.make_image('camera.jpg'))
+        name = first.image1.name
+        with patch('product_app.tasks.release_unreferenced_product_images.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                first.delete()
+        apply_async.assert_called_once_with(([name],), countdown=IMAGE_RELEASE_GRACE)
+        self.assertTrue(default_storage.exists(name))
+
+        # An identical upload resolved to the same blob and committed before the grace period ran out.
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            second = Product.objects.create(name='Camera Kit', slugname='camera-kit', price=150, category=self.category,
+                                            image1=self.make_image('camera.jpg'))
+        self.assertEqual(second.image1.name, name)
+        release_unreferenced_product_images([name])
+        self.assertTrue(default_storage.exists(name))
+
+    def test_thumbnail_shown_by_an_order_snapshot_is_kept(self):
+        user = User.objects.create(phone_number='09111111111')
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            product = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                             image1=self.make_image('camera.jpg'))
+        generate_image_derivatives(product.id)
+        product.refresh_from_db()
+        name, thumbnail = product.image1.name, product.thumbnail.name
+        order = Order.objects.create(user=user, delivery_address='Somewhere')
+        OrderItem.objects.create(order=order, product=product, product_snapshot=product_snapshot(product))
+
+        with patch('product_app.tasks.generate_image_derivatives.delay'), self.release_now():
+            with self.captureOnCommitCallbacks(execute=True):
+                product.image1 = self.make_image('camera-v2.jpg', size=(500, 400))
+                product.save()
+        self.assertEqual(image_reference_count(name), 1)
+        self.assertTrue(default_storage.exists(thumbnail))
+
+    def test_broker_redelivers_only_after_the_release_grace(self):
+        self.assertGreater(settings.CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'], IMAGE_RELEASE_GRACE)
+
+    def test_content_addressed_media_is_served_immutable(self):
+        with patch('product_app.tasks.generate_image_derivatives.delay'):
+            product = Product.objects.create(name='Camera', slugname='camera', price=100, category=self.category,
+                                             image1=self.make_image('camera.jpg'))
+        response = serve_product_media(APIRequestFactory().get('/'), product.image1.name)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+
+class TaxonomyCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones', slugname='phones')
+        self.subcategory = Subcategory.objects.create(name='Android', slugname='android', category=self.category)
+        Category.objects.create(name='Laptops', slugname='laptops')
+
+    def test_category_tree_is_served_without_queries(self):
+        url = reverse('category-list')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([node['slugname'] for node in response.data['results']], ['phones', 'laptops'])
+        self.assertEqual(response.data['results'][0]['sub_categories'][0]['category_name'], 'Phones')
+
+        with self.assertNumQueries(0):
+            again = self.client.get(url)
+        self.assertEqual(again.data, response.data)
+
+        by_slug = self.client.get(url, {'slugname': 'phones'})
+        self.assertEqual([node['id'] for node in by_slug.data['results']], [self.category.id])
+
+    def test_taxonomy_is_rebuilt_after_changes(self):
+        self.assertFalse(taxonomy.get().has_category(self.category.id + 100))
+        with self.captureOnCommitCallbacks(execute=True):
+            Subcategory.objects.create(name='iOS', slugname='ios', category=self.category)
+        tree = taxonomy.get()
+        self.assertIsNotNone(tree.subcategory_by_slug('ios'))
+        self.assertEqual(len(tree.category_node(self.category.id)['sub_categories']), 2)
+
+    def test_product_filter_validates_against_taxonomy(self):
+        url = reverse('product-list')
+        taxonomy.get()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'category': self.category.id, 'subcategory': self.subcategory.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('FROM "product_app_category"' in query['sql'] for query in queries.captured_queries))
+
+        response = self.client.get(url, {'category': 'nope'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product', price=100, stock=5, category=self.category, slugname='product')
+
+    def assertNotModified(self, url, etag):
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_product_endpoints_answer_304(self):
+        for url in (reverse('product-list'), reverse('product-detail', args=[self.product.id]), reverse('category-list')):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotModified(url, response['ETag'])
+
+    def test_product_change_moves_etag(self):
+        url = reverse('product-detail', args=[self.product.id])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.stock = 3
+            self.product.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stock'], 3)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_etag_follows_stock_behind_the_list_cache(self):
+        url = reverse('product-list')
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            take_stock(self.product.id, 2)
+
+        # The cached list still shows the old count, and so does its ETag.
+        self.assertNotModified(url, etag)
+
+        # Once that entry is gone the new count comes with a new ETag.
+        with patch('product_app.views.cached_response_data', return_value=None):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['stock'], 3)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @patch('product_app.views.top_product_ids', return_value=None)
+    def test_top_sellers_answer_304_without_loading_products(self, top_product_ids):
+        url = reverse('top-seller')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class SparseFieldsetsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product', description='Long text ' * 50, price=100, stock=5,
+                                              category=self.category, slugname='product')
+
+    def test_list_uses_compact_representation(self):
+        response = self.client.get(reverse('product-list'))
+        item = response.data['results'][0]
+        self.assertIn('thumbnail', item)
+        self.assertNotIn('description', item)
+        self.assertNotIn('image1', item)
+        self.assertNotIn('images_srcset', item)
+
+    def test_fields_and_expand(self):
+        response = self.client.get(reverse('product-list'), {'fields': 'id,name'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name'})
+
+        response = self.client.get(reverse('product-list'), {'expand': 'description'})
+        self.assertEqual(response.data['results'][0]['description'], self.product.description)
+
+        response = self.client.get(reverse('product-detail', args=[self.product.id]), {'fields': 'id,stock'})
+        self.assertEqual(response.data, {'id': self.product.id, 'stock': 5})
+        response = self.client.get(reverse('product-detail', args=[self.product.id]))
+        self.assertIn('description', response.data)
+
+    def test_list_skips_description_column(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('product-list'))
+        product_queries = [query['sql'] for query in queries.captured_queries if 'FROM "product_app_product"' in query['sql']]
+        self.assertTrue(product_queries)
+        self.assertFalse(any('"description"' in sql for sql in product_queries))
+
+
+class ProductImportExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones', slugname='phones')
+        self.subcategory = Subcategory.objects.create(name='Android', slugname='android', category=self.category)
+        self.existing = Product.objects.create(name='Old Phone', slugname='old-phone', description='Keep me',
+                                               price=1000, stock=0, category=self.category)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_feed(self, name, content):
+        path = f'{self.directory}/{name}'
+        with open(path, 'w', encoding='utf-8') as feed:
+            feed.write(content)
+        return path
+
+    @patch('product_app.management.commands.import_products.notify_back_in_stock.delay')
+    def test_import_upserts_and_batches_notifications(self, notify):
+        self.assertImportUpserts(notify)
+
+    @patch('product_app.management.commands.import_products.notify_back_in_stock.delay')
+    def test_import_without_upsert_support_falls_back_to_bulk_update(self, notify):
+        # MySQL cannot name a conflict target, so this is the path it takes.
+        with patch.object(connection.features, 'supports_update_conflicts_with_target', False):
+            queries = self.assertImportUpserts(notify)
+        self.assertFalse([query for query in queries if 'ON CONFLICT' in query['sql']])
+
+    def assertImportUpserts(self, notify):
+        path = self.write_feed('feed.csv', (
+            'slugname,name,price,discount_percentage,stock,category,subcategory\n'
+            'old-phone,Old Phone,2000,15,4,phones,android\n'
+            'new-phone,New Phone,999,33,0,phones,\n'
+            'broken,Broken,abc,0,1,phones,\n'
+        ))
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_products', path, '--chunk-size', '2', stdout=out, stderr=StringIO())
+        self.assertIn('Created 1 products, updated 1, skipped 1', out.getvalue())
+        self.assertLess(len(queries), 15)
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.description, 'Keep me')
+        self.assertEqual((self.existing.price_after_discount, self.existing.pre_order_price), (1700, 425))
+        self.assertEqual(self.existing.subcategory, self.subcategory)
+
+        new = Product.objects.get(slugname='new-phone')
+        expected = Product(name='Check', slugname='check', price=999, discount_percentage=33, category=self.category)
+        expected.save()
+        self.assertEqual((new.price_after_discount, new.pre_order_price),
+                         (expected.price_after_discount, expected.pre_order_price))
+        notify.assert_called_once_with([self.existing.id])
+        return queries.captured_queries
+
+    def test_export_round_trips_through_import(self):
+        path = f'{self.directory}/catalog.jsonl'
+        call_command('export_products', path)
+        with open(path, encoding='utf-8') as feed:
+            rows = [json.loads(line) for line in feed]
+        self.assertEqual(rows[0]['slugname'], 'old-phone')
+        self.assertEqual(rows[0]['category'], 'phones')
+
+        Product.objects.filter(pk=self.existing.pk).update(description='Changed')
+        call_command('import_products', path, stdout=StringIO())
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.description, 'Keep me')
+
+    @patch('product_app.utils.send_sms')
+    def test_bulk_notification_sends_one_sms_per_user_and_product(self, send):
+        user = User.objects.create(phone_number='09120000000')
+        wishlist = Wishlist.objects.create(user=user)
+        WishlistItem.objects.create(wishlist=wishlist, product=self.existing)
+        with self.assertNumQueries(1):
+            self.assertEqual(notify_users_in_bulk([self.existing.id, self.existing.id]), 1)
+        send.assert_called_once_with('09120000000', 'Product Old Phone is now available!')
+
+
+class PromotionTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones', slugname='phones')
+        self.laptops = Category.objects.create(name='Laptops', slugname='laptops')
+        for i in range(20):
+            Product.objects.create(name=f'Phone {i}', slugname=f'phone-{i}', price=999 + i, discount_percentage=10 if i % 2 else 0,
+                                   category=self.phones, brand='Acme' if i < 5 else 'Other')
+        self.laptop = Product.objects.create(name='Laptop', slugname='laptop', price=5000, category=self.laptops)
+        self.now = timezone.now()
+
+    def promote(self, percentage, **scope):
+        return Promotion.objects.create(name='Sale', percentage=percentage, starts_at=self.now - timedelta(minutes=1),
+                                        ends_at=self.now + timedelta(hours=1), **scope)
+
+    def assertPricesMatchSave(self):
+        for product in Product.objects.all():
+            expected = Product(price=product.price, discount_percentage=product.discount_percentage,
+                               promotion_percentage=product.promotion_percentage)
+            calculate_prices(Product, expected)
+            self.assertEqual((product.price_after_discount, product.pre_order_price),
+                             (expected.price_after_discount, expected.pre_order_price), product.name)
+
+    def test_promotion_applies_and_reverts_in_set_based_updates(self):
+        promotion = self.promote(25, scope='category', category=self.phones)
+        with CaptureQueriesContext(connection) as queries:
+            run_promotions(self.now)
+        # Selects, status saves and one UPDATE: nothing per product.
+        self.assertLess(len(queries), 10)
+        self.assertEqual(Product.objects.filter(promotion=promotion).count(), 20)
+        self.assertEqual(Product.objects.get(slugname='phone-0').price_after_discount, 999 * 75 // 100)
+        self.assertIsNone(Product.objects.get(slugname='laptop').promotion)
+        self.assertPricesMatchSave()
+
+        run_promotions(self.now + timedelta(hours=2))
+        promotion.refresh_from_db()
+        self.assertEqual(promotion.status, 'ended')
+        self.assertFalse(Product.objects.filter(promotion_percentage__gt=0).exists())
+        self.assertEqual(Product.objects.get(slugname='phone-1').price_after_discount, 1000 * 90 // 100)
+        self.assertPricesMatchSave()
+
+    def test_deepest_overlapping_promotion_wins_and_survivor_is_reapplied(self):
+        brand = self.promote(40, scope='brand', brand='Acme')
+        everything = self.promote(15)
+        everything.ends_at = self.now + timedelta(days=1)
+        everything.save()
+        run_promotions(self.now)
+        self.assertEqual(Product.objects.get(slugname='phone-0').promotion, brand)
+        self.assertEqual(Product.objects.get(slugname='laptop').promotion, everything)
+
+        run_promotions(self.now + timedelta(hours=2))
+        self.assertEqual(Product.objects.get(slugname='phone-0').promotion, everything)
+        self.assertPricesMatchSave()
+
+    def test_save_honours_promotion_and_detail_cache_is_dropped(self):
+        product = Product.objects.get(slugname='phone-0')
+        url = reverse('product-detail', args=[product.id])
+        self.assertEqual(self.client.get(url).data['price_after_discount'], 999)
+
+        self.promote(50)
+        with self.captureOnCommitCallbacks(execute=True):
+            run_promotions(self.now)
+        self.assertEqual(self.client.get(url).data['price_after_discount'], 499)
+
+        product.refresh_from_db()
+        product.price = 2000
+        product.save()
+        self.assertEqual(product.price_after_discount, 1000)
+
+    def test_scope_must_match_its_target(self):
+        promotion = Promotion(name='Sale', percentage=10, starts_at=self.now, ends_at=self.now + timedelta(hours=1),
+                              scope='category', brand='Acme')
+        with self.assertRaises(ValidationError) as raised:
+            promotion.full_clean()
+        self.assertEqual(set(raised.exception.message_dict), {'category', 'brand'})
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            promotion.save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.promote(10, scope='all', category=self.phones)
+        self.promote(10, scope='category', category=self.phones).full_clean()
+
+
+class CommentFeedTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Test Category', slugname='test-category')
+        self.product = Product.objects.create(name='Product', price=100, category=self.category, slugname='product')
+        for i in range(12):
+            owner = User.objects.create(phone_number=f'0912000{i:04d}')
+            Comment.objects.create(product=self.product, owner=owner, text=f'Comment {i}')
+        self.url = reverse('comment-list')
+
+    def test_comment_count_is_maintained(self):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.comment_count, 12)
+        Comment.objects.filter(product=self.product).first().delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.comment_count, 11)
+
+    def test_feed_is_newest_first_by_cursor_without_n_plus_one(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'product_id': self.product.id, 'pagination': 'cursor'})
+        texts = [comment['text'] for comment in response.data['results']]
+        self.assertEqual(texts, [f'Comment {i}' for i in range(11, 1, -1)])
+
+        second = self.client.get(response.data['next'])
+        self.assertEqual([comment['text'] for comment in second.data['results']], ['Comment 1', 'Comment 0'])
+
+    def test_page_numbers_still_work_for_a_product_feed(self):
+        response = self.client.get(self.url, {'product_id': self.product.id, 'page': 2})
+        self.assertEqual(response.data['count'], 12)
+        self.assertIsNotNone(response.data['previous'])
+        self.assertEqual([comment['text'] for comment in response.data['results']], ['Comment 1', 'Comment 0'])
+
+    def test_first_page_is_cached_until_a_new_comment(self):
+        self.client.get(self.url, {'product_id': self.product.id})
+        with self.assertNumQueries(0):
+            self.client.get(self.url, {'product_id': self.product.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(product=self.product, owner=User.objects.first(), text='Newest')
+        response = self.client.get(self.url, {'product_id': self.product.id})
+        self.assertEqual(response.data['results'][0]['text'], 'Newest')
+
+
+class RelatedProductsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(phone_number='09120000000')
+        self.category = Category.objects.create(name='Phones', slugname='phones')
+        self.subcategory = Subcategory.objects.create(name='Android', slugname='android', category=self.category)
+        self.phone, self.case, self.charger, self.cable = [
+            Product.objects.create(name=name, slugname=name.lower(), price=100, category=self.category, subcategory=self.subcategory)
+            for name in ('Phone', 'Case', 'Charger', 'Cable')
+        ]
+        self.cable.sales_count = 50
+        self.cable.save()
+        self.later = timezone.now() + timedelta(hours=1)
+
+    def place_order(self, *products, delivery_status='pending'):
+        order = Order.objects.create(user=self.user, delivery_status=delivery_status)
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, quantity=1)
+        return order
+
+    def test_incremental_counts(self):
+        self.place_order(self.phone, self.case)
+        self.place_order(self.phone, self.case, self.charger)
+        self.place_order(self.phone, self.charger, delivery_status='cancelled')
+        self.assertEqual(update_cooccurrences(now=self.later), 3)
+        self.assertEqual(ProductCooccurrence.objects.get(product=self.phone, related=self.case).count, 2)
+        self.assertEqual(ProductCooccurrence.objects.get(product=self.charger, related=self.phone).count, 1)
+
+        self.assertEqual(update_cooccurrences(now=self.later), 0)
+        self.place_order(self.case, self.phone)
+        update_cooccurrences(now=self.later)
+        self.assertEqual(ProductCooccurrence.objects.get(product=self.case, related=self.phone).count, 3)
+
+    def test_recent_orders_wait_for_the_next_run(self):
+        self.place_order(self.phone, self.case)
+        self.assertEqual(update_cooccurrences(), 0)
+        self.assertEqual(update_cooccurrences(now=self.later), 1)
+
+    def test_related_endpoint_falls_back_to_subcategory_best_sellers(self):
+        self.place_order(self.phone, self.charger)
+        update_cooccurrences(now=self.later)
+
+        url = reverse('product-related', args=[self.phone.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in response.data], [self.charger.id, self.cable.id, self.case.id])
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+
+class AutocompleteTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(name='Phones', slugname='phones')
+        self.galaxy = Product.objects.create(name='Samsung Galaxy S21', slugname='galaxy-s21', brand='Samsung',
+                                             price=100, category=self.phones, sales_count=5)
+        self.pixel = Product.objects.create(name='Google Pixel 8', slugname='pixel-8', brand='Google',
+                                            price=100, category=self.phones, sales_count=40)
+        self.url = reverse('product-autocomplete')
+
+    def suggest(self, query):
+        return [(item['type'], item['text']) for item in self.client.get(self.url, {'q': query}).data['results']]
+
+    def test_prefix_matches_names_brands_and_categories_by_popularity(self):
+        self.assertEqual(self.suggest('ph'), [('category', 'Phones')])
+        self.assertEqual(self.suggest('gal'), [('product', 'Samsung Galaxy S21')])
+        self.assertEqual(self.suggest('g'), [('brand', 'Google'), ('product', 'Google Pixel 8'), ('product', 'Samsung Galaxy S21')])
+        with self.assertNumQueries(0):
+            self.suggest('  SAMS ')
+
+    def test_index_follows_saves_and_deletes(self):
+        self.suggest('g')
+        published = autocomplete_index.get()
+        keys, entries = list(published.keys), dict(published.entries)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.galaxy.name = 'Samsung Note 20'
+            self.galaxy.sales_count = 100
+            self.galaxy.save()
+        self.assertEqual(self.suggest('gal'), [])
+        self.assertEqual(self.suggest('s')[:2], [('brand', 'Samsung'), ('product', 'Samsung Note 20')])
+        # Readers still holding the old index never see it change under them.
+        self.assertEqual((published.keys, published.entries), (keys, entries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pixel.delete()
+        self.assertEqual(self.suggest('goo'), [])
+        self.assertEqual(len(autocomplete_index.get().keys), len(set(autocomplete_index.get().keys)))
+
+
+@skipUnless(redis_available(), 'Redis is not reachable')
+class ViewCounterTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        connection = get_redis()
+        for key in connection.scan_iter(match='views:*'):
+            connection.delete(key)
+        self.category = Category.objects.create(name='Phones', slugname='phones')
+        self.phone = Product.objects.create(name='Phone', slugname='phone', price=100, category=self.category)
+        self.case = Product.objects.create(name='Case', slugname='case', price=10, category=self.category)
+
+    def test_views_are_buffered_then_flushed_in_bulk(self):
+        url = reverse('product-detail', args=[self.phone.id])
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.client.get(reverse('product-detail', args=[self.case.id]))
+        yesterday = timezone.now() - timedelta(days=1)
+        popularity.record_view(self.case.id, when=yesterday)
+        popularity.record_view(self.case.id, when=yesterday)
+
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.view_count, 0)
+
+        self.assertEqual(popularity.flush_view_counts(), 3)
+        self.assertEqual(popularity.flush_view_counts(), 0)
+        self.phone.refresh_from_db()
+        self.case.refresh_from_db()
+        self.assertEqual((self.phone.view_count, self.case.view_count), (2, 3))
+        stats = ProductDailyStats.objects.get(product=self.case, date=timezone.localdate(yesterday))
+        self.assertEqual(stats.views, 2)
+
+        popularity.record_view(self.phone.id)
+        popularity.flush_view_counts()
+        self.assertEqual(ProductDailyStats.objects.get(product=self.phone, date=timezone.localdate()).views, 3)
+
+    def test_views_survive_a_failed_flush(self):
+        popularity.record_view(self.phone.id)
+        with patch.object(popularity, '_apply_day', side_effect=RuntimeError('database down')):
+            with self.assertRaises(RuntimeError):
+                popularity.flush_view_counts()
+        # Within the grace period the taken hash may still belong to a running flush.
+        self.assertEqual(popularity.flush_view_counts(), 0)
+
+        with patch.object(leaderboard, 'TAKEN_GRACE', timedelta(0)), self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(popularity.flush_view_counts(), 1)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.view_count, 1)
+        self.assertFalse(list(get_redis().scan_iter(match='views:*')))
+
+    def test_flush_skips_while_another_is_running(self):
+        popularity.record_view(self.phone.id)
+        with get_redis().lock(popularity.VIEWS_LOCK_KEY, timeout=10):
+            self.assertEqual(popularity.flush_view_counts(), 0)
+        self.assertEqual(popularity.flush_view_counts(), 1)
+
+    def test_views_drive_sorting_and_most_viewed(self):
+        Product.objects.filter(pk=self.case.pk).update(view_count=7)
+        ProductDailyStats.objects.create(product=self.phone, date=timezone.localdate(), views=4)
+        ProductDailyStats.objects.create(product=self.case, date=timezone.localdate() - timedelta(days=30), views=7)
+
+        response = self.client.get(reverse('product-list'), {'sort': 'views', 'sort_order': 'desc'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.case.id, self.phone.id])
+
+        response = self.client.get(reverse('most-viewed'))
+        self.assertEqual([item['id'] for item in response.data['results']], [self.case.id])
+        response = self.client.get(reverse('most-viewed'), {'window': '7d'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.phone.id])
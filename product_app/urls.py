@@ -3,7 +3,7 @@ from .views import (
     CategoryViewSet,SubcategoryViewSet,
     ProductViewSet,
     CommentViewSet,
-    RatingViewSet,TopSellerAPIView
+    RatingViewSet,TopSellerAPIView,MostViewedAPIView
 )
 from rest_framework.routers import DefaultRouter
 
@@ -18,6 +18,7 @@ urlpatterns = [
     path('', include(router.urls)),
     #TopSellerList
     path('top-seller/', TopSellerAPIView.as_view(), name='top-seller'),
+    path('most-viewed/', MostViewedAPIView.as_view(), name='most-viewed'),
 
 
     # Category
@@ -1,7 +1,12 @@
 import logging
 from kavenegar import *
 from django.conf import settings
+from django.db.models import ExpressionWrapper, F, IntegerField, Value
+from django.db.models.functions import Floor
+from django.utils import timezone
 from order_app.models import WishlistItem
+from .models import Product
+from .cache import invalidate_on_commit, invalidate_product
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +25,22 @@ def send_sms(phone_number, message):
     except HTTPException as e:
         logger.error(f"Kavenegar HTTPException: {e}")
 
+def compute_prices(price, discount_percentage, promotion_percentage=0):
+    # Integer arithmetic, so saves, batch imports and the set-based promotion
+    # updates (see price_expressions) all store exactly the same values.
+    if price is None:
+        return None, None
+    percentage = max(discount_percentage or 0, promotion_percentage or 0)
+    return price * (100 - percentage) // 100, price * (100 - percentage) // 400
+
+def price_expressions(percentage):
+    # compute_prices as SQL: percentage is an expression over the row.
+    remaining = ExpressionWrapper(F('price') * (Value(100) - percentage), output_field=IntegerField())
+    return {
+        'price_after_discount': Floor(remaining / Value(100), output_field=IntegerField()),
+        'pre_order_price': Floor(remaining / Value(400), output_field=IntegerField()),
+    }
+
 def notify_users(product):
     logger.info(f"Notifying users about product availability: {product.name}")
     wishlist_items = WishlistItem.objects.filter(product=product)
@@ -37,4 +58,47 @@ def notify_users(product):
             send_sms(phone_number, message)
             logger.info("send_sms function called successfully")
 
-            notified_users.add(user.id)
\ No newline at end of file
+            notified_users.add(user.id)
+
+def apply_rating_change(product_id, old_rating=None, new_rating=None):
+    if old_rating == new_rating:
+        return
+
+    updates = {}
+    count_delta = 0
+    sum_delta = 0
+    if old_rating is not None:
+        updates[f'rating_{old_rating}'] = F(f'rating_{old_rating}') - 1
+        count_delta -= 1
+        sum_delta -= old_rating
+    if new_rating is not None:
+        updates[f'rating_{new_rating}'] = F(f'rating_{new_rating}') + 1
+        count_delta += 1
+        sum_delta += new_rating
+    if count_delta:
+        updates['rating_count'] = F('rating_count') + count_delta
+    if sum_delta:
+        updates['rating_sum'] = F('rating_sum') + sum_delta
+
+    updates['updated_at'] = timezone.now()
+    Product.objects.filter(pk=product_id).update(**updates)
+    # update() skips the post_save receivers, so drop the cached responses here.
+    invalidate_on_commit(invalidate_product, product_id)
+
+def notify_users_in_bulk(product_ids):
+    # One query for every wishlist entry of the restocked products instead of
+    # one notify_users() call per product.
+    items = (
+        WishlistItem.objects.filter(product_id__in=product_ids)
+        .select_related('product', 'wishlist__user')
+        .order_by('product_id', 'wishlist__user_id')
+    )
+    notified = set()
+    for item in items.iterator(chunk_size=1000):
+        user = item.wishlist.user
+        if (user.id, item.product_id) in notified:
+            continue
+        send_sms(user.phone_number, f"Product {item.product.name} is now available!")
+        notified.add((user.id, item.product_id))
+    logger.info(f"Sent {len(notified)} back-in-stock notifications for {len(set(product_ids))} products")
+    return len(notified)
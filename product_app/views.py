@@ -7,13 +7,66 @@ from django.http import Http404
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import generics
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, IsAdminUser, AllowAny
 from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.exceptions import ValidationError, NotFound
+from rest_framework.decorators import action
+from django.conf import settings
 from django.db import transaction
+from django.utils.cache import patch_cache_control
+from django.views.static import serve
+from django.db.models import FloatField
+from django.db.models.functions import Cast, Coalesce, NullIf
+from .pagination import KeysetPaginationMixin
+from .search import product_search_index, FILTER_RESULTS, MAX_RESULTS
+from .facets import compute_facets
+from .utils import apply_rating_change
+from .leaderboard import top_product_ids
+from .storage import is_content_addressed
+from .taxonomy import taxonomy
+from .cache import (
+    PRODUCT_LIST_VERSION_KEY, PRODUCT_STOCK_VERSION_KEY, get_version, product_list_cache_key, product_detail_cache_key,
+    cached_response_data, store_response_data, response_etag, not_modified, set_validators, comment_page_cache_key,
+    product_related_cache_key, content_digest,
+)
+from .recommendations import related_products
+from .popularity import record_view, most_viewed_ids
+from .autocomplete import autocomplete_index, SUGGESTION_LIMIT, MAX_SUGGESTION_LIMIT
+
+class SparseFieldsetsMixin:
+    # ?fields=id,name,price returns only those fields and ?expand=description
+    # adds to the compact list representation. Writes always see every field.
+    list_serializer_class = ProductListSerializer
+    list_actions = ('list',)
+
+    def get_serializer_class(self):
+        if getattr(self, 'action', 'list') in self.list_actions:
+            return self.list_serializer_class
+        return super().get_serializer_class()
+
+    def get_fieldset_kwargs(self):
+        if self.request is None or self.request.method not in ('GET', 'HEAD'):
+            return {}
+        params = self.request.query_params
+        return {'fields': parse_field_list(params.get('fields')), 'expand': parse_field_list(params.get('expand'))}
+
+    def get_serializer(self, *args, **kwargs):
+        for name, value in self.get_fieldset_kwargs().items():
+            kwargs.setdefault(name, value)
+        return super().get_serializer(*args, **kwargs)
+
+    def get_selected_fields(self):
+        serializer_class = self.get_serializer_class()
+        params = self.request.query_params
+        fields = parse_field_list(params.get('fields'))
+        if not fields:
+            fields = getattr(serializer_class.Meta, 'default_fields', None)
+            if fields is None:
+                return None
+        return set(fields) | set(parse_field_list(params.get('expand')))
 
 class CategoryViewSet(viewsets.ModelViewSet):
     queryset = Category.objects.all()
@@ -31,15 +84,41 @@ class CategoryViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    def get_etag(self, request):
+        return response_etag(request, get_version(taxonomy.version_key), request.build_absolute_uri())
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+
+        tree = taxonomy.get()
+        slugname = request.query_params.get('slugname')
+        if slugname is not None:
+            category = tree.category_by_slug(slugname)
+            nodes = [tree.category_node(category['id'])] if category else []
+        else:
+            nodes = tree.tree()
+
+        page = self.paginate_queryset(nodes)
+        if page is not None:
+            return set_validators(self.get_paginated_response(page), etag)
+        return set_validators(Response(nodes), etag)
+
     def get_object(self):
         obj = super().get_object()
         return obj
 
     def retrieve(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
         try:
             obj = self.get_object()
             serializer = self.get_serializer(obj)
-            return Response(serializer.data)
+            return set_validators(Response(serializer.data), etag)
         except Http404:
             raise NotFound('Category not found.')
         except Exception as e:
@@ -56,7 +135,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
             return Response({'error': f'An error occurred while deleting the category: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class SubcategoryViewSet(viewsets.ModelViewSet):
-    queryset = Subcategory.objects.all()
+    queryset = Subcategory.objects.select_related('category')
     serializer_class = SubcategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsAdminUser]
     authentication_classes = [JWTAuthentication]
@@ -97,16 +176,17 @@ class SubcategoryViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'error': f'An error occurred while deleting the Subcategory: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(SparseFieldsetsMixin, KeysetPaginationMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [IsAdminOrReadOnly]
     authentication_classes = [JWTAuthentication]
     parser_classes = [MultiPartParser, JSONParser]
-    
-    search_fields = ['name']
+    # ?search= goes through the in-process index instead of SearchFilter's LIKE scan.
+    filter_backends = []
     lookup_url_kwarg = 'product_id'
-    
+    list_actions = ('list', 'search')
+
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['request'] = self.request
@@ -122,57 +202,214 @@ class ProductViewSet(viewsets.ModelViewSet):
             transaction.set_rollback(True)
             return Response({'error': f'An error occurred while creating the product: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
+    def get_facet_filters(self):
+        # The filters the facets are counted across, by name. Each facet
+        # leaves its own filter out (see compute_facets).
         params = self.request.query_params
+        filters = {}
 
         category_id = params.get('category')
         subcategory_id = params.get('subcategory')
         if category_id or subcategory_id:
-            try:
-                if category_id:
-                    Category.objects.get(id=category_id)
-                if subcategory_id:
-                    Subcategory.objects.get(id=subcategory_id)
-            except (Category.DoesNotExist, Subcategory.DoesNotExist):
+            tree = taxonomy.get()
+            if (category_id and not tree.has_category(category_id)) or \
+                    (subcategory_id and not tree.has_subcategory(subcategory_id)):
                 raise ValidationError("Invalid category or subcategory ID(s) provided.")
 
         if category_id or subcategory_id:
-            queryset = queryset.filter(Q(category_id=category_id) | Q(subcategory_id=subcategory_id))
+            taxonomy_filter = Q()
+            if category_id:
+                taxonomy_filter |= Q(category_id=category_id)
+            if subcategory_id:
+                taxonomy_filter |= Q(subcategory_id=subcategory_id)
+            filters['taxonomy'] = taxonomy_filter
+
+        brands = [brand.strip() for brand in params.get('brand', '').split(',') if brand.strip()]
+        if brands:
+            filters['brand'] = Q(brand__in=brands)
 
         min_price = params.get('minPrice')
         max_price = params.get('maxPrice')
         if min_price and max_price:
-            queryset = queryset.filter(price_after_discount__gte=float(min_price), price_after_discount__lte=float(max_price))
+            filters['price'] = Q(price_after_discount__gte=float(min_price), price_after_discount__lte=float(max_price))
         elif min_price:
-            queryset = queryset.filter(price_after_discount__gte=float(min_price))
+            filters['price'] = Q(price_after_discount__gte=float(min_price))
         elif max_price:
-            queryset = queryset.filter(price_after_discount__lte=float(max_price))
+            filters['price'] = Q(price_after_discount__lte=float(max_price))
 
-        sort_field = params.get('sort', 'category')
-        if sort_field:
-            queryset = queryset.order_by(sort_field)
+        return filters
+
+    def get_queryset(self):
+        queryset = self.get_base_queryset()
+        for condition in self.get_facet_filters().values():
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def get_base_queryset(self):
+        # Everything but the facet filters: search, rating, field selection
+        # and ordering.
+        queryset = super().get_queryset()
+        params = self.request.query_params
 
+        if self.request.method == 'GET':
+            selected = self.get_selected_fields()
+            if selected is not None and 'description' not in selected:
+                # The longest column by far; skip reading it when it is not sent.
+                queryset = queryset.defer('description')
+
+        search = params.get('search')
+        if search:
+            # Only the best ranked matches go on to the ordering and
+            # pagination below; list() flags the response when some were cut.
+            matches = product_search_index.search(search, limit=MAX_RESULTS + 1)
+            self.search_truncated = len(matches) > MAX_RESULTS
+            queryset = queryset.filter(id__in=matches[:MAX_RESULTS])
+
+        sort_field = params.get('sort', 'category')
         sort_order = params.get('sort_order', 'asc')
-        if sort_order == 'desc':
-            queryset = queryset.order_by('-price_after_discount')
+        min_rating = params.get('minRating')
+        if sort_field == 'rating' or min_rating:
+            queryset = queryset.annotate(
+                rating_average=Coalesce(Cast('rating_sum', FloatField()) / NullIf('rating_count', 0), 0.0)
+            )
+        if min_rating:
+            queryset = queryset.filter(rating_average__gte=float(min_rating))
+
+        if sort_field in ('rating', 'views'):
+            direction = '-' if sort_order == 'desc' else ''
+            field = 'rating_average' if sort_field == 'rating' else 'view_count'
+            queryset = queryset.order_by(f'{direction}{field}', f'{direction}id')
         else:
-            queryset = queryset.order_by('price_after_discount')
+            if sort_field:
+                queryset = queryset.order_by(sort_field)
+
+            if sort_order == 'desc':
+                queryset = queryset.order_by('-price_after_discount')
+            else:
+                queryset = queryset.order_by('price_after_discount')
 
         return queryset
 
+    def use_keyset_pagination(self):
+        # Search results are ordered by relevance, which has no keyset.
+        return self.action != 'search' and super().use_keyset_pagination()
+
+    def get_keyset_ordering(self):
+        params = self.request.query_params
+        field = {'rating': 'rating_average', 'views': 'view_count'}.get(params.get('sort'), 'price_after_discount')
+        if params.get('sort_order', 'asc') == 'desc':
+            return (f'-{field}', '-id')
+        return (field, 'id')
+
     def get_object(self):
         try:
             return super().get_object()
         except Http404:
             raise NotFound('Product not found.')
 
+    def list(self, request, *args, **kwargs):
+        # Stock-only writes leave the list version alone, so the ETag is taken
+        # from the cached body rather than from the cache key.
+        cache_key = product_list_cache_key(request)
+        entry = cached_response_data(cache_key)
+        if entry is not None:
+            etag = response_etag(request, entry['digest'])
+            cached = not_modified(request, etag)
+            if cached is not None:
+                return cached
+            return set_validators(Response(entry['data']), etag)
+
+        response = super().list(request, *args, **kwargs)
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        if getattr(self, 'search_truncated', False):
+            response.data['search_truncated'] = True
+        digest = content_digest(response.data)
+        store_response_data(cache_key, {'data': response.data, 'digest': digest})
+        return set_validators(response, response_etag(request, digest))
+
     def retrieve(self, request, *args, **kwargs):
+        response = self.retrieve_product(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            record_view(kwargs.get(self.lookup_url_kwarg))
+        return response
+
+    def retrieve_product(self, request, *args, **kwargs):
         try:
-            return super().retrieve(request, *args, **kwargs)
+            cache_key = product_detail_cache_key(request, kwargs.get(self.lookup_url_kwarg))
+            etag = response_etag(request, cache_key)
+            cached = not_modified(request, etag)
+            if cached is not None:
+                return cached
+
+            data = cached_response_data(cache_key)
+            if data is not None:
+                return set_validators(Response(data), etag)
+
+            response = super().retrieve(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                store_response_data(cache_key, response.data)
+            return set_validators(response, etag)
         except Exception as e:
             return Response({'error': f'An error occurred while retrieving the Product: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Query parameter q is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = product_list_cache_key(request)
+        data = cached_response_data(cache_key)
+        if data is not None:
+            return Response(data)
+
+        ranked_ids = product_search_index.search(query)
+        # Category and price filters still come from get_queryset; the index only decides relevance.
+        allowed_ids = set(self.get_queryset().filter(id__in=ranked_ids).values_list('id', flat=True))
+        ids = [product_id for product_id in ranked_ids if product_id in allowed_ids]
+
+        page = self.paginate_queryset(ids)
+        page_ids = page if page is not None else ids
+        products = Product.objects.in_bulk(page_ids)
+        serializer = self.get_serializer([products[product_id] for product_id in page_ids if product_id in products], many=True)
+        if page is not None:
+            response = self.get_paginated_response(serializer.data)
+        else:
+            response = Response(serializer.data)
+        store_response_data(cache_key, response.data)
+        return response
+
+    @action(detail=False, methods=['get'], url_path='autocomplete')
+    def autocomplete(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(int(request.query_params.get('limit', SUGGESTION_LIMIT)), MAX_SUGGESTION_LIMIT)
+        except ValueError:
+            return Response({'error': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'query': query, 'results': autocomplete_index.suggest(query, max(limit, 1))})
+
+    @action(detail=True, methods=['get'], url_path='related')
+    def related(self, request, product_id=None):
+        cache_key = product_related_cache_key(request, product_id)
+        data = cached_response_data(cache_key)
+        if data is None:
+            product = self.get_object()
+            serializer = ProductListSerializer(related_products(product), many=True,
+                                               context=self.get_serializer_context(), **self.get_fieldset_kwargs())
+            data = serializer.data
+            store_response_data(cache_key, data)
+        return Response(data)
+
+    @action(detail=False, methods=['get'], url_path='facets')
+    def facets(self, request):
+        cache_key = product_list_cache_key(request)
+        data = cached_response_data(cache_key)
+        if data is None:
+            data = compute_facets(self.get_base_queryset(), self.get_facet_filters())
+            store_response_data(cache_key, data)
+        return Response(data)
+
     def update(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
@@ -194,13 +431,27 @@ class ProductViewSet(viewsets.ModelViewSet):
             return Response({'error': f'An error occurred while deleting the Product: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Comments
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrAdmin]
     authentication_classes = [JWTAuthentication]
     parser_classes = [JSONParser]
     lookup_url_kwarg = 'comment_id'
+    keyset_ordering = ('-created_at', '-id')
+
+    def list(self, request, *args, **kwargs):
+        product_id = request.query_params.get('product_id')
+        first_page = product_id and set(request.query_params) == {'product_id'}
+        cache_key = comment_page_cache_key(request, product_id) if first_page else None
+        data = cached_response_data(cache_key)
+        if data is not None:
+            return Response(data)
+
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            store_response_data(cache_key, response.data)
+        return response
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -215,12 +466,15 @@ class CommentViewSet(viewsets.ModelViewSet):
         serializer.save(owner=self.request.user)
 
     def get_queryset(self):
+        queryset = self.queryset.select_related('owner')
         product_id = self.request.query_params.get('product_id')
         if product_id:
-            return self.queryset.filter(product_id=product_id)
+            # A product's feed is newest first, by page number or, with
+            # ?pagination=cursor, by cursor.
+            return queryset.filter(product_id=product_id).order_by(*self.keyset_ordering)
         if self.request.user.is_superuser:
-            return self.queryset
-        return self.queryset.filter(owner=self.request.user)
+            return queryset
+        return queryset.filter(owner=self.request.user)
 
     def retrieve(self, request, *args, **kwargs):
         try:
@@ -247,17 +501,17 @@ class CommentViewSet(viewsets.ModelViewSet):
             return Response({'error': f'An error occurred while deleting the comment: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Rating
-class RatingViewSet(viewsets.ModelViewSet):
+class RatingViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrAdmin]
     authentication_classes = [JWTAuthentication]
     parser_classes = [JSONParser]
-    filter_backends = [SearchFilter, OrderingFilter]
-    search_fields = ['product__name', 'user__phone_number']
+    filter_backends = [OrderingFilter]
     ordering_fields = ['product', 'user']
     ordering = ['product']
     lookup_url_kwarg = 'rating_id'
+    keyset_ordering = ('product_id', 'id')
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -277,8 +531,22 @@ class RatingViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({"error": f'An error occurred while creating the rating: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        rating = serializer.save(user=self.request.user)
+        apply_rating_change(rating.product_id, new_rating=rating.rating)
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        old_rating = serializer.instance.rating
+        rating = serializer.save()
+        apply_rating_change(rating.product_id, old_rating=old_rating, new_rating=rating.rating)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        product_id, old_rating = instance.product_id, instance.rating
+        instance.delete()
+        apply_rating_change(product_id, old_rating=old_rating)
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -292,6 +560,13 @@ class RatingViewSet(viewsets.ModelViewSet):
         if user_id:
             queryset = queryset.filter(user_id=user_id)
 
+        search = params.get('search')
+        if search:
+            queryset = queryset.filter(
+                Q(product_id__in=product_search_index.search(search, limit=FILTER_RESULTS)) |
+                Q(user__phone_number__startswith=search.strip())
+            )
+
         return queryset
 
     def retrieve(self, request, *args, **kwargs):
@@ -321,12 +596,71 @@ class RatingViewSet(viewsets.ModelViewSet):
             return Response({'error': f'An error occurred while deleting the rating: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)    
 
 
-class TopSellerAPIView(ListAPIView):
+class TopSellerAPIView(SparseFieldsetsMixin, ListAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
     authentication_classes = []
 
 
+    def get_product_ids(self):
+        params = self.request.query_params
+        category_id = params.get('category')
+        window = params.get('window')
+
+        product_ids = top_product_ids(limit=10, category_id=category_id, window=window)
+        if product_ids is None:
+            queryset = self.queryset
+            if category_id:
+                queryset = queryset.filter(category_id=category_id)
+            product_ids = list(queryset.order_by('-sales_count').values_list('id', flat=True)[:10])
+        return product_ids
+
+    def get_queryset(self):
+        product_ids = getattr(self, 'product_ids', None)
+        if product_ids is None:
+            product_ids = self.get_product_ids()
+        queryset = Product.objects.all()
+        selected = self.get_selected_fields()
+        if selected is not None and 'description' not in selected:
+            queryset = queryset.defer('description')
+        products = queryset.in_bulk(product_ids)
+        return [products[product_id] for product_id in product_ids if product_id in products]
+
+    def list(self, request, *args, **kwargs):
+        # The ranking plus the product versions identify the response, so an
+        # unchanged board is answered without loading or serializing products.
+        # The stock version is there because the serialized stock moves
+        # without the list version.
+        self.product_ids = self.get_product_ids()
+        etag = response_etag(request, get_version(PRODUCT_LIST_VERSION_KEY), get_version(PRODUCT_STOCK_VERSION_KEY),
+                             request.build_absolute_uri(), self.product_ids)
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+        return set_validators(super().list(request, *args, **kwargs), etag)
+
+
+class MostViewedAPIView(SparseFieldsetsMixin, ListAPIView):
+    queryset = Product.objects.all()
+    serializer_class = ProductSerializer
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
     def get_queryset(self):
-        return self.queryset.order_by('-sales_count')[:10]
+        params = self.request.query_params
+        days = 7 if params.get('window') == '7d' else None
+        product_ids = most_viewed_ids(limit=10, category_id=params.get('category'), days=days)
+        products = Product.objects.defer('description').in_bulk(product_ids)
+        return [products[product_id] for product_id in product_ids if product_id in products]
+
+
+# Content-addressed files change name whenever their bytes change, so they can
+# be cached by clients and CDNs for good.
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+def serve_product_media(request, path):
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if is_content_addressed(path):
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    return response
@@ -3,6 +3,6 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('request/', views.send_request, name='request'),
+    path('request/', views.initiate_payment, name='request'),
     path('verify/', views.verify , name='verify'),
 ]
@@ -6,6 +6,7 @@ from rest_framework.response import Response
 from rest_framework import status
 from order_app.serializers import CartSerializer
 from order_app.models import Cart
+from order_app.idempotency import idempotent
 import requests
 import json
 
@@ -23,6 +24,8 @@ CallbackURL = 'http://127.0.0.1:8080/verify/'
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+# A gateway failure is not stored, so a retry asks the gateway again.
+@idempotent(store_if=lambda response: response.data.get('status', True))
 def initiate_payment(request):
     user = request.user
     cart = get_object_or_404(Cart, user=user)